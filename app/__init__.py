@@ -1,57 +1,158 @@
+import asyncio
 import logging
 import os
 
 from flask import Flask
 
 from app.driver.file_driver import LocalFileDriverImpl
+from app.library import ocr
+from app.library.executor import run_coroutine, worker_pool
+from app.library.job_queue import JobWorkerPool, create_job_queue
+from app.library.matching_template import correlation
+from app.library.metrics import stats_collector, tracing
+from app.library.result_cache import ResultCache, create_redis_client, file_digest
+from app.library.template_locator import CalibrationCache
 from app.usecase.ability import AbilityInteractor
 from app.usecase.character import CharacterInteractor
 from app.usecase.skill_interactor import SkillInteractor
 from app.usecase.status_interactor import StatusInteractor
 from app.usecase.image import ImageInteractor
-from app.views.api import APIResource
+from app.usecase.templates import (ability_rank_classifier, glyph_digit_reader, resource_path, template_locator,
+                                  template_registry)
+from app.views.api import APIRequest, APIResource
 from app.views.web import WebResource
 
 
-def create_app():
-    logging.basicConfig(level=logging.INFO)
-    debug = os.environ.get('ENABLE_DEBUG', True)
+async def load_master_data(character_interactor: CharacterInteractor, skill_interactor: SkillInteractor):
+    # 最初のリクエストで読み込まないよう、マスターデータは起動時に読み込んでおく
+    await asyncio.gather(
+        character_interactor.get_master_characters(),
+        character_interactor.get_master_all_characters(),
+        skill_interactor.get_master_skill_names_by_weight(),
+        skill_interactor.get_master_skills_map_by_type(),
+    )
 
-    app = Flask(__name__, instance_relative_config=True)
 
-    app.config.from_object("settings")
+def create_api_resource(config, logger, *, debug=None) -> APIResource:
+    # テンプレート・マスターデータ・OCRエンジンを読み込んでから、APIのリソースを組み立てる
+    # debugを指定しなければ、途中の画像をtmp/以下に書き出すかをENABLE_DEBUGで決める
+    if debug is None:
+        debug = os.environ.get('ENABLE_DEBUG', True)
+    search_mode = config['TEMPLATE_SEARCH_MODE']
+
+    tracing.configure(enabled=config['TRACING_ENABLED'], sampling_rate=config['TRACING_SAMPLING_RATE'])
+
+    correlation.configure(mode=config['CORRELATION_BACKEND'], crossover=config['CORRELATION_FFT_CROSSOVER'])
+    template_registry.load()
+    calibration = CalibrationCache(path=config['TEMPLATE_CALIBRATION_PATH']) if config['TEMPLATE_CALIBRATION'] else None
+    if calibration is not None:
+        calibration.load()
+    template_locator.configure(enabled=config['TEMPLATE_LAYOUT_PRIORS'], boxes=config['TEMPLATE_LAYOUT_PRIOR_BOXES'],
+                               calibration=calibration)
+    ability_rank_classifier.load()
+    glyph_digit_reader.load(config['GLYPH_BANK_PATH'])
+    glyph_digit_reader.bootstrap(config['GLYPH_BANK_BOOTSTRAP_PATH'])
+    ocr.warm_up()
+
+    skill_interactor = SkillInteractor(
+        LocalFileDriverImpl(''),
+        logger,
+        debug=debug,
+        search_mode=search_mode,
+    )
+
+    # マスターデータが更新されたら以前の結果は使わない
+    result_cache = ResultCache(
+        maxsize=config['RESULT_CACHE_SIZE'],
+        ttl=config['RESULT_CACHE_TTL'],
+        version=file_digest([resource_path('master_data', name)
+                             for name in ('characters.json', 'all_characters.json', 'skills.json')]),
+        redis_client=create_redis_client(config['RESULT_CACHE_REDIS_URL']),
+    )
+    job_worker_pool = JobWorkerPool(
+        create_job_queue(create_redis_client(config['JOB_QUEUE_REDIS_URL']), ttl=config['JOB_TTL'],
+                         max_depth=config['JOB_QUEUE_MAX_DEPTH']),
+        workers=config['JOB_WORKERS'],
+        progress_interval=config['JOB_PROGRESS_INTERVAL'],
+    )
+
+    character_interactor = CharacterInteractor(
+        LocalFileDriverImpl(''),
+        logger,
+        debug=debug,
+        search_mode=search_mode,
+    )
+    run_coroutine(load_master_data(character_interactor, skill_interactor))
 
-    web_resource = WebResource()
     api_resource = APIResource(
         StatusInteractor(
             LocalFileDriverImpl(''),
-            app.logger,
-            debug=debug,
-        ),
-        CharacterInteractor(
-            LocalFileDriverImpl(''),
-            app.logger,
+            logger,
             debug=debug,
+            search_mode=search_mode,
         ),
+        character_interactor,
         AbilityInteractor(
             LocalFileDriverImpl(''),
-            app.logger,
-            debug=debug,
-        ),
-        SkillInteractor(
-            LocalFileDriverImpl(''),
-            app.logger,
+            logger,
             debug=debug,
         ),
+        skill_interactor,
         ImageInteractor(
             LocalFileDriverImpl(''),
-            app.logger,
+            logger,
             debug=debug,
-        )
+            search_mode=search_mode,
+        ),
+        template_registry,
+        result_cache,
+        job_worker_pool,
+        batch_concurrency=config['BATCH_CONCURRENCY'],
+        max_batch_size=config['MAX_BATCH_SIZE'],
     )
 
+    stats_collector.register('templates', template_registry.stats)
+    stats_collector.register('layout_priors', template_locator.stats)
+    if calibration is not None:
+        stats_collector.register('template_calibration', calibration.stats)
+    stats_collector.register('ocr_engines', ocr.engine_pool.stats)
+    stats_collector.register('worker_pool', worker_pool.stats)
+    stats_collector.register('result_cache', result_cache.stats)
+    stats_collector.register('jobs', job_worker_pool.stats)
+
+    return api_resource
+
+
+def add_url_rules(app: Flask, web_resource: WebResource, api_resource: APIResource):
     app.add_url_rule('/', view_func=web_resource.as_view('web_resource'))
     app.add_url_rule('/api/v1/ocr/status', view_func=api_resource.post_ocr_status, methods=['POST'])
     app.add_url_rule('/api/v1/ocr/support_params', view_func=api_resource.post_ocr_support_params, methods=['POST'])
+    app.add_url_rule('/api/v1/ocr/status:batch', view_func=api_resource.post_ocr_status_batch, methods=['POST'])
+    app.add_url_rule('/api/v1/ocr/support_params:batch', view_func=api_resource.post_ocr_support_params_batch,
+                     methods=['POST'])
+    app.add_url_rule('/api/v1/jobs/ocr/status', view_func=api_resource.post_ocr_status_job, methods=['POST'])
+    app.add_url_rule('/api/v1/jobs/ocr/support_params', view_func=api_resource.post_ocr_support_params_job,
+                     methods=['POST'])
+    app.add_url_rule('/api/v1/jobs/<job_id>', view_func=api_resource.get_job, methods=['GET'])
+    app.add_url_rule('/api/v1/stats/templates', view_func=api_resource.get_template_stats, methods=['GET'])
+    app.add_url_rule('/api/v1/stats/result_cache', view_func=api_resource.get_result_cache_stats, methods=['GET'])
+    app.add_url_rule('/api/v1/stats/jobs', view_func=api_resource.get_job_stats, methods=['GET'])
+    app.add_url_rule('/metrics', view_func=api_resource.get_metrics, methods=['GET'])
+
+
+def create_app():
+    logging.basicConfig(level=logging.INFO)
+
+    app = Flask(__name__, instance_relative_config=True)
+    app.request_class = APIRequest
+
+    app.config.from_object("settings")
+
+    web_resource = WebResource()
+    api_resource = create_api_resource(app.config, app.logger)
+
+    add_url_rules(app, web_resource, api_resource)
+
+    api_resource.job_worker_pool.start()
 
     return app
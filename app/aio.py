@@ -0,0 +1,51 @@
+import logging
+
+from aiohttp import web
+
+import settings
+from app import create_api_resource
+from app.views.aio_api import AioAPIResource
+from app.views.api import APIResource
+
+
+def load_config() -> dict:
+    return {key: getattr(settings, key) for key in dir(settings) if key.isupper()}
+
+
+def create_aio_app(api_resource: APIResource = None, *, config: dict = None) -> web.Application:
+    # Flaskのスレッドごとにイベントループを回す代わりに、1つのイベントループで多数のアップロードを受ける
+    # api_resourceを渡された場合は、読み込み済みのものをそのまま使う
+    logging.basicConfig(level=logging.INFO)
+
+    config = config or load_config()
+    if api_resource is None:
+        api_resource = create_api_resource(config, logging.getLogger(__name__))
+    aio_resource = AioAPIResource(
+        api_resource,
+        max_concurrency=config['AIO_MAX_CONCURRENCY'],
+        max_content_length=config['MAX_CONTENT_LENGTH'],
+        max_batch_content_length=config['MAX_BATCH_CONTENT_LENGTH'],
+    )
+
+    # エンドポイントごとの上限はハンドラでアップロードを読みながら確認する
+    app = web.Application(client_max_size=config['MAX_BATCH_CONTENT_LENGTH'])
+    app.router.add_post('/api/v1/ocr/status', aio_resource.post_ocr_status)
+    app.router.add_post('/api/v1/ocr/support_params', aio_resource.post_ocr_support_params)
+    app.router.add_post('/api/v1/ocr/status:batch', aio_resource.post_ocr_status_batch)
+    app.router.add_post('/api/v1/ocr/support_params:batch', aio_resource.post_ocr_support_params_batch)
+    app.router.add_post('/api/v1/jobs/ocr/status', aio_resource.post_ocr_status_job)
+    app.router.add_post('/api/v1/jobs/ocr/support_params', aio_resource.post_ocr_support_params_job)
+    app.router.add_get('/api/v1/jobs/{job_id}', aio_resource.get_job)
+    app.router.add_get('/api/v1/stats/templates', aio_resource.get_template_stats)
+    app.router.add_get('/api/v1/stats/result_cache', aio_resource.get_result_cache_stats)
+    app.router.add_get('/api/v1/stats/jobs', aio_resource.get_job_stats)
+    app.router.add_get('/api/v1/health/ready', aio_resource.get_ready)
+    app.router.add_get('/metrics', aio_resource.get_metrics)
+    app.on_startup.append(aio_resource.on_startup)
+    app.on_shutdown.append(aio_resource.on_shutdown)
+
+    return app
+
+
+if __name__ == '__main__':
+    web.run_app(create_aio_app(), host=settings.HOST, port=settings.PORT)
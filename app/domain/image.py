@@ -1,8 +1,117 @@
+import threading
+
+import cv2
+import numpy as np
 from PIL import Image
 from dataclasses import dataclass
-from app.library.pillow import resize_pil
+from app.library.pillow import binarized, crop_array, crop_pil, resize_pil
+
+INPUT_IMAGE_WIDTH = 1024
+
+
+class ImageContext:
+    # リクエスト中に共有する前処理済みの画像
+    # 幅1024へのリサイズ・グレースケール化・しきい値ごとの二値化は初回に一度だけ行い、
+    # crop() で切り出した領域も元画像の処理結果を切り出して使い回す
+    # リサイズの補間方法は読み取りごとに従来のものを使う。スキルはLANCZOS、それ以外はBILINEAR
+
+    def __init__(self, image: Image, *, width=INPUT_IMAGE_WIDTH, resample=Image.BILINEAR, parent=None, box=None):
+        self.source = image
+        self.width = width
+        self.resample = resample
+        self.parent = parent
+        self.box = box
+        self.cache_resampled = dict()
+        self.cache_image = None
+        self.cache_array = None
+        self.cache_gray = None
+        self.cache_binarized = dict()
+        self.lock = threading.RLock()
+
+    @classmethod
+    def of(cls, image) -> 'ImageContext':
+        if isinstance(image, ImageContext):
+            return image
+        return cls(image)
+
+    @property
+    def image(self) -> Image:
+        with self.lock:
+            if self.cache_image is None:
+                if self.parent is None:
+                    self.cache_image = resize_pil(self.source.convert('RGB'), self.width, None, self.resample)
+                else:
+                    self.cache_image = crop_pil(self.parent.image, self.box)
+            return self.cache_image
+
+    @property
+    def size(self) -> (int, int):
+        # 大きさだけならリサイズ・切り出しをせずに元画像の大きさから求める
+        if self.parent is None:
+            return resized_size(self.source.size, self.width)
+
+        (sx, sy, ex, ey) = (int(round(v)) for v in self.box)
+        return max(ex - sx, 0), max(ey - sy, 0)
+
+    @property
+    def array(self) -> np.ndarray:
+        with self.lock:
+            if self.cache_array is None:
+                if self.parent is None:
+                    self.cache_array = np.asarray(self.image)
+                else:
+                    self.cache_array = crop_array(self.parent.array, self.box)
+            return self.cache_array
+
+    @property
+    def gray(self) -> np.ndarray:
+        with self.lock:
+            if self.cache_gray is None:
+                if self.parent is None:
+                    self.cache_gray = cv2.cvtColor(self.array, cv2.COLOR_RGB2GRAY)
+                else:
+                    self.cache_gray = crop_array(self.parent.gray, self.box)
+            return self.cache_gray
+
+    def binarized(self, threshold: int) -> Image:
+        with self.lock:
+            if threshold not in self.cache_binarized:
+                if self.parent is None:
+                    self.cache_binarized[threshold] = binarized(self.image, threshold)
+                else:
+                    self.cache_binarized[threshold] = crop_pil(self.parent.binarized(threshold), self.box)
+            return self.cache_binarized[threshold]
+
+    def crop(self, box) -> 'ImageContext':
+        return ImageContext(self.source, width=self.width, resample=self.resample, parent=self, box=box)
+
+    def resampled(self, resample) -> 'ImageContext':
+        # 同じ元画像を別の補間方法でリサイズしたコンテキスト。補間方法ごとに一度だけ作る
+        if resample == self.resample:
+            return self
+        if self.parent is not None:
+            return self.parent.resampled(resample).crop(self.box)
+
+        with self.lock:
+            if resample not in self.cache_resampled:
+                self.cache_resampled[resample] = ImageContext(self.source, width=self.width, resample=resample)
+            return self.cache_resampled[resample]
+
+
+def resized_size(size: (int, int), width: int) -> (int, int):
+    # resize_pil で幅をwidthにしたときの大きさ
+    (w, h) = size
+    if w == width:
+        return w, h
+    return width, int(h * (width / float(w)))
+
 
 @dataclass(frozen=True)
 class CharacterDetailImage:
     image: Image
     params_frame_loc: list
+    context: ImageContext = None
+
+    def __post_init__(self):
+        if self.context is None:
+            object.__setattr__(self, 'context', ImageContext(self.image))
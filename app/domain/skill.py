@@ -50,3 +50,26 @@ class CharacterSkills:
             'normal_skills': self.normal_skills.to_dict_array(),
         }
 
+
+@dataclass(frozen=True)
+class SkillExtraction:
+    skills: NormalSkills
+    master_unique_skill_names: frozenset
+
+    def is_unique_skill(self, skill: NormalSkill) -> bool:
+        return skill.name in self.master_unique_skill_names and skill.level > 0
+
+    def unique_skill(self, *, last=False) -> UniqueSkill:
+        # 固有スキルが複数読み取れた場合、固有スキルだけを返すAPIは最初の、スキル一覧を返すAPIは最後のものを返す
+        unique_skills = [skill for skill in self.skills.values if self.is_unique_skill(skill)]
+        if len(unique_skills) == 0:
+            return UniqueSkill('', 0)
+
+        skill = unique_skills[-1] if last else unique_skills[0]
+        return UniqueSkill(skill.name, skill.level)
+
+    def normal_skills(self) -> NormalSkills:
+        return NormalSkills([skill for skill in self.skills.values if not self.is_unique_skill(skill)])
+
+    def character_skills(self) -> CharacterSkills:
+        return CharacterSkills(self.unique_skill(last=True), self.normal_skills())
@@ -1,8 +1,8 @@
 from abc import ABCMeta, abstractmethod
 from PIL import Image
-from app.domain.image import CharacterDetailImage
+from app.domain.image import CharacterDetailImage, ImageContext
 
 class ImageUsecase(metaclass=ABCMeta):
     @abstractmethod
-    async def create_character_detail_image(self, image: Image) -> CharacterDetailImage:
+    async def create_character_detail_image(self, image: Image or ImageContext) -> CharacterDetailImage:
         raise NotImplementedError
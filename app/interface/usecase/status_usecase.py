@@ -14,3 +14,10 @@ class StatusUsecase(metaclass=ABCMeta):
     async def get_support_parameters_from_image(self, image: Image) -> SupportParameters:
         raise NotImplementedError
 
+    @abstractmethod
+    async def crop_parameter_images(self, image: Image) -> [Image] or None:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def crop_support_parameter_images(self, image: Image) -> [Image] or None:
+        raise NotImplementedError
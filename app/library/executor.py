@@ -0,0 +1,137 @@
+import asyncio
+import contextvars
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class WorkerPoolStats:
+    workers: int
+    active: int
+    queued: int
+    completed: int
+
+    def to_dict(self):
+        return {
+            'workers': self.workers,
+            'active': self.active,
+            'queued': self.queued,
+            'completed': self.completed,
+        }
+
+
+class WorkerPool:
+    # OCRやテンプレートマッチングなどのブロッキング処理を実行する、プロセス全体で共有する上限付きのスレッドプール
+    # リクエストごとにスレッドを作らないので、同時リクエスト数が増えてもスレッド数はmax_workersを超えない
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self.executor = None
+        self.pid = None
+        self.active = 0
+        self.queued = 0
+        self.completed = 0
+        self.lock = threading.Lock()
+
+    def get_executor(self) -> ThreadPoolExecutor:
+        with self.lock:
+            # fork後の子プロセスには親のスレッドが引き継がれないので作り直す
+            if self.executor is None or self.pid != os.getpid():
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='worker')
+                self.pid = os.getpid()
+            return self.executor
+
+    async def run(self, func, *args, **kwargs):
+        # 呼び出し元のContextVarを引き継いで実行する
+        context = contextvars.copy_context()
+        with self.lock:
+            self.queued += 1
+        future = self.get_executor().submit(self.call, context, func, args, kwargs)
+        future.add_done_callback(self.on_done)
+        return await asyncio.wrap_future(future)
+
+    def call(self, context, func, args, kwargs):
+        with self.lock:
+            self.queued -= 1
+            self.active += 1
+        try:
+            return context.run(func, *args, **kwargs)
+        finally:
+            with self.lock:
+                self.active -= 1
+                self.completed += 1
+
+    def on_done(self, future):
+        # 実行前にキャンセルされた処理は待ち行列から外す
+        if future.cancelled():
+            with self.lock:
+                self.queued -= 1
+
+    def shutdown(self):
+        with self.lock:
+            (executor, self.executor) = (self.executor, None)
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def stats(self) -> WorkerPoolStats:
+        with self.lock:
+            return WorkerPoolStats(self.max_workers, self.active, self.queued, self.completed)
+
+
+class EventLoopThread:
+    # Flaskのリクエストスレッドからコルーチンを実行するための常駐イベントループ
+    # リクエストや呼び出しのたびにイベントループを作らない
+
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def get_loop(self) -> asyncio.AbstractEventLoop:
+        with self.lock:
+            if self.loop is None or self.pid != os.getpid():
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name='event-loop', daemon=True)
+                thread.start()
+                (self.loop, self.thread, self.pid) = (loop, thread, os.getpid())
+            return self.loop
+
+    def run(self, coro, timeout=None):
+        self.get_loop()
+        if threading.current_thread() is self.thread:
+            coro.close()
+            raise RuntimeError('run_coroutine() cannot be called from the event loop thread')
+
+        return self.submit(coro).result(timeout)
+
+    def submit(self, coro) -> Future:
+        return asyncio.run_coroutine_threadsafe(coro, self.get_loop())
+
+    def close(self):
+        with self.lock:
+            (loop, thread, self.loop, self.thread) = (self.loop, self.thread, None, None)
+        if loop is None or self.pid != os.getpid():
+            return
+
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+worker_pool = WorkerPool(int(os.environ.get('WORKER_THREADS', os.cpu_count() or 1)))
+event_loop = EventLoopThread()
+
+
+async def run_blocking(func, *args, **kwargs):
+    return await worker_pool.run(func, *args, **kwargs)
+
+
+def run_coroutine(coro, timeout=None):
+    return event_loop.run(coro, timeout)
+
+
+def submit_coroutine(coro) -> Future:
+    return event_loop.submit(coro)
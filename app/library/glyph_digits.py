@@ -0,0 +1,178 @@
+import os
+import threading
+import zipfile
+from logging import getLogger
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from app.library.ocr import DigitField
+from app.library.pillow import background_level
+
+GLYPH_WIDTH = 16
+GLYPH_HEIGHT = 24
+DIGITS = '0123456789'
+
+logger = getLogger(__name__)
+
+
+class GlyphDigitReader:
+    # ゲーム内フォントの数字を連結成分ごとに切り出し、0〜9の字形バンクとの相関で読み取る
+    # 字形バンクは scripts.glyph_bank で正解付きのテスト画像から事前に作り、resources/ に置いておく
+    # bootstrap() を呼んだ場合だけ、実際のリクエストでTesseractが確度高く読めた結果からも学習する
+
+    def __init__(self, *, border=0.85, min_samples=3):
+        self.border = border
+        self.min_samples = min_samples
+        self.learning = False
+        self.sums = np.zeros((len(DIGITS), GLYPH_WIDTH * GLYPH_HEIGHT))
+        self.counts = np.zeros(len(DIGITS), dtype=np.int64)
+        self.bank = None
+        self.bootstrap_path = None
+        self.learned = 0
+        self.lock = threading.Lock()
+
+    def configure(self, *, learning: bool):
+        # 学習中は字形バンクで読まず、読み取り結果や正解から学習する
+        self.learning = learning
+
+    def collecting(self) -> bool:
+        # Tesseractで読んだ結果を学習に渡すかどうか
+        return self.learning or self.bootstrap_path is not None
+
+    def bootstrap(self, path: str or None):
+        # 字形バンクがなければ、以前に学習した結果を読み込み、まだ揃っていなければ揃うまで学習して path に書き出す
+        if not path or self.bank is not None:
+            return
+
+        self.load(path)
+        if self.bank is None:
+            logger.info('learning the glyph bank from confident Tesseract reads until all digits are seen: %s', path)
+            self.bootstrap_path = path
+
+    def load(self, path: str or None):
+        if not path:
+            return
+        if not os.path.exists(path):
+            logger.info('glyph bank %s not found, reading digits with Tesseract only', path)
+            return
+
+        try:
+            with np.load(path) as data:
+                (sums, counts) = (data['sums'], data['counts'])
+            if sums.shape != self.sums.shape or counts.shape != self.counts.shape:
+                raise ValueError('unexpected shape: sums {}, counts {}'.format(sums.shape, counts.shape))
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            # 壊れたファイルでは起動を止めず、字形バンクを使わずにTesseractで読み取る
+            logger.warning('failed to load glyph bank: %s', path, exc_info=True)
+            return
+
+        with self.lock:
+            self.sums = sums.astype(np.float64)
+            self.counts = counts.astype(np.int64)
+            self.bank = build_bank(self.sums, self.counts, self.min_samples)
+
+    def save(self, path: str):
+        with self.lock:
+            (sums, counts) = (self.sums.copy(), self.counts.copy())
+        # 書き込み途中のファイルを読まないよう、別名で書いてから置き換える
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, sums=sums, counts=counts)
+        os.replace(tmp_path, path)
+
+    def read(self, image: Image) -> DigitField or None:
+        bank = self.bank
+        if bank is None or self.learning:
+            return None
+
+        glyphs = segment_glyphs(image)
+        if len(glyphs) == 0:
+            return None
+
+        scores = glyphs @ bank.T
+        indexes = np.argmax(scores, axis=1)
+        confidences = scores[np.arange(len(glyphs)), indexes]
+        if confidences.min() < self.border:
+            return None
+
+        text = ''.join(DIGITS[index] for index in indexes)
+        return DigitField(text, float(confidences.min()) * 100)
+
+    def learn(self, image: Image, text: str) -> bool:
+        if not self.collecting() or len(text) == 0 or not text.isdigit():
+            return False
+
+        glyphs = segment_glyphs(image)
+        if len(glyphs) != len(text):
+            return False
+
+        with self.lock:
+            for (glyph, digit) in zip(glyphs, text):
+                self.sums[DIGITS.index(digit)] += glyph
+                self.counts[DIGITS.index(digit)] += 1
+            self.bank = build_bank(self.sums, self.counts, self.min_samples)
+            self.learned += 1
+            (path, self.bootstrap_path) = ((self.bootstrap_path, None) if self.bank is not None
+                                           else (None, self.bootstrap_path))
+
+        if path is not None:
+            # 書き出せなくても、このプロセスでは学習した字形バンクで読み取る
+            try:
+                self.save(path)
+                logger.info('glyph bank learned from %d parameters: %s', self.learned, path)
+            except OSError:
+                logger.warning('failed to save glyph bank: %s', path, exc_info=True)
+        return True
+
+
+def build_bank(sums: np.ndarray, counts: np.ndarray, min_samples: int) -> np.ndarray or None:
+    # 一部の数字が欠けたバンクでは、欠けた数字を別の数字と読み違えるので使わない
+    if counts.min() < min_samples:
+        return None
+
+    return normalize_glyphs(sums / counts[:, None])
+
+
+def normalize_glyphs(glyphs: np.ndarray) -> np.ndarray:
+    glyphs = glyphs - glyphs.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(glyphs, axis=1, keepdims=True)
+    return np.divide(glyphs, norms, out=np.zeros_like(glyphs), where=norms > 1e-6)
+
+
+def segment_glyphs(image: Image) -> np.ndarray:
+    # 背景と異なる画素の連結成分を字形とし、左から順に正規化したベクトルで返す
+    gray = np.asarray(image.convert('L'))
+    foreground = (gray != background_level([image])).astype(np.uint8)
+
+    n, _, stats, _ = cv2.connectedComponentsWithStats(foreground, connectivity=8)
+    if n <= 1:
+        return np.zeros((0, GLYPH_WIDTH * GLYPH_HEIGHT))
+
+    components = stats[1:]
+    max_height = components[:, cv2.CC_STAT_HEIGHT].max()
+    components = components[components[:, cv2.CC_STAT_HEIGHT] >= max_height * 0.5]
+    components = components[np.argsort(components[:, cv2.CC_STAT_LEFT])]
+
+    # 途切れた線で複数に分かれた字形は、横方向に重なる成分同士をまとめる
+    boxes = []
+    for (x, y, w, h, _) in components:
+        if len(boxes) > 0 and x < boxes[-1][2]:
+            (sx, sy, ex, ey) = boxes[-1]
+            boxes[-1] = (sx, min(sy, y), max(ex, x + w), max(ey, y + h))
+        else:
+            boxes.append((x, y, x + w, y + h))
+
+    glyphs = []
+    for (sx, sy, ex, ey) in boxes:
+        glyph = foreground[sy:ey, sx:ex].astype(np.float32)
+        # 「1」のような細い字形が潰れないよう、縦横比を保ったまま左右に余白を足す
+        width = max(ex - sx, int(np.ceil((ey - sy) * GLYPH_WIDTH / GLYPH_HEIGHT)))
+        left = (width - (ex - sx)) // 2
+        glyph = cv2.copyMakeBorder(glyph, 0, 0, left, width - (ex - sx) - left, cv2.BORDER_CONSTANT, value=0)
+        glyph = cv2.resize(glyph, (GLYPH_WIDTH, GLYPH_HEIGHT), interpolation=cv2.INTER_AREA)
+        glyphs.append(glyph.reshape(-1))
+
+    return normalize_glyphs(np.array(glyphs, dtype=np.float64))
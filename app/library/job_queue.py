@@ -0,0 +1,326 @@
+import concurrent.futures
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from dataclasses import dataclass, replace
+from logging import getLogger
+
+import cachetools
+import msgpack
+
+from app.library.executor import submit_coroutine
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+logger = getLogger(__name__)
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class Job:
+    id: str
+    endpoint: str
+    status: str
+    total: int
+    submitted_at: float
+    completed: int = 0
+    started_at: float = None
+    finished_at: float = None
+    result: list = None
+    error: str = None
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'endpoint': self.endpoint,
+            'status': self.status,
+            'total': self.total,
+            'submitted_at': self.submitted_at,
+            'completed': self.completed,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'result': self.result,
+            'error': self.error,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Job':
+        return cls(**data)
+
+
+@dataclass(frozen=True)
+class JobQueueStats:
+    depth: int
+    running: int
+    submitted: int
+    done: int
+    failed: int
+    wait_seconds_total: float
+    wait_seconds_max: float
+    execution_seconds_total: float
+    execution_seconds_max: float
+
+    def to_dict(self):
+        return {
+            'depth': self.depth,
+            'running': self.running,
+            'submitted': self.submitted,
+            'done': self.done,
+            'failed': self.failed,
+            'wait_seconds_total': self.wait_seconds_total,
+            'wait_seconds_max': self.wait_seconds_max,
+            'execution_seconds_total': self.execution_seconds_total,
+            'execution_seconds_max': self.execution_seconds_max,
+        }
+
+
+class MemoryJobQueue:
+    # プロセス内の待ち行列。ジョブの状態は終了後もttlの間だけ保持する
+    # アップロードされた画像をそのまま持つので、待ち行列の長さはmax_depthまでにする
+
+    def __init__(self, *, ttl: int, max_depth: int, maxsize=10000):
+        self.ttl = ttl
+        self.queue = queue.Queue(maxsize=max_depth)
+        self.jobs = cachetools.TTLCache(maxsize=maxsize, ttl=ttl)
+        self.lock = threading.Lock()
+
+    def put(self, job: Job, payload: dict):
+        self.save(job)
+        try:
+            self.queue.put_nowait((job, payload))
+        except queue.Full:
+            with self.lock:
+                self.jobs.pop(job.id, None)
+            raise JobQueueFull('job queue is full (max {})'.format(self.queue.maxsize))
+
+    def get(self, timeout: float) -> (Job, dict) or None:
+        try:
+            (job, payload) = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+        # 待っている間にttlが過ぎて状態が消えていれば、投入した時点の状態を返す
+        return self.load(job.id) or job, payload
+
+    def save(self, job: Job):
+        with self.lock:
+            self.jobs[job.id] = job
+
+    def load(self, job_id: str) -> Job or None:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+
+class RedisJobQueue:
+    # Redisのリストを待ち行列にして、複数のプロセス・コンテナで同じジョブを共有する
+    # BLPOPで取り出した時点で待ち行列から消えるので、実行中にワーカーのプロセスが落ちたジョブは再実行されない
+    # （at-most-once）。そのジョブは running のまま JOB_TTL が過ぎると消えるので、クライアントは投入し直す
+
+    def __init__(self, redis_client, *, ttl: int, max_depth: int, prefix='umaocr'):
+        self.redis_client = redis_client
+        self.ttl = ttl
+        self.max_depth = max_depth
+        self.queue_key = '{}:jobs:queue'.format(prefix)
+        self.job_key_prefix = '{}:jobs:'.format(prefix)
+
+    def put(self, job: Job, payload: dict):
+        message = msgpack.packb({'job': job.to_dict(), 'payload': payload})
+        pipeline = self.redis_client.pipeline()
+        pipeline.set(self.job_key_prefix + job.id, json.dumps(job.to_dict()), ex=self.ttl)
+        pipeline.rpush(self.queue_key, message)
+        (_, depth) = pipeline.execute()
+        if depth <= self.max_depth:
+            return
+
+        # 追加した後に上限を超えていれば取り消す。取り消す前にワーカーが取り出していれば、そのまま受け付ける
+        if self.redis_client.lrem(self.queue_key, -1, message) > 0:
+            self.redis_client.delete(self.job_key_prefix + job.id)
+            raise JobQueueFull('job queue is full (max {})'.format(self.max_depth))
+
+    def get(self, timeout: float) -> (Job, dict) or None:
+        item = self.redis_client.blpop([self.queue_key], timeout=max(int(timeout), 1))
+        if item is None:
+            return None
+
+        # 待っている間にttlが過ぎて状態が消えていれば、投入した時点の状態を返す
+        message = msgpack.unpackb(item[1])
+        job = Job.from_dict(message['job'])
+        return self.load(job.id) or job, message['payload']
+
+    def save(self, job: Job):
+        self.redis_client.set(self.job_key_prefix + job.id, json.dumps(job.to_dict()), ex=self.ttl)
+
+    def load(self, job_id: str) -> Job or None:
+        data = self.redis_client.get(self.job_key_prefix + job_id)
+        if data is None:
+            return None
+        return Job.from_dict(json.loads(data))
+
+    def depth(self) -> int:
+        return self.redis_client.llen(self.queue_key)
+
+
+class JobWorkerPool:
+    # 待ち行列からジョブを取り出して実行する、上限付きのワーカースレッド
+    # handlerは (payload, on_progress) を受け取り、結果を返すコルーチン関数
+
+    def __init__(self, job_queue, *, workers: int, poll_interval=1.0, progress_interval=1.0):
+        self.job_queue = job_queue
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.progress_interval = progress_interval
+        self.handlers = dict()
+        self.threads = []
+        self.pid = None
+        self.stopping = threading.Event()
+        self.running = 0
+        self.submitted = 0
+        self.done = 0
+        self.failed = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.execution_seconds_total = 0.0
+        self.execution_seconds_max = 0.0
+        self.lock = threading.Lock()
+
+    def register(self, endpoint: str, handler):
+        self.handlers[endpoint] = handler
+
+    def start(self):
+        with self.lock:
+            # fork後の子プロセスには親のスレッドが引き継がれないので、プロセスごとに起動する
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.stopping.clear()
+            self.threads = [threading.Thread(target=self.run, name='job-worker-{}'.format(i), daemon=True)
+                            for i in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+        with self.lock:
+            self.pid = None
+
+    def alive(self) -> bool:
+        # このプロセスで起動したワーカーがすべて動いているか
+        with self.lock:
+            return (self.pid == os.getpid() and not self.stopping.is_set()
+                    and all(thread.is_alive() for thread in self.threads))
+
+    def submit(self, endpoint: str, payload: dict, total: int) -> Job:
+        # 待ち行列が上限に達していれば JobQueueFull を送出する
+        if endpoint not in self.handlers:
+            raise ValueError('unknown endpoint: {}'.format(endpoint))
+
+        job = Job(uuid.uuid4().hex, endpoint, JOB_QUEUED, total, time.time())
+        self.job_queue.put(job, payload)
+        with self.lock:
+            self.submitted += 1
+        return job
+
+    def get(self, job_id: str) -> Job or None:
+        return self.job_queue.load(job_id)
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                item = self.job_queue.get(self.poll_interval)
+            except Exception:
+                logger.exception('failed to get a job')
+                self.stopping.wait(self.poll_interval)
+                continue
+
+            if item is not None:
+                self.execute(*item)
+
+    def execute(self, job: Job, payload: dict):
+        started_at = time.time()
+        if started_at - job.submitted_at >= self.job_queue.ttl:
+            # 状態の保持期間を過ぎるまで待たされたジョブは実行せず、失敗として残す
+            job = replace(job, status=JOB_FAILED, error='job expired before it started')
+            self.finish(job, started_at, started_at)
+            return
+
+        job = replace(job, status=JOB_RUNNING, started_at=started_at)
+        self.job_queue.save(job)
+        with self.lock:
+            self.running += 1
+            self.wait_seconds_total += started_at - job.submitted_at
+            self.wait_seconds_max = max(self.wait_seconds_max, started_at - job.submitted_at)
+
+        progress = [0]
+
+        def on_progress(_):
+            # イベントループ上で呼ばれるので数えるだけにし、待ち行列への保存はこのワーカースレッドで行う
+            progress[0] += 1
+
+        future = submit_coroutine(self.handlers[job.endpoint](payload, on_progress))
+        saved = 0
+        while not concurrent.futures.wait([future], timeout=self.progress_interval).done:
+            if progress[0] == saved:
+                continue
+            saved = progress[0]
+            try:
+                self.job_queue.save(replace(job, completed=saved))
+            except Exception:
+                logger.exception('failed to save the progress of job: %s', job.id)
+
+        try:
+            result = future.result()
+            job = replace(job, status=JOB_DONE, completed=job.total, result=result)
+        except Exception as e:
+            logger.exception('failed to execute job: %s', job.id)
+            job = replace(job, status=JOB_FAILED, completed=progress[0], error=str(e))
+
+        with self.lock:
+            self.running -= 1
+        self.finish(job, started_at, time.time())
+
+    def finish(self, job: Job, started_at: float, finished_at: float):
+        job = replace(job, finished_at=finished_at)
+        self.job_queue.save(job)
+        with self.lock:
+            if job.status == JOB_DONE:
+                self.done += 1
+            else:
+                self.failed += 1
+            self.execution_seconds_total += finished_at - started_at
+            self.execution_seconds_max = max(self.execution_seconds_max, finished_at - started_at)
+
+    def stats(self) -> JobQueueStats:
+        depth = self.job_queue.depth()
+        with self.lock:
+            return JobQueueStats(
+                depth,
+                self.running,
+                self.submitted,
+                self.done,
+                self.failed,
+                self.wait_seconds_total,
+                self.wait_seconds_max,
+                self.execution_seconds_total,
+                self.execution_seconds_max,
+            )
+
+
+def create_job_queue(redis_client, *, ttl: int, max_depth: int):
+    if redis_client is None:
+        return MemoryJobQueue(ttl=ttl, max_depth=max_depth)
+
+    return RedisJobQueue(redis_client, ttl=ttl, max_depth=max_depth)
@@ -1,15 +1,151 @@
+import threading
+import time
 from dataclasses import dataclass
 from logging import getLogger
 
+import cachetools
 import cv2
 import numpy
 from PIL import Image
 
-from app.library.pillow import pil2cv
+from app.library.metrics import correlations, stage, timed
+from app.library.pillow import pil2gray
+
+SEARCH_MODE_FULL = 'full'
+SEARCH_MODE_PYRAMID = 'pyramid'
+
+PYRAMID_DOWNSAMPLE = 0.25
+PYRAMID_CANDIDATES = 2
+PYRAMID_FINE_STEPS = 5
+
+# 近傍での最大値を取る範囲（px）
+PEAK_SIZE = 5
+
+CORRELATION_SPATIAL = 'spatial'
+CORRELATION_FFT = 'fft'
+CORRELATION_AUTO = 'auto'
+
+
+@dataclass(frozen=True)
+class TemplateMatch:
+    score: float
+    ratio: float
+    start: tuple
+    end: tuple
+
+    @property
+    def loc(self):
+        return self.start, self.end
+
+
+class CorrelationBackend:
+    # cv2.matchTemplate と、画像全体のDFTによる正規化相互相関のどちらで相関を計算するかを選ぶ
+    # autoでは、直接計算した場合の演算量とDFTの演算量の比が crossover 以上のときだけDFTを使う
+    # crossoverは scripts/benchmark/correlation.py で実機の速度を計測して決める
+
+    def __init__(self, *, mode=CORRELATION_AUTO, crossover=float('inf'), max_spectrum_bytes=64 * 1024 * 1024):
+        self.mode = mode
+        self.crossover = crossover
+        # テンプレートは使い回されるので、DFTの大きさごとにスペクトルを保持しておく
+        self.spectra = cachetools.LRUCache(maxsize=max_spectrum_bytes, getsizeof=lambda value: value[0].nbytes)
+        self.lock = threading.Lock()
+
+    def configure(self, *, mode: str, crossover: float):
+        if mode not in (CORRELATION_SPATIAL, CORRELATION_FFT, CORRELATION_AUTO):
+            raise ValueError('unknown correlation backend: {}'.format(mode))
+        self.mode = mode
+        self.crossover = crossover
+
+    def choose(self, image_shape, templ_shape, method) -> str:
+        if method != cv2.TM_CCOEFF_NORMED or self.mode == CORRELATION_SPATIAL:
+            return CORRELATION_SPATIAL
+        if self.mode == CORRELATION_FFT:
+            return CORRELATION_FFT
+        return CORRELATION_FFT if cost_ratio(image_shape, templ_shape) >= self.crossover else CORRELATION_SPATIAL
+
+    def match(self, image, templ, method):
+        backend = self.choose(image.shape, templ.shape, method)
+        correlations.labels(backend).inc()
+        if backend == CORRELATION_FFT:
+            return self.fft_ccoeff_normed(image, templ)
+        return cv2.matchTemplate(image, templ, method)
+
+    def spectrum(self, templ, dft_shape) -> (numpy.ndarray, float):
+        key = (templ.shape, dft_shape, hash(templ.tobytes()))
+        with self.lock:
+            value = self.spectra.get(key)
+        if value is None:
+            value = template_spectrum(templ, dft_shape)
+            if value[0].nbytes <= self.spectra.maxsize:
+                with self.lock:
+                    self.spectra[key] = value
+        return value
+
+    def fft_ccoeff_normed(self, image, templ):
+        (h, w) = image.shape[:2]
+        (tH, tW) = templ.shape[:2]
+        if h < tH or w < tW:
+            # cv2.matchTemplateと同じ例外を送出させる
+            return cv2.matchTemplate(image, templ, cv2.TM_CCOEFF_NORMED)
+
+        dft_shape = (cv2.getOptimalDFTSize(h), cv2.getOptimalDFTSize(w))
+        (templ_spectrum, templ_norm) = self.spectrum(templ, dft_shape)
+        return fft_ccoeff_normed(image, templ.shape[:2], templ_spectrum, templ_norm)
+
+
+def cost_ratio(image_shape, templ_shape) -> float:
+    # 直接計算した場合の積和の回数と、DFT（N log N）の演算量の比
+    (h, w) = image_shape[:2]
+    (tH, tW) = templ_shape[:2]
+    if h < tH or w < tW:
+        return 0.0
+    direct = float(h - tH + 1) * (w - tW + 1) * tH * tW
+    dft_area = float(cv2.getOptimalDFTSize(h)) * cv2.getOptimalDFTSize(w)
+    return direct / (dft_area * numpy.log2(max(dft_area, 2)))
+
+
+def template_spectrum(templ, dft_shape) -> (numpy.ndarray, float):
+    # 平均を引いたテンプレートのスペクトル（CCS形式）と、そのノルム
+    zero_mean = (templ - templ.mean()).astype(numpy.float32)
+    padded = cv2.copyMakeBorder(zero_mean, 0, dft_shape[0] - templ.shape[0], 0, dft_shape[1] - templ.shape[1],
+                                cv2.BORDER_CONSTANT, value=0)
+    norm = float(numpy.sqrt(numpy.square(zero_mean, dtype=numpy.float64).sum()))
+    return cv2.dft(padded, nonzeroRows=templ.shape[0]), norm
+
+
+def fft_ccoeff_normed(image, templ_shape, templ_spectrum, templ_norm):
+    # TM_CCOEFF_NORMED と同じ値を返す。分子はDFTによる相互相関、分母は積分画像から求めた窓ごとの分散
+    (h, w) = image.shape[:2]
+    (tH, tW) = templ_shape
+    (oH, oW) = (h - tH + 1, w - tW + 1)
+    (dH, dW) = templ_spectrum.shape[:2]
+
+    padded = cv2.copyMakeBorder(image, 0, dH - h, 0, dW - w, cv2.BORDER_CONSTANT, value=0).astype(numpy.float32)
+    spectrum = cv2.mulSpectrums(cv2.dft(padded, nonzeroRows=h), templ_spectrum, 0, conjB=True)
+    num = cv2.idft(spectrum, flags=cv2.DFT_REAL_OUTPUT | cv2.DFT_SCALE, nonzeroRows=oH)[:oH, :oW]
+
+    (sums, sq_sums) = cv2.integral2(image, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+    window_sum = sums[tH:, tW:] - sums[:-tH, tW:] - sums[tH:, :-tW] + sums[:-tH, :-tW]
+    window_sq_sum = sq_sums[tH:, tW:] - sq_sums[:-tH, tW:] - sq_sums[tH:, :-tW] + sq_sums[:-tH, :-tW]
+    variance = numpy.maximum(window_sq_sum - window_sum * window_sum / (tH * tW), 0)
+
+    # 分散がほぼ0の窓や丸め誤差の扱いはOpenCVの実装に合わせる
+    denominator = numpy.sqrt(variance) * templ_norm
+    denominator[variance <= numpy.minimum(0.5, 10 * numpy.finfo(numpy.float32).eps * window_sq_sum)] = 0
+    result = numpy.zeros((oH, oW), dtype=numpy.float32)
+    abs_num = numpy.abs(num)
+    inner = abs_num < denominator
+    result[inner] = num[inner] / denominator[inner]
+    edge = ~inner & (abs_num < denominator * 1.125)
+    result[edge] = numpy.sign(num[edge])
+    return result
+
+
+correlation = CorrelationBackend()
 
 
 def matching_template(image, templ, *, method=cv2.TM_CCOEFF_NORMED):
-    return cv2.matchTemplate(image, templ, method)
+    return correlation.match(image, templ, method)
 
 
 def multi_scale_matching_template(image,
@@ -17,26 +153,46 @@ def multi_scale_matching_template(image,
                                   linspace,
                                   *,
                                   method=cv2.TM_CCOEFF_NORMED,
+                                  mode=SEARCH_MODE_FULL,
                                   logger=None,
                                   debug=False):
     logger = logger or getLogger(__name__)
 
-    image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    templ = cv2.cvtColor(templ, cv2.COLOR_BGR2GRAY)
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    if templ.ndim == 3:
+        templ = cv2.cvtColor(templ, cv2.COLOR_BGR2GRAY)
+
+    match = search_template(image, templ, linspace, method=method, mode=mode)
+    if match is None:
+        return None
+
+    return match.loc
+
 
-    loc = _multi_scale_matching_template_impl(image,
-                                              templ,
-                                              linspace,
-                                              method=method)
+@timed('template.search_template')
+def search_template(image,
+                    templ,
+                    linspace,
+                    *,
+                    method=cv2.TM_CCOEFF_NORMED,
+                    mode=SEARCH_MODE_FULL) -> TemplateMatch or None:
+    gray_image = pil2gray(image)
+    gray_templ = pil2gray(templ)
 
-    return loc
+    if mode == SEARCH_MODE_PYRAMID:
+        return _pyramid_search_template(gray_image, gray_templ, linspace, method=method)
+    if mode == SEARCH_MODE_FULL:
+        return _full_search_template(gray_image, gray_templ, linspace, method=method)
 
+    raise ValueError('unknown search mode: {}'.format(mode))
 
-def _multi_scale_matching_template_impl(image,
-                                        templ,
-                                        linspace,
-                                        *,
-                                        method=cv2.TM_CCOEFF_NORMED):
+
+def _full_search_template(image,
+                          templ,
+                          linspace,
+                          *,
+                          method=cv2.TM_CCOEFF_NORMED):
     (tH, tW) = templ.shape[:2]
 
     found = None
@@ -56,11 +212,81 @@ def _multi_scale_matching_template_impl(image,
     if found is None:
         return None
 
-    (_, maxLoc, r) = found
+    (maxVal, maxLoc, r) = found
     (startX, startY) = (int(maxLoc[0] * r), int(maxLoc[1] * r))
     (endX, endY) = (int((maxLoc[0] + tW) * r), int((maxLoc[1] + tH) * r))
 
-    return (startX, startY), (endX, endY)
+    return TemplateMatch(maxVal, r, (startX, startY), (endX, endY))
+
+
+def _pyramid_search_template(image,
+                             templ,
+                             linspace,
+                             *,
+                             method=cv2.TM_CCOEFF_NORMED,
+                             downsample=PYRAMID_DOWNSAMPLE,
+                             candidates=PYRAMID_CANDIDATES,
+                             fine_steps=PYRAMID_FINE_STEPS):
+    (h, w) = image.shape[:2]
+    (tH, tW) = templ.shape[:2]
+
+    # 縮小した画像で全スケールを粗く探索する
+    small_image = resize(image, max(int(w * downsample), 1))
+    small_templ = resize(templ, max(int(tW * downsample), 1))
+    d = small_image.shape[1] / float(w)
+
+    coarse = []
+    for scale in linspace[::-1]:
+        resized = resize(small_image, int(small_image.shape[1] * scale))
+        r = small_image.shape[1] / float(resized.shape[1])
+
+        if resized.shape[0] < small_templ.shape[0] or resized.shape[1] < small_templ.shape[1]:
+            break
+
+        result = matching_template(resized, small_templ, method=method)
+        (_, maxVal, _, maxLoc) = cv2.minMaxLoc(result)
+        coarse.append((maxVal, scale, (maxLoc[0] * r / d, maxLoc[1] * r / d)))
+
+    if len(coarse) == 0:
+        return _full_search_template(image, templ, linspace, method=method)
+
+    # 上位候補の周辺だけを元の解像度・細かいスケールで探索し直す
+    step = (linspace.max() - linspace.min()) / max(len(linspace) - 1, 1)
+    pad = int(numpy.ceil(4 / d))
+
+    found = None
+    for (_, scale, (x, y)) in sorted(coarse, key=lambda k: -k[0])[:candidates]:
+        fine_linspace = numpy.clip(numpy.linspace(scale - step, scale + step, fine_steps),
+                                   linspace.min(), linspace.max())
+        min_scale = fine_linspace.min()
+
+        roi_sx = max(int(x) - pad, 0)
+        roi_sy = max(int(y) - pad, 0)
+        roi_ex = min(int(x + tW / min_scale) + pad, w)
+        roi_ey = min(int(y + tH / min_scale) + pad, h)
+        roi = image[roi_sy:roi_ey, roi_sx:roi_ex]
+
+        for fine_scale in numpy.unique(fine_linspace):
+            resized = resize(roi, int(roi.shape[1] * fine_scale))
+            r = roi.shape[1] / float(resized.shape[1])
+
+            if resized.shape[0] < tH or resized.shape[1] < tW:
+                continue
+
+            result = matching_template(resized, templ, method=method)
+            (_, maxVal, _, maxLoc) = cv2.minMaxLoc(result)
+
+            if found is None or maxVal > found[0]:
+                found = (maxVal, maxLoc, r, (roi_sx, roi_sy))
+
+    if found is None:
+        return _full_search_template(image, templ, linspace, method=method)
+
+    (maxVal, maxLoc, r, (roi_sx, roi_sy)) = found
+    (startX, startY) = (roi_sx + int(maxLoc[0] * r), roi_sy + int(maxLoc[1] * r))
+    (endX, endY) = (roi_sx + int((maxLoc[0] + tW) * r), roi_sy + int((maxLoc[1] + tH) * r))
+
+    return TemplateMatch(maxVal, r, (startX, startY), (endX, endY))
 
 
 @dataclass(frozen=True)
@@ -69,6 +295,7 @@ class MultiScaleMatchingTemplateResult:
     result: []
 
 
+@timed('template.multi_scale_matching_template_impl')
 def multi_scale_matching_template_impl(
         image: Image,
         templ: Image,
@@ -76,13 +303,10 @@ def multi_scale_matching_template_impl(
         linspace=numpy.linspace(1.0, 1.1, 10),
         method=cv2.TM_CCOEFF_NORMED,
 ):
-    cv2_image = pil2cv(image)
-    cv2_templ = pil2cv(templ)
-
-    (tH, tW) = cv2_templ.shape[:2]
+    gray_cv2_image = pil2gray(image)
+    gray_cv2_templ = pil2gray(templ)
 
-    gray_cv2_image = cv2.cvtColor(cv2_image, cv2.COLOR_BGR2GRAY)
-    gray_cv2_templ = cv2.cvtColor(cv2_templ, cv2.COLOR_BGR2GRAY)
+    (tH, tW) = gray_cv2_templ.shape[:2]
 
     results = []
 
@@ -99,6 +323,65 @@ def multi_scale_matching_template_impl(
     return results
 
 
+@dataclass(frozen=True)
+class TemplateDetections:
+    locs: list
+    scores: list
+    raw_hits: int
+    suppression_seconds: float
+
+
+def find_peaks(result, threshold: float, *, size=PEAK_SIZE) -> (numpy.ndarray, numpy.ndarray, numpy.ndarray):
+    # しきい値以上の点のうち、周囲size×sizeの範囲で最大のものだけを返す
+    dilated = cv2.dilate(result, numpy.ones((size, size), numpy.uint8))
+    (ys, xs) = numpy.where((result >= threshold) & (result >= dilated))
+    return xs, ys, result[ys, xs]
+
+
+def non_maximum_suppression(xs, ys, scores, distance: (int, int)) -> numpy.ndarray:
+    # スコアの高い順に採用し、採用した点から横distance[0]・縦distance[1]未満の点を候補から除く
+    (dx, dy) = distance
+    order = numpy.argsort(-scores, kind='stable')
+    keep = []
+    while len(order) > 0:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        order = rest[(numpy.abs(xs[rest] - xs[i]) >= dx) | (numpy.abs(ys[rest] - ys[i]) >= dy)]
+    return numpy.array(keep, dtype=numpy.int64)
+
+
+@timed('template.detect_templates')
+def detect_templates(results: [MultiScaleMatchingTemplateResult],
+                     templ_shape,
+                     *,
+                     threshold: float,
+                     distance: (int, int)) -> TemplateDetections:
+    # multi_scale_matching_template_impl の全スケールの結果から、重ならないテンプレートの位置をすべて返す
+    (tH, tW) = templ_shape[:2]
+
+    raw_hits = 0
+    candidates = []
+    for result in results:
+        raw_hits += int(numpy.count_nonzero(result.result >= threshold))
+        (xs, ys, scores) = find_peaks(result.result, threshold)
+        candidates.append((xs * result.ratio, ys * result.ratio,
+                           (xs + tW) * result.ratio, (ys + tH) * result.ratio, scores))
+
+    if len(candidates) == 0:
+        return TemplateDetections([], [], raw_hits, 0.0)
+
+    (start_xs, start_ys, end_xs, end_ys, scores) = (numpy.concatenate(values) for values in zip(*candidates))
+
+    start = time.perf_counter()
+    with stage('template.non_maximum_suppression'):
+        keep = non_maximum_suppression(start_xs, start_ys, scores, distance)
+    suppression_seconds = time.perf_counter() - start
+
+    locs = [((int(start_xs[i]), int(start_ys[i])), (int(end_xs[i]), int(end_ys[i]))) for i in keep]
+    return TemplateDetections(locs, [float(scores[i]) for i in keep], raw_hits, suppression_seconds)
+
+
 def resize(image, width=None, height=None, inter=cv2.INTER_AREA):
     (h, w) = image.shape[:2]
 
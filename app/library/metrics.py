@@ -0,0 +1,201 @@
+import contextvars
+import functools
+import inspect
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+stage_seconds = Histogram(
+    'umaocr_stage_seconds', 'Time spent in each pipeline stage', ['stage'], buckets=STAGE_BUCKETS)
+ocr_seconds = Histogram(
+    'umaocr_ocr_seconds', 'Time spent in each OCR call', ['builder', 'lang'], buckets=STAGE_BUCKETS)
+ocr_calls = Counter(
+    'umaocr_ocr_calls', 'Number of OCR calls', ['builder', 'lang'])
+skill_threshold_retries = Counter(
+    'umaocr_skill_threshold_retries', 'Number of skill name reads retried with a fixed threshold', ['threshold'])
+skill_frame_raw_hits = Histogram(
+    'umaocr_skill_frame_raw_hits', 'Number of skill frame template hits before non-maximum suppression',
+    buckets=(0, 10, 100, 1000, 10000, 100000))
+layout_prior_searches = Counter(
+    'umaocr_layout_prior_searches', 'Number of template searches using a layout prior', ['template', 'result'])
+correlations = Counter(
+    'umaocr_correlations', 'Number of template correlations by backend', ['backend'])
+template_calibrations = Counter(
+    'umaocr_template_calibrations', 'Number of template searches seeded by a resolution calibration',
+    ['template', 'result'])
+
+
+class Timings:
+    # 1リクエスト内のステージを開始順に記録する。parentは呼び出し元のステージのid
+
+    def __init__(self, timer=time.perf_counter):
+        self.timer = timer
+        self.origin = timer()
+        self.items = []
+        self.lock = threading.Lock()
+
+    def start(self, name: str, parent: int or None, attributes: dict) -> int:
+        item = dict(attributes, id=0, parent=parent, stage=name,
+                    start_ms=round((self.timer() - self.origin) * 1000, 2), elapsed_ms=None)
+        with self.lock:
+            item['id'] = len(self.items)
+            self.items.append(item)
+        return item['id']
+
+    def finish(self, stage_id: int, elapsed: float):
+        with self.lock:
+            self.items[stage_id]['elapsed_ms'] = round(elapsed * 1000, 2)
+
+    def to_list(self) -> [dict]:
+        with self.lock:
+            return [dict(item) for item in self.items]
+
+
+class Tracing:
+    # opencensusのトレースは明示的に有効にした場合だけ行う
+
+    def __init__(self):
+        self.enabled = False
+        self.sampling_rate = 1.0
+        self.exporter = None
+
+    def configure(self, *, enabled: bool, sampling_rate=1.0, exporter=None):
+        self.enabled = enabled
+        self.sampling_rate = sampling_rate
+        self.exporter = exporter
+
+    def create_tracer(self):
+        from opencensus.trace.logging_exporter import LoggingExporter
+        from opencensus.trace.samplers import ProbabilitySampler
+        from opencensus.trace.tracer import Tracer
+
+        if self.exporter is None:
+            self.exporter = LoggingExporter()
+        return Tracer(sampler=ProbabilitySampler(self.sampling_rate), exporter=self.exporter)
+
+
+tracing = Tracing()
+
+# asyncioのタスクやワーカープールのスレッドにも引き継がれるよう、リクエスト単位の状態はContextVarで持つ
+current_timings = contextvars.ContextVar('current_timings', default=None)
+current_stage = contextvars.ContextVar('current_stage', default=None)
+current_tracer = contextvars.ContextVar('current_tracer', default=None)
+
+
+@contextmanager
+def stage(name: str, **attributes):
+    timings = current_timings.get()
+    tracer = current_tracer.get()
+    stage_id = timings.start(name, current_stage.get(), attributes) if timings is not None else None
+    token = current_stage.set(stage_id)
+    span = tracer.start_span(name) if tracer is not None else None
+    if span is not None:
+        for (key, value) in attributes.items():
+            span.add_attribute(key, value)
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if span is not None:
+            tracer.end_span()
+        current_stage.reset(token)
+        if timings is not None:
+            timings.finish(stage_id, elapsed)
+        stage_seconds.labels(name).observe(elapsed)
+
+
+@contextmanager
+def request_stage(name: str, *, timings: Timings = None):
+    # リクエストの最上位のステージ。timingsを渡すと内側のステージの内訳を記録する
+    tracer = tracing.create_tracer() if tracing.enabled else None
+    tokens = [(current_timings, current_timings.set(timings)),
+              (current_stage, current_stage.set(None)),
+              (current_tracer, current_tracer.set(tracer))]
+    try:
+        with stage(name):
+            yield
+    finally:
+        for (var, token) in reversed(tokens):
+            var.reset(token)
+
+
+def timed(name: str):
+    # コルーチン関数にも通常の関数にも使えるデコレータ
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with stage(name):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def ocr_call(builder, lang: str):
+    labels = (type(builder).__name__, lang)
+    ocr_calls.labels(*labels).inc()
+    start = time.perf_counter()
+    try:
+        with stage('ocr', builder=labels[0], lang=lang):
+            yield
+    finally:
+        ocr_seconds.labels(*labels).observe(time.perf_counter() - start)
+
+
+class StatsCollector:
+    # 各コンポーネントの stats() をスクレイプのたびに読み取り、数値の項目をゲージとして出力する
+
+    def __init__(self):
+        self.sources = dict()
+
+    def register(self, name: str, stats):
+        self.sources[name] = stats
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        for (name, stats) in list(self.sources.items()):
+            for (field, value) in stats().to_dict().items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                yield GaugeMetricFamily('umaocr_{}_{}'.format(name, field), '{} {}'.format(name, field), value=value)
+
+
+stats_collector = StatsCollector()
+REGISTRY.register(stats_collector)
+
+
+def multiprocess_dir() -> str or None:
+    # prometheus_clientと同じ環境変数を読む
+    return os.environ.get('PROMETHEUS_MULTIPROC_DIR') or os.environ.get('prometheus_multiproc_dir')
+
+
+def generate_metrics() -> (bytes, str):
+    registry = REGISTRY
+    if multiprocess_dir():
+        # prefork時は子プロセスごとのヒストグラム・カウンターを合算する。stats()の値はこのプロセスのもの
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(stats_collector)
+
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -1,33 +1,107 @@
+import os
+from dataclasses import dataclass
+
 import pyocr
+import pyocr.builders
+import pyocr.libtesseract
 from PIL import Image
 
+from app.library.metrics import ocr_call
+from app.library.pillow import background_level, concat_horizontal
+from app.library.tesseract_pool import EngineKey, TesseractEnginePool
+
+OCR_BACKEND_LIBTESSERACT = 'libtesseract'
+OCR_BACKEND_TESSERACT = 'tesseract'
+
 tools = pyocr.get_available_tools()
 tool = tools[0]
 
+ocr_backend = os.environ.get('OCR_BACKEND', OCR_BACKEND_LIBTESSERACT)
+if ocr_backend == OCR_BACKEND_LIBTESSERACT and not pyocr.libtesseract.is_available():
+    ocr_backend = OCR_BACKEND_TESSERACT
+
+engine_pool = TesseractEnginePool(int(os.environ.get('OCR_MAX_ENGINES', os.cpu_count() or 1)))
+
+ENGINE_KEYS = [
+    EngineKey('eng', 7, True),
+    EngineKey('eng', 7, False),
+    EngineKey('jpn', 7, False),
+]
+
+
+@dataclass(frozen=True)
+class DigitField:
+    text: str
+    confidence: float
+
+
+def image_to_string(image: Image, lang: str, builder):
+    with ocr_call(builder, lang):
+        if ocr_backend == OCR_BACKEND_LIBTESSERACT:
+            return engine_pool.image_to_string(image, lang, builder)
+
+        return tool.image_to_string(image, lang=lang, builder=builder)
+
+
+def warm_up():
+    if ocr_backend == OCR_BACKEND_LIBTESSERACT:
+        engine_pool.warm_up(ENGINE_KEYS)
+
 
 def get_digit_with_single_text_line_and_eng_from_image(image: Image):
     builder = pyocr.builders.DigitBuilder(tesseract_layout=7)
-    text = tool.image_to_string(image, lang="eng", builder=builder)
+    text = image_to_string(image, lang="eng", builder=builder)
 
     return text
 
 
 def get_text_with_single_text_line_and_jpn_from_image(image: Image):
     builder = pyocr.builders.TextBuilder(tesseract_layout=7)
-    text = tool.image_to_string(image, lang="jpn", builder=builder)
+    text = image_to_string(image, lang="jpn", builder=builder)
 
     return text
 
 
 def get_text_with_single_text_line_and_eng_from_image(image: Image):
     builder = pyocr.builders.TextBuilder(tesseract_layout=7)
-    text = tool.image_to_string(image, lang="eng", builder=builder)
+    text = image_to_string(image, lang="eng", builder=builder)
 
     return text
 
 
 def get_line_box_with_single_text_line_and_jpn_from_image(image: Image):
     builder = pyocr.builders.LineBoxBuilder(tesseract_layout=7)
-    text = tool.image_to_string(image, lang="jpn", builder=builder)
+    text = image_to_string(image, lang="jpn", builder=builder)
 
     return text
+
+
+def get_digit_word_boxes_with_single_text_line_and_eng_from_image(image: Image):
+    builder = pyocr.builders.DigitLineBoxBuilder(tesseract_layout=7)
+    line_boxes = image_to_string(image, lang="eng", builder=builder)
+
+    return [word_box for line_box in line_boxes for word_box in line_box.word_boxes]
+
+
+def get_digits_with_single_text_line_and_eng_from_images(images: [Image]) -> [DigitField]:
+    # 複数の数値画像を1枚に並べて1回のOCRで読み取り、単語の位置から元の画像へ振り分ける
+    gap = max(image.size[1] for image in images)
+    strip, spans = concat_horizontal(images, gap, background_level(images))
+
+    word_boxes = get_digit_word_boxes_with_single_text_line_and_eng_from_image(strip)
+
+    fields = []
+    for (start_x, end_x) in spans:
+        words = []
+        for word_box in word_boxes:
+            (s_x, _), (e_x, _) = word_box.position
+            center_x = (s_x + e_x) / 2
+            if start_x - gap / 2 <= center_x < end_x + gap / 2:
+                words.append(word_box)
+        words = sorted(words, key=lambda k: k.position[0][0])
+
+        text = ''.join(word_box.content for word_box in words)
+        confidence = min((word_box.confidence for word_box in words), default=0)
+        fields.append(DigitField(text, confidence))
+
+    return fields
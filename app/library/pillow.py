@@ -11,6 +11,20 @@ def crop_pil(image, box, *, debug=False):
     return cropped
 
 
+def crop_array(array: np.ndarray, box) -> np.ndarray:
+    # crop_pilと同じく座標を丸め、画像の外側は0で埋める
+    (sx, sy, ex, ey) = (int(round(v)) for v in box)
+    (h, w) = array.shape[:2]
+    if 0 <= sx <= ex <= w and 0 <= sy <= ey <= h:
+        return array[sy:ey, sx:ex]
+
+    cropped = np.zeros((max(ey - sy, 0), max(ex - sx, 0)) + array.shape[2:], dtype=array.dtype)
+    (csx, csy, cex, cey) = (max(sx, 0), max(sy, 0), min(ex, w), min(ey, h))
+    if csx < cex and csy < cey:
+        cropped[csy - sy:cey - sy, csx - sx:cex - sx] = array[csy:cey, csx:cex]
+    return cropped
+
+
 def resize_pil(image, width=None, height=None, inter=Image.BILINEAR):
     (w, h) = image.size
 
@@ -45,7 +59,46 @@ def pil2cv(image_pil):
     return image_cv
 
 
+def pil2gray(image):
+    if isinstance(image, np.ndarray) and image.ndim == 2:
+        return image
+
+    return cv2.cvtColor(pil2cv(image), cv2.COLOR_BGR2GRAY)
+
+
 def binarized(image: Image, threshold: int) -> Image:
     bin_img = image.convert("L")
     bin_img = bin_img.point(lambda x: 0 if x < threshold else 255)
     return bin_img
+
+
+def otsu_threshold(image: Image) -> int:
+    # 切り出した領域の濃淡分布から文字と背景を最もよく分けるしきい値を求める（大津の二値化）
+    # OpenCVはしきい値より大きい画素を白にするので、binarized() に渡せるよう1つ上げる
+    gray = np.asarray(image.convert('L'))
+    (threshold, _) = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    return int(threshold) + 1
+
+
+def concat_horizontal(images: [Image], gap: int, fill: int) -> (Image, list):
+    # 画像を間隔を空けて横一列に並べ、各画像が置かれたx座標の範囲も返す
+    width = sum(image.size[0] for image in images) + gap * (len(images) + 1)
+    height = max(image.size[1] for image in images)
+    strip = Image.new('L', (width, height), fill)
+
+    spans = []
+    x = gap
+    for image in images:
+        strip.paste(image.convert('L'), (x, 0))
+        spans.append((x, x + image.size[0]))
+        x += image.size[0] + gap
+
+    return strip, spans
+
+
+def background_level(images: [Image]) -> int:
+    histogram = np.zeros(256, dtype=np.int64)
+    for image in images:
+        histogram += np.array(image.convert('L').histogram(), dtype=np.int64)
+
+    return int(np.argmax(histogram))
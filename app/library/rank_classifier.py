@@ -0,0 +1,72 @@
+import threading
+from dataclasses import dataclass
+
+import cv2
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from app.library.template_registry import TemplateRegistry
+
+
+@dataclass(frozen=True)
+class RankClassification:
+    rank: str
+    confidence: float
+
+
+class RankClassifier:
+    # 同サイズのランクテンプレートを1つの行列に積み、全候補のTM_CCOEFF_NORMEDを1回の行列積で求める
+
+    def __init__(self, template_registry: TemplateRegistry, rank_templates: list):
+        self.template_registry = template_registry
+        self.templ_names = [templ_name for (templ_name, _) in rank_templates]
+        self.ranks = [rank for (_, rank) in rank_templates]
+        self.templ_shape = None
+        self.templ_matrix = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        if self.templ_matrix is not None:
+            return
+
+        with self.lock:
+            if self.templ_matrix is not None:
+                return
+
+            templs = np.stack([self.template_registry.get(templ_name, count=False)
+                               for templ_name in self.templ_names]).astype(np.float64)
+            (n, tH, tW) = templs.shape
+            templs = templs.reshape(n, tH * tW)
+            templs -= templs.mean(axis=1, keepdims=True)
+            templs /= np.maximum(np.linalg.norm(templs, axis=1, keepdims=True), 1e-6)
+
+            self.templ_shape = (tH, tW)
+            self.templ_matrix = np.ascontiguousarray(templs.T, dtype=np.float32)
+
+    def scores(self, image: np.ndarray) -> np.ndarray:
+        # 各テンプレートについて全位置中の最大相関値を返す
+        self.load()
+
+        (tH, tW) = self.templ_shape
+        if image.shape[0] < tH or image.shape[1] < tW:
+            return np.zeros(len(self.ranks))
+
+        # 分子はテンプレートを平均0にしているため窓の平均を引かずに行列積で求められる
+        windows = sliding_window_view(image.astype(np.float32), (tH, tW)).reshape(-1, tH * tW)
+        numerator = windows @ self.templ_matrix
+
+        # 分母の窓ごとの分散は積分画像から求める
+        (sums, sqsums) = cv2.integral2(image, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+        window_sums = sums[tH:, tW:] - sums[:-tH, tW:] - sums[tH:, :-tW] + sums[:-tH, :-tW]
+        window_sqsums = sqsums[tH:, tW:] - sqsums[:-tH, tW:] - sqsums[tH:, :-tW] + sqsums[:-tH, :-tW]
+        variances = window_sqsums - window_sums * window_sums / (tH * tW)
+        norms = np.sqrt(np.maximum(variances, 0)).reshape(-1, 1).astype(np.float32)
+        result = np.divide(numerator, norms, out=np.zeros_like(numerator), where=norms > 1e-3)
+
+        return result.max(axis=0)
+
+    def classify(self, image: np.ndarray) -> RankClassification:
+        scores = self.scores(image)
+        index = int(np.argmax(scores))
+
+        return RankClassification(self.ranks[index], float(scores[index]))
@@ -0,0 +1,160 @@
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from dataclasses import dataclass
+
+import cachetools
+from PIL import Image
+
+from app.library.executor import run_blocking
+
+
+@dataclass(frozen=True)
+class ResultCacheStats:
+    entries: int
+    hits: int
+    redis_hits: int
+    misses: int
+    shared: int
+    errors: int
+
+    def to_dict(self):
+        return {
+            'entries': self.entries,
+            'hits': self.hits,
+            'redis_hits': self.redis_hits,
+            'misses': self.misses,
+            'shared': self.shared,
+            'errors': self.errors,
+        }
+
+
+class ResultCache:
+    # 画像の画素とマスターデータのバージョンをキーにしたOCR結果のキャッシュ
+    # プロセス内のLRU（TTL付き）を1段目、設定されていればRedisをプロセス間で共有する2段目として使う
+
+    def __init__(self, *, maxsize: int, ttl: int, version: str, redis_client=None, prefix='umaocr', timer=time.monotonic):
+        self.ttl = ttl
+        self.version = version
+        self.redis_client = redis_client
+        self.prefix = prefix
+        self.memory = cachetools.TTLCache(maxsize=maxsize, ttl=ttl, timer=timer)
+        self.inflight = dict()
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def key(self, endpoint: str, digest: str) -> str:
+        return '{}:result:{}:{}:{}'.format(self.prefix, endpoint, self.version, digest)
+
+    def get(self, key: str) -> dict or None:
+        with self.lock:
+            value = self.memory.get(key)
+            if value is not None:
+                self.hits += 1
+                return value
+
+        if self.redis_client is not None:
+            try:
+                data = self.redis_client.get(key)
+            except Exception:
+                # Redisに繋がらなくてもOCRはできるので、キャッシュなしとして扱う
+                data = None
+                with self.lock:
+                    self.errors += 1
+
+            if data is not None:
+                value = json.loads(data)
+                with self.lock:
+                    self.memory[key] = value
+                    self.redis_hits += 1
+                return value
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def set(self, key: str, value: dict):
+        with self.lock:
+            self.memory[key] = value
+
+        if self.redis_client is not None:
+            try:
+                self.redis_client.set(key, json.dumps(value), ex=self.ttl)
+            except Exception:
+                with self.lock:
+                    self.errors += 1
+
+    async def get_or_create(self, endpoint: str, image: Image, create) -> dict:
+        key = self.key(endpoint, await run_blocking(image_digest, image))
+        value = await run_blocking(self.get, key)
+        if value is not None:
+            return value
+
+        # 同じ画像が同時に送られてきた場合は、実行中の処理の結果を共有する
+        loop = asyncio.get_running_loop()
+        task = self.inflight.get(key)
+        if task is not None and task.get_loop() is loop:
+            with self.lock:
+                self.shared += 1
+            return await asyncio.shield(task)
+
+        task = loop.create_task(self.create(key, create))
+        self.inflight[key] = task
+        return await asyncio.shield(task)
+
+    async def create(self, key: str, create) -> dict:
+        try:
+            value = await create()
+            await run_blocking(self.set, key, value)
+            return value
+        finally:
+            if self.inflight.get(key) is asyncio.current_task():
+                del self.inflight[key]
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+
+    def stats(self) -> ResultCacheStats:
+        with self.lock:
+            return ResultCacheStats(
+                len(self.memory),
+                self.hits,
+                self.redis_hits,
+                self.misses,
+                self.shared,
+                self.errors,
+            )
+
+
+def image_digest(image: Image) -> str:
+    # ファイルのバイト列ではなくデコードした画素から計算するので、再エンコードされた同じ画像も同じキーになる
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update('{}x{}'.format(*image.size).encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def file_digest(paths: [str]) -> str:
+    digest = hashlib.blake2b(digest_size=8)
+    for path in paths:
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def create_redis_client(url: str or None):
+    if not url:
+        return None
+
+    import redis
+    return redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
@@ -0,0 +1,300 @@
+import fcntl
+import json
+import os
+import threading
+from dataclasses import dataclass, replace
+from logging import getLogger
+
+import cachetools
+import cv2
+import numpy as np
+
+from app.library.matching_template import SEARCH_MODE_FULL, TemplateMatch, search_template
+from app.library.metrics import layout_prior_searches, stage, template_calibrations
+
+logger = getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class LayoutPrior:
+    # テンプレートが見つかるはずの範囲を画像の幅・高さに対する割合 (sx, sy, ex, ey) で表す
+    # 範囲内の一致度が border 未満なら画像全体を探索し直す
+    box: tuple
+    border: float = 0.7
+
+
+@dataclass(frozen=True)
+class TemplateLocatorStats:
+    enabled: bool
+    searches: int
+    prior_hits: int
+    prior_misses: int
+    full_searches: int
+
+    def to_dict(self):
+        return {
+            'enabled': self.enabled,
+            'searches': self.searches,
+            'prior_hits': self.prior_hits,
+            'prior_misses': self.prior_misses,
+            'full_searches': self.full_searches,
+            'prior_hit_rate': self.prior_hits / (self.prior_hits + self.prior_misses)
+            if self.prior_hits + self.prior_misses > 0 else 0.0,
+        }
+
+
+@dataclass(frozen=True)
+class Calibration:
+    # ある解像度の画像で前回テンプレートが見つかったスケールと位置
+    scale: float
+    start: tuple
+    end: tuple
+    score: float
+
+    def to_dict(self):
+        return {
+            'scale': self.scale,
+            'start': list(self.start),
+            'end': list(self.end),
+            'score': self.score,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Calibration':
+        return cls(data['scale'], tuple(data['start']), tuple(data['end']), data['score'])
+
+
+@dataclass(frozen=True)
+class CalibrationCacheStats:
+    entries: int
+    hits: int
+    misses: int
+    invalidations: int
+
+    def to_dict(self):
+        return {
+            'entries': self.entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+        }
+
+
+class CalibrationCache:
+    # 入力画像の解像度ごとに、テンプレートが見つかったスケールと位置を覚えておき、
+    # 次からはその周辺・前後のスケールだけを探索する。一致度が border 未満なら破棄して探索し直す
+
+    def __init__(self, *, path=None, maxsize=256, border=0.8, margin=16):
+        self.path = path
+        self.border = border
+        self.margin = margin
+        self.entries = cachetools.LRUCache(maxsize=maxsize)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.removed = set()
+        self.lock = threading.Lock()
+
+    def load(self):
+        if self.path is None:
+            return
+
+        data = read_calibrations(self.path)
+        with self.lock:
+            for (key, value) in data.items():
+                self.entries[key] = Calibration.from_dict(value)
+
+    def save(self):
+        # preforkの子プロセスなど複数のプロセスが同じファイルに書くので、ロックを取ってファイルの内容とマージする
+        # このプロセスで破棄したものはファイルからも除き、それ以外で他のプロセスが見つけたものは残す
+        if self.path is None:
+            return
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            data = read_calibrations(self.path)
+            with self.lock:
+                for key in self.removed:
+                    data.pop(key, None)
+                self.removed.clear()
+                merged = {key: calibration.to_dict() for (key, calibration) in self.entries.items()}
+            for (key, value) in data.items():
+                if len(merged) >= self.entries.maxsize:
+                    break
+                merged.setdefault(key, value)
+
+            # 書き込み途中のファイルを読まないよう、別名で書いてから置き換える
+            tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(merged, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+
+    def search(self, name: str, size: (int, int), image: np.ndarray, templ: np.ndarray, linspace,
+               *, method=cv2.TM_CCOEFF_NORMED) -> TemplateMatch or None:
+        key = calibration_key(name, size)
+        with self.lock:
+            calibration = self.entries.get(key)
+            if calibration is None:
+                self.misses += 1
+                return None
+
+        with stage('template.calibrated', template=name):
+            match = search_calibrated(image, templ, linspace, calibration, margin=self.margin, method=method)
+
+        if match is None or match.score < self.border:
+            template_calibrations.labels(name, 'invalidated').inc()
+            with self.lock:
+                self.entries.pop(key, None)
+                self.removed.add(key)
+                self.invalidations += 1
+            self.save()
+            return None
+
+        template_calibrations.labels(name, 'hit').inc()
+        with self.lock:
+            self.hits += 1
+        return match
+
+    def put(self, name: str, size: (int, int), match: TemplateMatch):
+        if match.score < self.border:
+            return
+
+        with self.lock:
+            self.removed.discard(calibration_key(name, size))
+            self.entries[calibration_key(name, size)] = Calibration(
+                1 / match.ratio, tuple(match.start), tuple(match.end), float(match.score))
+        self.save()
+
+    def stats(self) -> CalibrationCacheStats:
+        with self.lock:
+            return CalibrationCacheStats(len(self.entries), self.hits, self.misses, self.invalidations)
+
+
+class TemplateLocator:
+    # 画面のレイアウトから位置の見当がつくテンプレートは、その範囲だけを先に探索する
+    # calibrationがあれば、同じ解像度の画像で前回見つかった位置とスケールをさらに先に試す
+
+    def __init__(self, priors: {str: LayoutPrior}, *, enabled=False, calibration: CalibrationCache = None):
+        self.priors = dict(priors)
+        self.enabled = enabled
+        self.calibration = calibration
+        self.searches = 0
+        self.prior_hits = 0
+        self.prior_misses = 0
+        self.full_searches = 0
+        self.lock = threading.Lock()
+
+    def configure(self, *, enabled: bool, boxes: {str: list} = None, calibration: CalibrationCache = None):
+        # boxes で一部のテンプレートの範囲だけを上書きできる
+        self.enabled = enabled
+        self.calibration = calibration
+        for (name, box) in (boxes or {}).items():
+            prior = self.priors.get(name)
+            self.priors[name] = LayoutPrior(tuple(box)) if prior is None else replace(prior, box=tuple(box))
+
+    def search(self, name: str or None, image: np.ndarray, templ: np.ndarray, linspace,
+               *, size: (int, int) = None, method=cv2.TM_CCOEFF_NORMED, mode=SEARCH_MODE_FULL) -> TemplateMatch or None:
+        # sizeは入力画像の元の解像度
+        with self.lock:
+            self.searches += 1
+
+        calibration = self.calibration if name is not None and size is not None else None
+        if calibration is not None:
+            match = calibration.search(name, size, image, templ, linspace, method=method)
+            if match is not None:
+                return match
+
+        match = self.search_uncalibrated(name, image, templ, linspace, method=method, mode=mode)
+        if calibration is not None and match is not None:
+            calibration.put(name, size, match)
+        return match
+
+    def search_uncalibrated(self, name: str or None, image: np.ndarray, templ: np.ndarray, linspace,
+                            *, method=cv2.TM_CCOEFF_NORMED, mode=SEARCH_MODE_FULL) -> TemplateMatch or None:
+        prior = self.priors.get(name) if self.enabled and name is not None else None
+        if prior is not None:
+            with stage('template.layout_prior', template=name):
+                match = search_prior(image, templ, linspace, prior, method=method, mode=mode)
+            hit = match is not None and match.score >= prior.border
+            layout_prior_searches.labels(name, 'hit' if hit else 'miss').inc()
+            with self.lock:
+                if hit:
+                    self.prior_hits += 1
+                else:
+                    self.prior_misses += 1
+            if hit:
+                return match
+
+        with self.lock:
+            self.full_searches += 1
+        return search_template(image, templ, linspace, method=method, mode=mode)
+
+    def stats(self) -> TemplateLocatorStats:
+        with self.lock:
+            return TemplateLocatorStats(
+                self.enabled,
+                self.searches,
+                self.prior_hits,
+                self.prior_misses,
+                self.full_searches,
+            )
+
+
+def calibration_key(name: str, size: (int, int)) -> str:
+    return '{}:{}x{}'.format(name, size[0], size[1])
+
+
+def read_calibrations(path: str) -> dict:
+    # ファイルがなければ空、壊れていれば警告して空として扱う
+    try:
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return dict()
+    except (OSError, ValueError) as e:
+        logger.warning('failed to read template calibrations from %s: %s', path, e)
+        return dict()
+    return data if isinstance(data, dict) else dict()
+
+
+def search_calibrated(image: np.ndarray, templ: np.ndarray, linspace, calibration: Calibration,
+                      *, margin: int, method=cv2.TM_CCOEFF_NORMED) -> TemplateMatch or None:
+    # 前回のスケールの前後半ステップだけを、前回の位置の周辺で探索する
+    step = (linspace.max() - linspace.min()) / max(len(linspace) - 1, 1)
+    scales = np.unique(np.clip(np.linspace(calibration.scale - step / 2, calibration.scale + step / 2, 3),
+                               linspace.min(), linspace.max()))
+
+    # スケールが変わった分だけテンプレートの大きさも変わるので、その分も余白に含める
+    (sx, sy) = calibration.start
+    (ex, ey) = calibration.end
+    pad_x = margin + int(np.ceil((ex - sx) * step / 2))
+    pad_y = margin + int(np.ceil((ey - sy) * step / 2))
+    (h, w) = image.shape[:2]
+    (roi_sx, roi_sy, roi_ex, roi_ey) = (max(sx - pad_x, 0), max(sy - pad_y, 0), min(ex + pad_x, w), min(ey + pad_y, h))
+    if roi_sx >= roi_ex or roi_sy >= roi_ey:
+        return None
+
+    match = search_template(image[roi_sy:roi_ey, roi_sx:roi_ex], templ, scales, method=method)
+    if match is None:
+        return None
+
+    return replace(match, start=(match.start[0] + roi_sx, match.start[1] + roi_sy),
+                   end=(match.end[0] + roi_sx, match.end[1] + roi_sy))
+
+
+def search_prior(image: np.ndarray, templ: np.ndarray, linspace, prior: LayoutPrior,
+                 *, method=cv2.TM_CCOEFF_NORMED, mode=SEARCH_MODE_FULL) -> TemplateMatch or None:
+    (h, w) = image.shape[:2]
+    (sx, sy, ex, ey) = prior.box
+    (sx, sy, ex, ey) = (int(w * sx), int(h * sy), int(np.ceil(w * ex)), int(np.ceil(h * ey)))
+    roi = image[max(sy, 0):min(ey, h), max(sx, 0):min(ex, w)]
+    if roi.shape[0] == 0 or roi.shape[1] == 0:
+        return None
+
+    match = search_template(roi, templ, linspace, method=method, mode=mode)
+    if match is None:
+        return None
+
+    (ox, oy) = (max(sx, 0), max(sy, 0))
+    return replace(match, start=(match.start[0] + ox, match.start[1] + oy), end=(match.end[0] + ox, match.end[1] + oy))
@@ -0,0 +1,82 @@
+import threading
+from dataclasses import dataclass
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from app.library.pillow import pil2cv, resize_pil
+
+
+@dataclass(frozen=True)
+class TemplateSpec:
+    name: str
+    path: str
+    width: int = None
+
+
+@dataclass(frozen=True)
+class TemplateRegistryStats:
+    templates: int
+    hits: int
+    misses: int
+    nbytes: int
+
+    def to_dict(self):
+        return {
+            'templates': self.templates,
+            'hits': self.hits,
+            'misses': self.misses,
+            'nbytes': self.nbytes,
+        }
+
+
+class TemplateRegistry:
+    # テンプレート画像はプロセス内で一度だけ読み込み、読み取り専用のグレースケール配列としてスレッド間で共有する
+
+    def __init__(self, specs: [TemplateSpec]):
+        self.specs = {spec.name: spec for spec in specs}
+        self.templates = dict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def load(self):
+        for name in self.specs:
+            self.get(name, count=False)
+
+    def get(self, name: str, *, count=True) -> np.ndarray:
+        templ = self.templates.get(name)
+        if templ is not None:
+            if count:
+                with self.lock:
+                    self.hits += 1
+            return templ
+
+        with self.lock:
+            templ = self.templates.get(name)
+            if templ is None:
+                templ = load_template(self.specs[name])
+                self.templates[name] = templ
+            if count:
+                self.misses += 1
+
+        return templ
+
+    def stats(self) -> TemplateRegistryStats:
+        with self.lock:
+            return TemplateRegistryStats(
+                len(self.templates),
+                self.hits,
+                self.misses,
+                sum(templ.nbytes for templ in self.templates.values()),
+            )
+
+
+def load_template(spec: TemplateSpec) -> np.ndarray:
+    with Image.open(spec.path) as image:
+        image = resize_pil(image, spec.width)
+        templ = cv2.cvtColor(pil2cv(image), cv2.COLOR_BGR2GRAY)
+
+    templ.setflags(write=False)
+    return templ
@@ -0,0 +1,200 @@
+import ctypes
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from os import devnull
+
+from PIL import Image
+from pyocr.error import TesseractError
+from pyocr.libtesseract import tesseract_raw
+
+
+@dataclass(frozen=True)
+class EngineKey:
+    lang: str
+    layout: int
+    digits: bool
+
+
+@dataclass(frozen=True)
+class TesseractEnginePoolStats:
+    engines: int
+    idle: int
+    created: int
+    evicted: int
+
+    def to_dict(self):
+        return {
+            'engines': self.engines,
+            'idle': self.idle,
+            'created': self.created,
+            'evicted': self.evicted,
+        }
+
+
+class TesseractEnginePool:
+    # 言語・ページ分割モードごとに初期化済みのTessBaseAPIを保持し、プロセス起動と学習データの読み込みを省く
+
+    def __init__(self, max_engines: int):
+        self.max_engines = max_engines
+        self.idle = dict()
+        self.engines = 0
+        self.created = 0
+        self.evicted = 0
+        self.condition = threading.Condition()
+
+    def image_to_string(self, image: Image, lang: str, builder):
+        key = EngineKey(lang, builder.tesseract_layout, 'digits' in builder.tesseract_configs)
+        with self.engine(key) as handle:
+            return recognize(handle, image, builder)
+
+    def warm_up(self, keys: [EngineKey]):
+        for key in keys:
+            with self.engine(key):
+                pass
+
+    @contextmanager
+    def engine(self, key: EngineKey):
+        handle = self.acquire(key)
+        try:
+            yield handle
+        except BaseException:
+            # 認識途中で失敗したエンジンは状態が不明なので再利用しない
+            self.discard(handle)
+            raise
+
+        try:
+            # 前の画像の認識結果と適応分類器の学習内容が次の画像に影響しないよう消しておく
+            clear_engine(handle)
+        except BaseException:
+            self.discard(handle)
+            raise
+        self.release(key, handle)
+
+    def acquire(self, key: EngineKey):
+        evicted = None
+        with self.condition:
+            while True:
+                handles = self.idle.get(key)
+                if handles:
+                    return handles.pop()
+                if self.engines < self.max_engines:
+                    self.engines += 1
+                    break
+                evicted = self.pop_idle_handle()
+                if evicted is not None:
+                    self.evicted += 1
+                    break
+                self.condition.wait()
+
+        if evicted is not None:
+            tesseract_raw.cleanup(evicted)
+
+        try:
+            handle = init_engine(key)
+        except BaseException:
+            with self.condition:
+                self.engines -= 1
+                self.condition.notify()
+            raise
+
+        with self.condition:
+            self.created += 1
+
+        return handle
+
+    def release(self, key: EngineKey, handle):
+        with self.condition:
+            self.idle.setdefault(key, []).append(handle)
+            self.condition.notify()
+
+    def discard(self, handle):
+        tesseract_raw.cleanup(handle)
+        with self.condition:
+            self.engines -= 1
+            self.condition.notify()
+
+    def pop_idle_handle(self):
+        for handles in self.idle.values():
+            if handles:
+                return handles.pop(0)
+        return None
+
+    def close(self):
+        with self.condition:
+            handles = [handle for handles in self.idle.values() for handle in handles]
+            self.engines -= len(handles)
+            self.idle = dict()
+
+        for handle in handles:
+            tesseract_raw.cleanup(handle)
+
+    def stats(self) -> TesseractEnginePoolStats:
+        with self.condition:
+            return TesseractEnginePoolStats(
+                self.engines,
+                sum(len(handles) for handles in self.idle.values()),
+                self.created,
+                self.evicted,
+            )
+
+
+def init_engine(key: EngineKey):
+    handle = tesseract_raw.init(lang=key.lang)
+    try:
+        for lang_item in (key.lang or 'eng').split('+'):
+            if lang_item not in tesseract_raw.get_available_languages(handle):
+                raise TesseractError('no lang', 'language {} is not available'.format(lang_item))
+
+        tesseract_raw.set_page_seg_mode(handle, key.layout)
+        tesseract_raw.set_debug_file(handle, devnull)
+        tesseract_raw.set_is_numeric(handle, key.digits)
+    except BaseException:
+        tesseract_raw.cleanup(handle)
+        raise
+
+    return handle
+
+
+def clear_engine(handle):
+    # pyocrのtesseract_rawにはClearのラッパーがないので、読み込み済みのlibtesseractを直接呼ぶ
+    libtesseract = tesseract_raw.g_libtesseract
+    libtesseract.TessBaseAPIClear(ctypes.c_void_p(handle))
+    libtesseract.TessBaseAPIClearAdaptiveClassifier(ctypes.c_void_p(handle))
+
+
+def recognize(handle, image: Image, builder):
+    # pyocr.libtesseract.image_to_string と同じ手順で、初期化済みのhandleを使い回す
+    lvl_line = tesseract_raw.PageIteratorLevel.TEXTLINE
+    lvl_word = tesseract_raw.PageIteratorLevel.WORD
+
+    tesseract_raw.set_image(handle, image)
+    tesseract_raw.recognize(handle)
+    res_iterator = tesseract_raw.get_iterator(handle)
+    if res_iterator is None:
+        # pyocr.libtesseract は TesseractError('no script') を送出するが、これまで使っていたtesseractのCLIと
+        # 同じく、文字が検出できなければ空の結果を返す（呼び出し側は空の結果を読み取り失敗として扱う）
+        return builder.get_output()
+    page_iterator = tesseract_raw.result_iterator_get_page_iterator(res_iterator)
+
+    while True:
+        if tesseract_raw.page_iterator_is_at_beginning_of(page_iterator, lvl_line):
+            (_, box) = tesseract_raw.page_iterator_bounding_box(page_iterator, lvl_line)
+            builder.start_line(((box[0], box[1]), (box[2], box[3])))
+
+        last_word_in_line = tesseract_raw.page_iterator_is_at_final_element(page_iterator, lvl_line, lvl_word)
+
+        word = tesseract_raw.result_iterator_get_utf8_text(res_iterator, lvl_word)
+        confidence = tesseract_raw.result_iterator_get_confidence(res_iterator, lvl_word)
+
+        if word is not None and confidence is not None and word != '':
+            (_, box) = tesseract_raw.page_iterator_bounding_box(page_iterator, lvl_word)
+            builder.add_word(word, ((box[0], box[1]), (box[2], box[3])), confidence)
+
+            if last_word_in_line:
+                builder.end_line()
+
+        if not tesseract_raw.page_iterator_next(page_iterator, lvl_word):
+            break
+
+    return builder.get_output()
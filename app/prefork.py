@@ -0,0 +1,215 @@
+import asyncio
+import logging
+import os
+import signal
+import socket
+import time
+
+from aiohttp import web
+
+import settings
+from app import create_api_resource
+from app.aio import create_aio_app, load_config
+from app.library.executor import event_loop, worker_pool
+from app.library.metrics import multiprocess_dir
+
+logger = logging.getLogger(__name__)
+
+# 起動してからこの秒数より早く落ちた子プロセスは、起動し直すまでの待ち時間を倍にしていく
+MIN_UPTIME = 10.0
+RESTART_DELAY = 0.5
+MAX_RESTART_DELAY = 30.0
+
+
+class PreforkServer:
+    # 親プロセスでマスターデータ・テンプレート・OCRエンジンを読み込んでから子プロセスをforkし、
+    # 読み込み済みのメモリをコピーオンライトで共有する。子プロセスは同じソケットで受け付ける
+    # SIGHUPで読み込み直してから子プロセスを入れ替え、SIGTERM・SIGINTで処理中のリクエストを待って終了する
+
+    def __init__(self, *, host: str, port: int, workers: int, shutdown_timeout: int):
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.shutdown_timeout = shutdown_timeout
+        self.api_resource = None
+        self.sock = None
+        self.children = dict()
+        self.generation = 0
+        self.failures = 0
+        self.pending = []
+        self.reloading = False
+        self.stopping = False
+
+    def warm_up(self):
+        self.api_resource = create_api_resource(load_config(), logger)
+        # forkで引き継がれない親のスレッドは、読み込みが終わったら止めておく
+        event_loop.close()
+        worker_pool.shutdown()
+
+    def run(self):
+        prepare_metrics_dir()
+        self.warm_up()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.host, self.port))
+        self.sock.listen(socket.SOMAXCONN)
+
+        signal.signal(signal.SIGHUP, self.on_reload)
+        signal.signal(signal.SIGTERM, self.on_stop)
+        signal.signal(signal.SIGINT, self.on_stop)
+
+        logger.info('listening on %s:%d with %d workers', self.host, self.port, self.workers)
+        for _ in range(self.workers):
+            self.spawn()
+
+        while not self.stopping:
+            if self.reloading:
+                self.reload()
+            self.reap()
+            self.spawn_pending()
+            time.sleep(0.5)
+
+        self.stop()
+
+    def on_reload(self, *_):
+        self.reloading = True
+
+    def on_stop(self, *_):
+        self.stopping = True
+
+    def spawn(self):
+        pid = os.fork()
+        if pid != 0:
+            self.children[pid] = (self.generation, time.monotonic())
+            return
+
+        status = 0
+        try:
+            self.serve()
+        except BaseException:
+            logger.exception('worker failed')
+            status = 1
+        finally:
+            os._exit(status)
+
+    def serve(self):
+        # SIGTERM・SIGINTはaiohttpが受け取り、処理中のリクエストを待ってから終了する
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        web.run_app(create_aio_app(self.api_resource), sock=self.sock, shutdown_timeout=self.shutdown_timeout,
+                    print=None)
+
+    def reap(self):
+        while True:
+            try:
+                (pid, status) = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            mark_process_dead(pid)
+
+            (generation, started_at) = self.children.pop(pid, (None, None))
+            # 入れ替え対象ではない子プロセスが落ちた場合は起動し直す。起動直後に落ち続ける場合は間隔を空ける
+            if generation == self.generation and not self.stopping:
+                if time.monotonic() - started_at < MIN_UPTIME:
+                    self.failures += 1
+                else:
+                    self.failures = 0
+                delay = restart_delay(self.failures)
+                logger.warning('worker %d exited with status %d, restarting in %.1f seconds', pid, status, delay)
+                self.pending.append(time.monotonic() + delay)
+
+    def spawn_pending(self):
+        now = time.monotonic()
+        due = [t for t in self.pending if t <= now]
+        self.pending = [t for t in self.pending if t > now]
+        for _ in due:
+            self.spawn()
+
+    def reload(self):
+        self.reloading = False
+        logger.info('reloading')
+        try:
+            self.warm_up()
+        except Exception:
+            logger.exception('failed to reload, keeping the current workers')
+            return
+
+        # 新しい子プロセスを起動してから古い子プロセスを止める。その間の接続はソケットの待ち行列で待つ
+        old_children = list(self.children)
+        self.generation += 1
+        self.failures = 0
+        self.pending = []
+        for _ in range(self.workers):
+            self.spawn()
+        for pid in old_children:
+            kill(pid, signal.SIGTERM)
+
+    def stop(self):
+        logger.info('stopping')
+        for pid in self.children:
+            kill(pid, signal.SIGTERM)
+
+        deadline = time.monotonic() + self.shutdown_timeout
+        while len(self.children) > 0 and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+
+        for pid in self.children:
+            kill(pid, signal.SIGKILL)
+        self.sock.close()
+
+
+def prepare_metrics_dir():
+    # prometheus_clientはimport時に環境変数を読むので、PROMETHEUS_MULTIPROC_DIRは起動前に設定しておく
+    # 前回の起動で残った子プロセスの値を合算しないよう、起動時に空にする
+    directory = multiprocess_dir()
+    if not directory:
+        logger.warning('PROMETHEUS_MULTIPROC_DIR is not set; /metrics only reports the worker that serves it')
+        return
+
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        if name.endswith('.db'):
+            os.remove(os.path.join(directory, name))
+
+
+def mark_process_dead(pid: int):
+    directory = multiprocess_dir()
+    if directory:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(pid, directory)
+
+
+def restart_delay(failures: int) -> float:
+    if failures == 0:
+        return 0.0
+    return min(RESTART_DELAY * 2 ** (failures - 1), MAX_RESTART_DELAY)
+
+
+def kill(pid: int, signum: int):
+    try:
+        os.kill(pid, signum)
+    except ProcessLookupError:
+        pass
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='[%(process)d] %(levelname)s:%(name)s:%(message)s')
+    if settings.SERVER_WORKERS > 1 and not settings.JOB_QUEUE_REDIS_URL:
+        # メモリ上の待ち行列は子プロセスごとに別なので、投入したのと別の子プロセスに問い合わせると見つからない
+        logger.warning('SERVER_WORKERS is %d but JOB_QUEUE_REDIS_URL is not set; '
+                       'jobs can only be polled from the worker that accepted them', settings.SERVER_WORKERS)
+    PreforkServer(
+        host=settings.HOST,
+        port=settings.PORT,
+        workers=settings.SERVER_WORKERS,
+        shutdown_timeout=settings.SERVER_SHUTDOWN_TIMEOUT,
+    ).run()
+
+
+if __name__ == '__main__':
+    main()
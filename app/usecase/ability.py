@@ -1,18 +1,18 @@
 import os
 from logging import Logger
 
-import cv2
 import numpy as np
 from PIL import Image
 
-import resources
 from app.domain.ability import (DistanceAbilities, FieldAbilities,
                                 StrategiesAbilities)
 from app.interface.driver.file_driver import LocalFileDriver
 from app.interface.usecase.appropriate import AppropriateUsecase
-from app.library.matching_template import matching_template
-from app.library.pillow import crop_pil, pil2cv, resize_pil
+from app.library.executor import run_blocking
+from app.library.metrics import timed
+from app.library.pillow import pil2gray
 from app.usecase.const import INPUT_IMAGE_WIDTH
+from app.usecase.templates import ability_rank_classifier
 from app.domain.image import CharacterDetailImage
 
 
@@ -30,6 +30,7 @@ class AbilityInteractor(AppropriateUsecase):
         self.debug = debug
         self.cache_master_characters = None
 
+    @timed('ability.get_character_appropriate_fields_from_image')
     async def get_character_appropriate_fields_from_image(self, character_detail_image: CharacterDetailImage) -> FieldAbilities:
         if character_detail_image.params_frame_loc is None:
             self.logger.debug('not found params_frame_loc')
@@ -40,33 +41,32 @@ class AbilityInteractor(AppropriateUsecase):
         abilities = dict()
 
         # ocr seed ability
-        cropped_ability_turf = crop_pil(character_detail_image.image,
-                                        (start_x + (st_x * 0.315),
-                                         end_y + (st_y * 2.8),
-                                         start_x + (st_x * 0.37),
-                                         end_y + (st_y * 4.2)))
-        ability_turf = await self.get_ability_rank_from_image(cropped_ability_turf)
+        cropped_ability_turf = character_detail_image.context.crop((start_x + (st_x * 0.315),
+                                                                    end_y + (st_y * 2.8),
+                                                                    start_x + (st_x * 0.37),
+                                                                    end_y + (st_y * 4.2)))
+        ability_turf = await self.get_ability_rank_from_image(cropped_ability_turf.gray)
         if self.debug:
             await self.local_file_driver.save_image(
-                cropped_ability_turf,
+                cropped_ability_turf.image,
                 os.path.join('tmp', 'get_character_appropriate_fields_from_image', 'cropped_ability_turf.png')
             )
 
         # ダート
-        cropped_ability_dirt = crop_pil(character_detail_image.image,
-                                        (start_x + (st_x * 0.515),
-                                         end_y + (st_y * 2.8),
-                                         start_x + (st_x * 0.57),
-                                         end_y + (st_y * 4.2)))
-        ability_dirt = await self.get_ability_rank_from_image(cropped_ability_dirt)
+        cropped_ability_dirt = character_detail_image.context.crop((start_x + (st_x * 0.515),
+                                                                    end_y + (st_y * 2.8),
+                                                                    start_x + (st_x * 0.57),
+                                                                    end_y + (st_y * 4.2)))
+        ability_dirt = await self.get_ability_rank_from_image(cropped_ability_dirt.gray)
         if self.debug:
             await self.local_file_driver.save_image(
-                cropped_ability_dirt,
+                cropped_ability_dirt.image,
                 os.path.join('tmp', 'get_character_appropriate_fields_from_image', 'cropped_ability_dirt.png')
             )
 
         return FieldAbilities(ability_turf, ability_dirt)
 
+    @timed('ability.get_character_appropriate_distances_from_image')
     async def get_character_appropriate_distances_from_image(self, character_detail_image: CharacterDetailImage) -> DistanceAbilities:
         if character_detail_image.params_frame_loc is None:
             self.logger.debug('not found params_frame_loc')
@@ -75,59 +75,56 @@ class AbilityInteractor(AppropriateUsecase):
         (st_x, st_y) = (end_x - start_x, end_y - start_y)
 
         # 短距離
-        cropped_ability_short = crop_pil(character_detail_image.image,
-                                         (start_x + (st_x * 0.315),
-                                          end_y + (st_y * 4.35),
-                                          start_x + (st_x * 0.37),
-                                          end_y + (st_y * 5.75)))
-        ability_short = await self.get_ability_rank_from_image(cropped_ability_short)
+        cropped_ability_short = character_detail_image.context.crop((start_x + (st_x * 0.315),
+                                                                     end_y + (st_y * 4.35),
+                                                                     start_x + (st_x * 0.37),
+                                                                     end_y + (st_y * 5.75)))
+        ability_short = await self.get_ability_rank_from_image(cropped_ability_short.gray)
         if self.debug:
             await self.local_file_driver.save_image(
-                cropped_ability_short,
+                cropped_ability_short.image,
                 os.path.join('tmp', 'get_character_appropriate_distances_from_image', 'cropped_ability_short.png')
             )
 
         # マイル
-        cropped_ability_miles = crop_pil(character_detail_image.image,
-                                         (start_x + (st_x * 0.515),
-                                          end_y + (st_y * 4.35),
-                                          start_x + (st_x * 0.57),
-                                          end_y + (st_y * 5.75)))
-        ability_miles = await self.get_ability_rank_from_image(cropped_ability_miles)
+        cropped_ability_miles = character_detail_image.context.crop((start_x + (st_x * 0.515),
+                                                                     end_y + (st_y * 4.35),
+                                                                     start_x + (st_x * 0.57),
+                                                                     end_y + (st_y * 5.75)))
+        ability_miles = await self.get_ability_rank_from_image(cropped_ability_miles.gray)
         if self.debug:
             await self.local_file_driver.save_image(
-                cropped_ability_miles,
+                cropped_ability_miles.image,
                 os.path.join('tmp', 'get_character_appropriate_distances_from_image', 'cropped_ability_mile.png')
             )
 
         # 中距離
-        cropped_ability_medium = crop_pil(character_detail_image.image,
-                                          (start_x + (st_x * 0.715),
-                                           end_y + (st_y * 4.35),
-                                           start_x + (st_x * 0.77),
-                                           end_y + (st_y * 5.75)))
-        ability_medium = await self.get_ability_rank_from_image(cropped_ability_medium)
+        cropped_ability_medium = character_detail_image.context.crop((start_x + (st_x * 0.715),
+                                                                      end_y + (st_y * 4.35),
+                                                                      start_x + (st_x * 0.77),
+                                                                      end_y + (st_y * 5.75)))
+        ability_medium = await self.get_ability_rank_from_image(cropped_ability_medium.gray)
         if self.debug:
             await self.local_file_driver.save_image(
-                cropped_ability_medium,
+                cropped_ability_medium.image,
                 os.path.join('tmp', 'get_character_appropriate_distances_from_image', 'cropped_ability_medium.png')
             )
 
         # 長距離
-        cropped_ability_long = crop_pil(character_detail_image.image,
-                                        (start_x + (st_x * 0.915),
-                                         end_y + (st_y * 4.35),
-                                         start_x + (st_x * 0.97),
-                                         end_y + (st_y * 5.75)))
-        ability_long = await self.get_ability_rank_from_image(cropped_ability_long)
+        cropped_ability_long = character_detail_image.context.crop((start_x + (st_x * 0.915),
+                                                                    end_y + (st_y * 4.35),
+                                                                    start_x + (st_x * 0.97),
+                                                                    end_y + (st_y * 5.75)))
+        ability_long = await self.get_ability_rank_from_image(cropped_ability_long.gray)
         if self.debug:
             await self.local_file_driver.save_image(
-                cropped_ability_long,
+                cropped_ability_long.image,
                 os.path.join('tmp', 'get_character_appropriate_distances_from_image', 'cropped_ability_long.png')
             )
 
         return DistanceAbilities(ability_short, ability_miles, ability_medium, ability_long)
 
+    @timed('ability.get_character_appropriate_strategies_from_image')
     async def get_character_appropriate_strategies_from_image(self, character_detail_image: CharacterDetailImage) -> StrategiesAbilities:
         if character_detail_image.params_frame_loc is None:
             self.logger.debug('not found params_frame_loc')
@@ -136,87 +133,63 @@ class AbilityInteractor(AppropriateUsecase):
         (st_x, st_y) = (end_x - start_x, end_y - start_y)
 
         # 逃げ
-        cropped_ability_first = crop_pil(character_detail_image.image,
-                                         (start_x + (st_x * 0.315),
-                                          end_y + (st_y * 5.9),
-                                          start_x + (st_x * 0.37),
-                                          end_y + (st_y * 7.3)))
-        ability_first = await self.get_ability_rank_from_image(cropped_ability_first)
+        cropped_ability_first = character_detail_image.context.crop((start_x + (st_x * 0.315),
+                                                                     end_y + (st_y * 5.9),
+                                                                     start_x + (st_x * 0.37),
+                                                                     end_y + (st_y * 7.3)))
+        ability_first = await self.get_ability_rank_from_image(cropped_ability_first.gray)
         if self.debug:
             await self.local_file_driver.save_image(
-                cropped_ability_first,
+                cropped_ability_first.image,
                 os.path.join('tmp', 'get_character_appropriate_strategies_from_image', 'cropped_ability_first.png')
             )
 
         # 先行
-        cropped_ability_half_first = crop_pil(character_detail_image.image,
-                                              (start_x + (st_x * 0.515),
-                                               end_y + (st_y * 5.9),
-                                               start_x + (st_x * 0.57),
-                                               end_y + (st_y * 7.3)))
-        ability_half_first = await self.get_ability_rank_from_image(cropped_ability_half_first)
+        cropped_ability_half_first = character_detail_image.context.crop((start_x + (st_x * 0.515),
+                                                                          end_y + (st_y * 5.9),
+                                                                          start_x + (st_x * 0.57),
+                                                                          end_y + (st_y * 7.3)))
+        ability_half_first = await self.get_ability_rank_from_image(cropped_ability_half_first.gray)
         if self.debug:
             await self.local_file_driver.save_image(
-                cropped_ability_half_first,
+                cropped_ability_half_first.image,
                 os.path.join('tmp', 'get_character_appropriate_strategies_from_image', 'cropped_ability_half_first.png')
             )
 
         # 差し
-        cropped_ability_half_last = crop_pil(character_detail_image.image,
-                                              (start_x + (st_x * 0.715),
-                                               end_y + (st_y * 5.9),
-                                               start_x + (st_x * 0.77),
-                                               end_y + (st_y * 7.3)))
-        ability_half_last = await self.get_ability_rank_from_image(cropped_ability_half_last)
+        cropped_ability_half_last = character_detail_image.context.crop((start_x + (st_x * 0.715),
+                                                                         end_y + (st_y * 5.9),
+                                                                         start_x + (st_x * 0.77),
+                                                                         end_y + (st_y * 7.3)))
+        ability_half_last = await self.get_ability_rank_from_image(cropped_ability_half_last.gray)
         if self.debug:
             await self.local_file_driver.save_image(
-                cropped_ability_half_last,
+                cropped_ability_half_last.image,
                 os.path.join('tmp', 'get_character_appropriate_strategies_from_image', 'cropped_ability_half_last.png')
             )
 
         # 追込
-        cropped_ability_last = crop_pil(character_detail_image.image,
-                                         (start_x + (st_x * 0.915),
-                                          end_y + (st_y * 5.9),
-                                          start_x + (st_x * 0.97),
-                                          end_y + (st_y * 7.3)))
-        ability_last = await self.get_ability_rank_from_image(cropped_ability_last)
+        cropped_ability_last = character_detail_image.context.crop((start_x + (st_x * 0.915),
+                                                                    end_y + (st_y * 5.9),
+                                                                    start_x + (st_x * 0.97),
+                                                                    end_y + (st_y * 7.3)))
+        ability_last = await self.get_ability_rank_from_image(cropped_ability_last.gray)
         if self.debug:
             await self.local_file_driver.save_image(
-                cropped_ability_last,
+                cropped_ability_last.image,
                 os.path.join('tmp', 'get_character_appropriate_strategies_from_image', 'cropped_ability_last.png')
             )
 
         return StrategiesAbilities(ability_first, ability_half_first, ability_half_last, ability_last)
 
-    async def get_ability_rank_from_image(self, image: Image) -> str or None:
+    async def get_ability_rank_from_image(self, image: Image or np.ndarray) -> str or None:
         border = 0.88
-        cv2_image = pil2cv(image)
-        cv2_image = cv2.cvtColor(cv2_image, cv2.COLOR_BGR2GRAY)
-
-        rank_files = [
-            ['s.png', 'S'],
-            ['a.png', 'A'],
-            ['b.png', 'B'],
-            ['c.png', 'C'],
-            ['d.png', 'D'],
-            ['e.png', 'E'],
-            ['f.png', 'F'],
-            ['g.png', 'G'],
-        ]
-
-        for (rank_file, rank) in rank_files:
-            templ_rank_file = await self.local_file_driver.open_image(
-                os.path.join(resources.__path__[0], 'template_matching', 'ability', rank_file)
-            )
-            templ_rank_file = resize_pil(templ_rank_file, 38)
-            cv2_templ_rank_file = pil2cv(templ_rank_file)
-            cv2_templ_rank_file = cv2.cvtColor(
-                cv2_templ_rank_file, cv2.COLOR_BGR2GRAY)
-            result = matching_template(cv2_image, cv2_templ_rank_file)
-            ys, _ = np.where(result >= border)
+        cv2_image = pil2gray(image)
 
-            if len(ys) > 0:
-                return rank
+        # 全ランクのテンプレートを一度に照合し、最も一致度の高いランクを採用する
+        classification = await run_blocking(ability_rank_classifier.classify, cv2_image)
+        self.logger.debug('ability rank: {}, confidence: {:.3f}'.format(classification.rank, classification.confidence))
+        if classification.confidence < border:
+            return None
 
-        return None
+        return classification.rank
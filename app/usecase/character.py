@@ -2,7 +2,6 @@ import json
 import os
 from logging import Logger
 
-import cv2
 import Levenshtein
 import numpy as np
 from PIL import Image
@@ -10,23 +9,28 @@ from PIL import Image
 import resources
 from app.interface.driver.file_driver import LocalFileDriver
 from app.interface.usecase.character import CharacterUsecase
-from app.library.matching_template import (matching_template, multi_scale_matching_template, multi_scale_matching_template_impl)
+from app.library.executor import run_blocking
+from app.library.matching_template import SEARCH_MODE_FULL, matching_template, multi_scale_matching_template
+from app.library.metrics import stage, timed
 from app.library.ocr import get_text_with_single_text_line_and_jpn_from_image
-from app.library.pillow import binarized, crop_pil, pil2cv, resize_pil
+from app.library.pillow import crop_pil, resize_pil
 from app.domain.character import Character
-from app.domain.image import CharacterDetailImage
+from app.domain.image import CharacterDetailImage, ImageContext
+from app.usecase.templates import CHARACTER_RANK_TEMPLATES, SUPPORT_PARAMS_TEMPLATE, template_locator, template_registry
 
 TEMPLATE_WIDTH = 1024
 
 
 class CharacterInteractor(CharacterUsecase):
 
-    def __init__(self, local_file_driver: LocalFileDriver, logger: Logger, *, debug=False):
+    def __init__(self, local_file_driver: LocalFileDriver, logger: Logger, *, debug=False, search_mode=SEARCH_MODE_FULL):
         self.local_file_driver = local_file_driver
         self.logger = logger
         self.pattern_digital = r'\D'
         self.debug = debug
+        self.search_mode = search_mode
         self.cache_master_characters = None
+        self.cache_master_all_characters = None
 
     async def get_master_characters(self):
         if self.cache_master_characters is not None:
@@ -40,21 +44,23 @@ class CharacterInteractor(CharacterUsecase):
         return master_characters_json or []
 
     async def get_master_all_characters(self):
-        if self.cache_master_characters is not None:
-            return self.cache_master_characters
+        if self.cache_master_all_characters is not None:
+            return self.cache_master_all_characters
 
         master_characters_json_file = await self.local_file_driver.open(
             os.path.join(resources.__path__[0], 'master_data', 'all_characters.json'))
         master_characters_json = json.load(master_characters_json_file)
 
-        self.cache_master_characters = master_characters_json
+        self.cache_master_all_characters = master_characters_json
         return master_characters_json or []
 
+    @timed('character.get_character_from_image')
     async def get_character_from_image(self, character_detail_image: CharacterDetailImage) -> Character:
         name = await self.get_character_name_from_image(character_detail_image)
         nickname = await self.get_character_nickname_from_image_and_name(character_detail_image, name)
         return Character(name, nickname)
 
+    @timed('character.get_character_nickname_from_image_and_name')
     async def get_character_nickname_from_image_and_name(self, character_detail_image: CharacterDetailImage, name: str) -> str:
         if character_detail_image.params_frame_loc is None:
             self.logger.debug('not found parameter_frame_loc')
@@ -62,16 +68,15 @@ class CharacterInteractor(CharacterUsecase):
         (start_x, start_y), (end_x, end_y) = character_detail_image.params_frame_loc
         (st_x, st_y) = (end_x - start_x, end_y - start_y)
 
-        cropped_character_nickname = crop_pil(character_detail_image.image,
-                                          (start_x + (st_x * 0.5),
-                                           start_y - (st_y * 6.5),
-                                           end_x - (st_x * 0.05),
-                                           start_y - (st_y * 5.25)))
-        binarized_character_nickname = binarized(cropped_character_nickname, 130)
-        text = get_text_with_single_text_line_and_jpn_from_image(binarized_character_nickname)
+        character_nickname_region = character_detail_image.context.crop((start_x + (st_x * 0.5),
+                                                                         start_y - (st_y * 6.5),
+                                                                         end_x - (st_x * 0.05),
+                                                                         start_y - (st_y * 5.25)))
+        binarized_character_nickname = await run_blocking(character_nickname_region.binarized, 130)
+        text = await run_blocking(get_text_with_single_text_line_and_jpn_from_image, binarized_character_nickname)
         if self.debug:
             await self.local_file_driver.save_image(
-                cropped_character_nickname,
+                await run_blocking(lambda: character_nickname_region.image),
                 os.path.join('tmp', 'get_character_nickname_from_image_and_name', 'cropped_character_nickname.png')
             )
             await self.local_file_driver.save_image(
@@ -83,16 +88,18 @@ class CharacterInteractor(CharacterUsecase):
         found_str = ''
         found = 0
         border_found = 0.5
-        for master_character in master_characters:
-            if name == master_character['name']:
-                for character_nickname in master_character['nickname']:
-                    aro_dist = Levenshtein.jaro_winkler(text, character_nickname)
-                    if aro_dist > found and aro_dist > border_found:
-                        found_str = character_nickname
-                        found = aro_dist
+        with stage('match.character_nickname'):
+            for master_character in master_characters:
+                if name == master_character['name']:
+                    for character_nickname in master_character['nickname']:
+                        aro_dist = Levenshtein.jaro_winkler(text, character_nickname)
+                        if aro_dist > found and aro_dist > border_found:
+                            found_str = character_nickname
+                            found = aro_dist
 
         return found_str
 
+    @timed('character.get_character_name_from_image')
     async def get_character_name_from_image(self, character_detail_image: CharacterDetailImage) -> str:
         if character_detail_image.params_frame_loc is None:
             self.logger.debug('not found parameter_frame_loc')
@@ -100,18 +107,16 @@ class CharacterInteractor(CharacterUsecase):
         (start_x, start_y), (end_x, end_y) = character_detail_image.params_frame_loc
         (st_x, st_y) = (end_x - start_x, end_y - start_y)
 
-        cropped_character_name = crop_pil(character_detail_image.image,
-                                          (start_x + (st_x * 0.5),
-                                           start_y - (st_y * 5.25),
-                                              end_x - (st_x * 0.05),
-                                              start_y - (st_y * 4.15)))
-        binarized_character_name = binarized(
-            cropped_character_name, 150)
-        text = get_text_with_single_text_line_and_jpn_from_image(
-            binarized_character_name)
+        character_name_region = character_detail_image.context.crop((start_x + (st_x * 0.5),
+                                                                     start_y - (st_y * 5.25),
+                                                                     end_x - (st_x * 0.05),
+                                                                     start_y - (st_y * 4.15)))
+        binarized_character_name = await run_blocking(character_name_region.binarized, 150)
+        text = await run_blocking(get_text_with_single_text_line_and_jpn_from_image, binarized_character_name)
         if self.debug:
             await self.local_file_driver.save_image(
-                cropped_character_name, os.path.join('tmp', 'get_character_name_from_image', 'cropped_character_name.png')
+                await run_blocking(lambda: character_name_region.image),
+                os.path.join('tmp', 'get_character_name_from_image', 'cropped_character_name.png')
             )
             await self.local_file_driver.save_image(
                 binarized_character_name, os.path.join('tmp', 'get_character_name_from_image', 'binarized_character_name.png')
@@ -121,15 +126,17 @@ class CharacterInteractor(CharacterUsecase):
         master_characters = await self.get_master_characters()
         found_str = ''
         found = 0
-        for master_character in master_characters:
-            character_name = master_character['name']
-            aro_dist = Levenshtein.jaro_winkler(text, character_name)
-            if aro_dist > found:
-                found_str = character_name
-                found = aro_dist
+        with stage('match.character_name'):
+            for master_character in master_characters:
+                character_name = master_character['name']
+                aro_dist = Levenshtein.jaro_winkler(text, character_name)
+                if aro_dist > found:
+                    found_str = character_name
+                    found = aro_dist
 
         return found_str
 
+    @timed('character.get_character_rank_from_image')
     async def get_character_rank_from_image(self, character_detail_image: CharacterDetailImage) -> str:
         if character_detail_image.params_frame_loc is None:
             self.logger.debug('not found parameter_frame_loc')
@@ -137,72 +144,36 @@ class CharacterInteractor(CharacterUsecase):
         (start_x, start_y), (end_x, end_y) = character_detail_image.params_frame_loc
         (st_x, st_y) = (end_x - start_x, end_y - start_y)
 
-        cropped_character_rank = crop_pil(character_detail_image.image,
-                                          (start_x + (st_x * 0.325),
-                                           start_y - (st_y * 7),
-                                              end_x - (st_x * 0.515),
-                                              start_y - (st_y * 3.4)))
+        character_rank_region = character_detail_image.context.crop((start_x + (st_x * 0.325),
+                                                                     start_y - (st_y * 7),
+                                                                     end_x - (st_x * 0.515),
+                                                                     start_y - (st_y * 3.4)))
         if self.debug:
             await self.local_file_driver.save_image(
-                cropped_character_rank,
+                character_rank_region.image,
                 os.path.join('tmp', 'get_character_rank_from_image', 'cropped_character_rank.png')
             )
 
         # 要調整
         border = 0.8
-        cv2_image = pil2cv(cropped_character_rank)
-        cv2_image = cv2.cvtColor(cv2_image, cv2.COLOR_BGR2GRAY)
-
-        rank_files = [
-            ['s_plus.png', 'S+'],
-            ['s.png', 'S'],
-            ['a_plus.png', 'A+'],
-            ['a.png', 'A'],
-            ['b_plus.png', 'B+'],
-            ['b.png', 'B'],
-            ['c_plus.png', 'C+'],
-            ['c.png', 'C'],
-            ['d_plus.png', 'D+'],
-            ['d.png', 'D'],
-            ['e_plus.png', 'E+'],
-            ['e.png', 'E'],
-            ['f_plus.png', 'F+'],
-            ['f.png', 'F'],
-            ['g_plus.png', 'G+'],
-        ]
-        for (rank_file, rank) in rank_files:
-            templ_rank_file = await self.local_file_driver.open_image(
-                os.path.join(resources.__path__[0], 'ranks', rank_file)
-            )
-            templ_rank_file = resize_pil(templ_rank_file, 120)
-            cv2_templ_rank_file = pil2cv(templ_rank_file)
-            cv2_templ_rank_file = cv2.cvtColor(
-                cv2_templ_rank_file, cv2.COLOR_BGR2GRAY)
-            result = matching_template(cv2_image, cv2_templ_rank_file)
-            ys, _ = np.where(result >= border)
-            if len(ys) > 0:
-                return rank
-
-        return ''
-
-    async def get_character_name_from_support_image(self, image: Image) -> str:
-        templ = await self.local_file_driver.open_image(
-            os.path.join(resources.__path__[0], 'images', 'support_params', 'template.png')
-        )
-        (tW, tH) = templ.size
-        cv2_templ = pil2cv(templ)
-
-        image = resize_pil(image, TEMPLATE_WIDTH)
-        cv2_image = pil2cv(image)
+        return await run_blocking(find_character_rank, character_rank_region.gray, border)
+
+    @timed('character.get_character_name_from_support_image')
+    async def get_character_name_from_support_image(self, image: Image or ImageContext) -> str:
+        cv2_templ = template_registry.get(SUPPORT_PARAMS_TEMPLATE)
+
+        context = ImageContext.of(image)
 
         # マルチスケールテンプレートマッチングでtemplateと一致する箇所の座標を抽出
-        loc = multi_scale_matching_template(cv2_image, cv2_templ, np.linspace(1.0, 1.5, 10))
+        loc = await run_blocking(
+            lambda: multi_scale_matching_template(context.gray, cv2_templ, np.linspace(1.0, 1.5, 10), mode=self.search_mode))
         if loc is None:
             return ''
         if self.debug:
             (start_x, start_y), (end_x, end_y) = loc
+            # 全体のリサイズはイベントループ上で行わない
             await self.local_file_driver.save_image(
-                crop_pil(image, (start_x, start_y, end_x, end_y)),
+                await run_blocking(lambda: crop_pil(context.image, (start_x, start_y, end_x, end_y))),
                 os.path.join('tmp', 'get_character_name_from_support_image', 'multi_scale_matching_template.png')
             )
 
@@ -212,11 +183,9 @@ class CharacterInteractor(CharacterUsecase):
         border_found = 0.8
 
         # for guest
-        cropped_character_name = crop_pil(image, (start_x + (st_x * 0.2), start_y - (st_y * 7), end_x - (st_x * 0.3), start_y - (st_y * 5.7)))
-        binarized_character_name = binarized(
-            cropped_character_name, 150)
-        text = get_text_with_single_text_line_and_jpn_from_image(
-            binarized_character_name)
+        binarized_character_name = await run_blocking(context.crop(
+            (start_x + (st_x * 0.2), start_y - (st_y * 7), end_x - (st_x * 0.3), start_y - (st_y * 5.7))).binarized, 150)
+        text = await run_blocking(get_text_with_single_text_line_and_jpn_from_image, binarized_character_name)
         if self.debug:
             await self.local_file_driver.save_image(
                 binarized_character_name,
@@ -227,21 +196,19 @@ class CharacterInteractor(CharacterUsecase):
         master_characters = await self.get_master_all_characters()
         found_str = ''
         found = 0
-        for master_character in master_characters:
-            character_name = master_character['name']
-            aro_dist = Levenshtein.jaro_winkler(text, character_name)
-            if aro_dist > found and aro_dist > border_found:
-                found_str = character_name
-                found = aro_dist
+        with stage('match.support_character_name', position='guest'):
+            for master_character in master_characters:
+                character_name = master_character['name']
+                aro_dist = Levenshtein.jaro_winkler(text, character_name)
+                if aro_dist > found and aro_dist > border_found:
+                    found_str = character_name
+                    found = aro_dist
 
         if found == 0:
             # for other
-            cropped_character_name = crop_pil(image, (
-            start_x + (st_x * 0.2), start_y - (st_y * 11.5), end_x - (st_x * 0.3), start_y - (st_y * 10.2)))
-            binarized_character_name = binarized(
-                cropped_character_name, 150)
-            text = get_text_with_single_text_line_and_jpn_from_image(
-                binarized_character_name)
+            binarized_character_name = await run_blocking(context.crop(
+                (start_x + (st_x * 0.2), start_y - (st_y * 11.5), end_x - (st_x * 0.3), start_y - (st_y * 10.2))).binarized, 150)
+            text = await run_blocking(get_text_with_single_text_line_and_jpn_from_image, binarized_character_name)
             if self.debug:
                 await self.local_file_driver.save_image(
                     binarized_character_name,
@@ -252,44 +219,37 @@ class CharacterInteractor(CharacterUsecase):
             master_characters = await self.get_master_all_characters()
             found_str = ''
             found = 0
-            for master_character in master_characters:
-                character_name = master_character['name']
-                aro_dist = Levenshtein.jaro_winkler(text, character_name)
-                if aro_dist > found and aro_dist > border_found:
-                    found_str = character_name
-                    found = aro_dist
+            with stage('match.support_character_name', position='other'):
+                for master_character in master_characters:
+                    character_name = master_character['name']
+                    aro_dist = Levenshtein.jaro_winkler(text, character_name)
+                    if aro_dist > found and aro_dist > border_found:
+                        found_str = character_name
+                        found = aro_dist
 
         return found_str
 
 
-async def get_matching_template_location(image: Image, templ: Image, *, linspace=np.linspace(1.1, 1.5, 10)):
-    if image.size[0] != TEMPLATE_WIDTH:
-        image = resize_pil(image, TEMPLATE_WIDTH)
-    if templ.size[0] != TEMPLATE_WIDTH:
-        templ = resize_pil(templ, TEMPLATE_WIDTH)
-
-    (tW, tH) = templ.size
-    cv2_image = pil2cv(image)
-    cv2_templ = pil2cv(templ)
-
-    multi_scale_matching_template_results = multi_scale_matching_template_impl(
-        cv2_image, cv2_templ, linspace=linspace)
+def find_character_rank(image: np.ndarray, border: float) -> str:
+    for (templ_name, rank) in CHARACTER_RANK_TEMPLATES:
+        result = matching_template(image, template_registry.get(templ_name))
+        ys, _ = np.where(result >= border)
+        if len(ys) > 0:
+            return rank
 
-    found = None
-    for multi_scale_matching_template_result in multi_scale_matching_template_results:
-        r = multi_scale_matching_template_result.ratio
-        result = multi_scale_matching_template_result.result
+    return ''
 
-        (_, maxVal, _, maxLoc) = cv2.minMaxLoc(result)
 
-        if found is None or maxVal > found[0]:
-            found = (maxVal, maxLoc, r)
+async def get_matching_template_location(image: Image or ImageContext, templ, *, linspace=np.linspace(1.1, 1.5, 10), search_mode=SEARCH_MODE_FULL, name=None):
+    # ImageContextは幅1024にリサイズ済みのグレースケール画像を持っている
+    context = ImageContext.of(image)
+    if isinstance(templ, Image.Image) and templ.size[0] != TEMPLATE_WIDTH:
+        templ = resize_pil(templ, TEMPLATE_WIDTH)
 
-    if found is None:
+    # nameを渡すと、同じ解像度で前回見つかった位置やテンプレートごとの探索範囲から先に探索する
+    match = await run_blocking(lambda: template_locator.search(
+        name, context.gray, templ, linspace, size=context.source.size, mode=search_mode))
+    if match is None:
         return None
 
-    (_, maxLoc, r) = found
-    (start_x, start_y) = (int(maxLoc[0] * r), int(maxLoc[1] * r))
-    (end_x, end_y) = (int((maxLoc[0] + tW) * r), int((maxLoc[1] + tH) * r))
-
-    return (start_x, start_y), (end_x, end_y)
+    return match.loc
@@ -1,34 +1,34 @@
-import json
-import os
 from logging import Logger
 
 from PIL import Image
 
-import resources
 from app.interface.driver.file_driver import LocalFileDriver
 from app.interface.usecase.image import ImageUsecase
-from app.domain.image import CharacterDetailImage
-from app.library.pillow import resize_pil
+from app.domain.image import CharacterDetailImage, ImageContext
+from app.library.executor import run_blocking
+from app.library.matching_template import SEARCH_MODE_FULL
+from app.library.metrics import timed
 from app.usecase.character import get_matching_template_location
+from app.usecase.templates import PARAMS_FRAME_TEMPLATE, template_registry
 
 class ImageInteractor(ImageUsecase):
 
-    def __init__(self, local_file_driver: LocalFileDriver, logger: Logger, *, debug=False):
+    def __init__(self, local_file_driver: LocalFileDriver, logger: Logger, *, debug=False, search_mode=SEARCH_MODE_FULL):
         self.local_file_driver = local_file_driver
         self.logger = logger
         self.debug = debug
+        self.search_mode = search_mode
 
-    async def create_character_detail_image(self, image: Image) -> CharacterDetailImage:
-        character_detail_image_width = 1024
+    @timed('image.create_character_detail_image')
+    async def create_character_detail_image(self, image: Image or ImageContext) -> CharacterDetailImage:
+        context = ImageContext.of(image)
 
-        resized_image = resize_pil(image, character_detail_image_width)
-
-        params_frame_templ = await self.local_file_driver.open_image(
-            os.path.join(resources.__path__[0], 'template_matching', 'character', 'template_1024.png')
-        )
-        params_frame_loc = await get_matching_template_location(image, params_frame_templ)
+        params_frame_templ = template_registry.get(PARAMS_FRAME_TEMPLATE)
+        params_frame_loc = await get_matching_template_location(
+            context, params_frame_templ, search_mode=self.search_mode, name=PARAMS_FRAME_TEMPLATE)
 
         return CharacterDetailImage(
-            resized_image,
+            await run_blocking(lambda: context.image),
             params_frame_loc,
-        )
\ No newline at end of file
+            context,
+        )
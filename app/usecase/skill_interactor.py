@@ -1,9 +1,10 @@
 import asyncio
+import functools
 import json
 import os
 import re
-import cv2
-from concurrent import futures
+import threading
+import weakref
 from logging import Logger
 
 import cv2
@@ -12,118 +13,132 @@ import numpy as np
 from PIL import Image
 
 import resources
-from app.domain.skill import CharacterSkills, UniqueSkill, NormalSkill, NormalSkills
+from app.domain.image import ImageContext
+from app.domain.skill import CharacterSkills, UniqueSkill, NormalSkill, NormalSkills, SkillExtraction
 from app.interface.driver.file_driver import LocalFileDriver
 from app.interface.usecase.skill_usecase import SkillUsecase
-from app.library.matching_template import matching_template, multi_scale_matching_template_impl
+from app.library.executor import run_blocking
+from app.library.matching_template import (SEARCH_MODE_FULL, detect_templates, matching_template,
+                                           multi_scale_matching_template_impl)
+from app.library.metrics import skill_frame_raw_hits, skill_threshold_retries, stage, timed
 from app.library.ocr import (
     get_digit_with_single_text_line_and_eng_from_image,
     get_line_box_with_single_text_line_and_jpn_from_image)
-from app.library.pillow import binarized, crop_pil, pil2cv, resize_pil, cv2pil
-from app.usecase import const
+from app.library.pillow import binarized, crop_pil, cv2pil, otsu_threshold, pil2cv
+from app.usecase.templates import (CIRCLE_TEMPLATES, SKILL_FRAME_TEMPLATE, SKILL_TAB_TEMPLATE, template_locator,
+                                  template_registry)
 
 TEMPLATE_HEIGHT = 100
 IMAGE_MIN_WIDTH = 720
+# 大津の二値化でスキル名を読み取れなかったときに順に試すしきい値
+# 大津のしきい値に最も近いものはほぼ同じ二値化になるので試さず、読み取りは従来と同じ最大4回に収める
+SKILL_NAME_THRESHOLDS = (130, 120, 140, 160)
 
 
 class SkillInteractor(SkillUsecase):
 
-    def __init__(self, local_file_driver: LocalFileDriver, logger: Logger, *, debug=False):
+    def __init__(self, local_file_driver: LocalFileDriver, logger: Logger, *, debug=False, search_mode=SEARCH_MODE_FULL):
         self.local_file_driver = local_file_driver
         self.logger = logger
         self.pattern_digital = r'\D'
         self.debug = debug
+        self.search_mode = search_mode
         self.cache_master_skills_map_by_weight = None
         self.cache_master_skills_map_by_type = None
+        self.cache_master_skill_names_by_weight = None
+        self.skill_extraction_memo = dict()
+        self.skill_extraction_memo_lock = threading.Lock()
 
 
     async def get_skills_without_unique_from_image(self, image: Image) -> NormalSkills:
-        # resize image width to 1024px
-        optimized_resize_image = resize_pil(image, 1024, None, Image.LANCZOS)
-
-        # rough adjust
-        rough_adjusted_image = crop_pil(optimized_resize_image, (0, optimized_resize_image.size[1] * 0.4, optimized_resize_image.size[0], optimized_resize_image.size[1] * 0.95))
-
-        skills = await self.get_skills_from_image(rough_adjusted_image)
-        skills_dict_array = skills.to_dict_array()
-
-        master_skills_map_by_type = await self.get_master_skills_map_by_type()
-        unique_skills = master_skills_map_by_type['unique_skills']
-
-        result = []
-        for skill_dict in skills_dict_array:
-            skill_name = skill_dict['name']
-            skill_level = skill_dict['level']
-            is_unique_skill = False
-            for unique_skill in unique_skills:
-                unique_skill_name = unique_skill['name']
-                if unique_skill_name == skill_name and skill_level > 0:
-                    is_unique_skill = True
-            if is_unique_skill is False:
-                result.append(NormalSkill(skill_name, skill_level))
-
-        return NormalSkills(result)
+        skill_extraction = await self.get_skill_extraction_from_image(image)
+        return skill_extraction.normal_skills()
 
     async def get_unique_skill_from_image(self, image: Image) -> NormalSkill:
+        unique_skill = (await self.get_skill_extraction_from_image(image)).unique_skill()
+        return NormalSkill(unique_skill.name, unique_skill.level)
+
+    async def get_skill_extraction_from_image(self, image: Image) -> SkillExtraction:
+        # 同じ画像に対する抽出は画像の寿命の間（リクエスト中）1回だけ行い、結果を共有する
+        loop = asyncio.get_running_loop()
+        key = id(image)
+        with self.skill_extraction_memo_lock:
+            task = self.skill_extraction_memo.get(key)
+            if task is None or (not task.done() and task.get_loop() is not loop):
+                task = loop.create_task(self.extract_skills_from_image(image))
+                self.skill_extraction_memo[key] = task
+                weakref.finalize(image, self.skill_extraction_memo.pop, key, None)
+                task.add_done_callback(functools.partial(self.forget_failed_skill_extraction, key))
+
+        return await task
+
+    def forget_failed_skill_extraction(self, key: int, task: asyncio.Task):
+        # 失敗した抽出は残さない。例外のトレースバックが画像を参照し続け、画像の解放を待っていると破棄されない
+        if not task.cancelled() and task.exception() is None:
+            return
+        with self.skill_extraction_memo_lock:
+            if self.skill_extraction_memo.get(key) is task:
+                del self.skill_extraction_memo[key]
+
+    @timed('skill.extract_skills_from_image')
+    async def extract_skills_from_image(self, image: Image or ImageContext) -> SkillExtraction:
         # resize image width to 1024px
-        optimized_resize_image = resize_pil(image, 1024, None, Image.LANCZOS)
+        context = ImageContext.of(image).resampled(Image.LANCZOS)
+        if self.debug:
+            await self.local_file_driver.save_image(
+                context.image, os.path.join('tmp', 'get_skills_from_character_modal_image', 'resize_width_1024.png')
+            )
 
         # rough adjust
-        rough_adjusted_image = crop_pil(optimized_resize_image, (0, optimized_resize_image.size[1] * 0.4, optimized_resize_image.size[0], optimized_resize_image.size[1] * 0.95))
+        region = context.crop((0, context.size[1] * 0.4, context.size[0], context.size[1] * 0.95))
+        if self.debug:
+            await self.local_file_driver.save_image(
+                region.image, os.path.join('tmp', 'get_skills_from_character_modal_image', 'rough_adjust.png')
+            )
 
-        skills = await self.get_skills_from_image(rough_adjusted_image)
-        skills_dict_array = skills.to_dict_array()
+        # get skills
+        skills = await self.get_skills_from_image(region)
 
+        # get master_data
         master_skills_map_by_type = await self.get_master_skills_map_by_type()
-        unique_skills = master_skills_map_by_type['unique_skills']
+        master_unique_skill_names = frozenset(
+            master_unique_skill['name'] for master_unique_skill in master_skills_map_by_type['unique_skills'])
 
-        for skill_dict in skills_dict_array:
-            skill_name = skill_dict['name']
-            skill_level = skill_dict['level']
-            for unique_skill in unique_skills:
-                unique_skill_name = unique_skill['name']
-                if unique_skill_name == skill_name and skill_level > 0:
-                    return NormalSkill(skill_name, skill_level)
+        return SkillExtraction(skills, master_unique_skill_names)
 
-        return NormalSkill('', 0)
+    @timed('skill.get_skills_from_image')
+    async def get_skills_from_image(self, image: Image or ImageContext) -> NormalSkills:
+        context = ImageContext.of(image)
 
-    async def get_skills_from_image(self, image: Image) -> NormalSkills:
         # get skill_tab location
-        skill_tab_loc = await self.get_skill_tab_location(image)
+        skill_tab_loc = await self.get_skill_tab_location(context)
         if skill_tab_loc is None:
             return NormalSkills([])
         (skill_tab_loc_sx, skill_tab_loc_sy), (skill_tab_loc_ex, skill_tab_loc_ey) = skill_tab_loc
         (st_w, st_h) = skill_tab_loc_ex - skill_tab_loc_sx, skill_tab_loc_ey - skill_tab_loc_sy
 
         # cropped skill_area by skill_tab location
-        skill_area_box = (0, skill_tab_loc_ey, image.size[0], st_h * 20)
-        cropped_image = crop_pil(image, skill_area_box)
+        skill_area_box = (0, skill_tab_loc_ey, context.size[0], st_h * 20)
+        skill_area = context.crop(skill_area_box)
+        cropped_image = await run_blocking(lambda: skill_area.image)
         if self.debug:
             await self.local_file_driver.save_image(
                 cropped_image, os.path.join('tmp', 'get_skills_from_image', 'cropped_skill_area.png')
             )
 
         # get skill_frame locations
-        skill_frame_locs = await self.get_skill_frame_locations(cropped_image)
+        skill_frame_locs = await self.get_skill_frame_locations(skill_area)
 
         skills = []
         for i in range(len(skill_frame_locs)):
             skills.append(NormalSkill('', 0))
 
-        binarized_image = binarized(cropped_image, 130)
-
-        def p(index: int):
+        async def p(index: int):
             (start_x, start_y), (end_x, end_y) = skill_frame_locs[index]
 
             # 色の割合でスキルタイプを取得してみるテスト
-            try:
+            def mask_skill_type():
                 cropped_skill_type_image = crop_pil(cropped_image, (start_x + st_w * 0.02, start_y + st_h * 0.6, start_x + st_w * 0.06, end_y - st_h * 0.5))
-                if self.debug:
-                    asyncio.run(self.local_file_driver.save_image(
-                        cropped_skill_type_image,
-                        os.path.join('tmp', 'get_skills_from_image', 'skill' + str(index + 1) + '_type_cropped.png')
-                    ))
-
                 cv2_cropped_skill_type_image = pil2cv(cropped_skill_type_image)
 
                 # 回復・疲労軽減（青）
@@ -134,12 +149,20 @@ class SkillInteractor(SkillUsecase):
                 # img_mask = cv2.inRange(cv2_cropped_skill_type_image, (95, 60, 220), (255, 245, 245))
                 # 特定条件・レース場強化系（緑）
                 # img_mask = cv2.inRange(cv2_cropped_skill_type_image, (50, 150, 150), (255, 255, 230))
+                return cropped_skill_type_image, cv2_cropped_skill_type_image, img_mask
+
+            try:
+                (cropped_skill_type_image, cv2_cropped_skill_type_image, img_mask) = await run_blocking(mask_skill_type)
                 if self.debug:
+                    await self.local_file_driver.save_image(
+                        cropped_skill_type_image,
+                        os.path.join('tmp', 'get_skills_from_image', 'skill' + str(index + 1) + '_type_cropped.png')
+                    )
                     output = cv2.bitwise_and(cv2_cropped_skill_type_image, cv2_cropped_skill_type_image, mask=img_mask)
-                    asyncio.run(self.local_file_driver.save_image(
+                    await self.local_file_driver.save_image(
                         cv2pil(output),
                         os.path.join('tmp', 'get_skills_from_image', 'skill' + str(index + 1) + '_mask_cropped.png')
-                    ))
+                    )
                 red_ratio1 = cv2.countNonZero(img_mask) / img_mask.size
                 self.logger.info('index: {}, {:.2%}'.format(index+1, red_ratio1))  # 11.62%
 
@@ -147,224 +170,146 @@ class SkillInteractor(SkillUsecase):
                 self.logger.error(e)
                 return
 
-            cropped_skill = crop_pil(binarized_image, (
-                start_x + st_w * 0.07, start_y + st_h * 0.7, start_x + st_w * 0.43, end_y - st_h * 0.55))
-            skill_name = asyncio.run(self.get_skill_name_from_image(cropped_skill))
-            if skill_name is None or len(skill_name) == 0:
-                # 文字列によって有効なしきい値が異なるので読み取れなければしきい値を上げてリトライ
-                cropped_skill = crop_pil(binarized(cropped_image, 120), (
-                    start_x + st_w * 0.07, start_y + st_h * 0.7, start_x + st_w * 0.43, end_y - st_h * 0.55))
-                skill_name = asyncio.run(self.get_skill_name_from_image(cropped_skill))
-            if skill_name is None or len(skill_name) == 0:
-                # 文字列によって有効なしきい値が異なるので読み取れなければしきい値を上げてリトライ
-                cropped_skill = crop_pil(binarized(cropped_image, 140), (
-                    start_x + st_w * 0.07, start_y + st_h * 0.7, start_x + st_w * 0.43, end_y - st_h * 0.55))
-                skill_name = asyncio.run(self.get_skill_name_from_image(cropped_skill))
-            if skill_name is None or len(skill_name) == 0:
-                # 文字列によって有効なしきい値が異なるので読み取れなければしきい値を上げてリトライ
-                cropped_skill = crop_pil(binarized(cropped_image, 160), (
-                    start_x + st_w * 0.07, start_y + st_h * 0.7, start_x + st_w * 0.43, end_y - st_h * 0.55))
-                skill_name = asyncio.run(self.get_skill_name_from_image(cropped_skill))
+            # スキルエリア全体ではなく、スキル名の領域だけを切り出してから二値化する
+            cropped_name = await run_blocking(lambda: crop_pil(cropped_image, (
+                start_x + st_w * 0.07, start_y + st_h * 0.7, start_x + st_w * 0.43, end_y - st_h * 0.55)))
+            otsu = await run_blocking(otsu_threshold, cropped_name)
+            cropped_skill = await run_blocking(binarized, cropped_name, otsu)
+            match = await self.match_skill_name_from_image(cropped_skill)
+            if match is None or match[1] == 0:
+                # 文字列によって有効なしきい値が異なるので、読み取れなければ固定のしきい値で順にリトライ
+                nearest = min(SKILL_NAME_THRESHOLDS, key=lambda threshold: abs(threshold - otsu))
+                for threshold in [threshold for threshold in SKILL_NAME_THRESHOLDS if threshold != nearest]:
+                    skill_threshold_retries.labels(threshold).inc()
+                    cropped_skill = await run_blocking(binarized, cropped_name, threshold)
+                    match = await self.match_skill_name_from_image(cropped_skill)
+                    if match is not None and match[1] > 0:
+                        break
+            skill_name = '' if match is None else match[0]
 
             if self.debug:
-                asyncio.run(self.local_file_driver.save_image(
+                await self.local_file_driver.save_image(
                     cropped_skill,
                     os.path.join('tmp', 'get_skills_from_image', 'skill' + str(index + 1) + '_name_cropped.png')
-                ))
+                )
 
             # 通常の文字認識では○と◎と識別が難しいので追加で検証
             if '◯' in skill_name:
-                cropped_for_check_circle_image = crop_pil(binarized(cropped_image, 160), (
-                    start_x + st_w * 0.07, start_y + st_h * 0.7, start_x + st_w * 0.435, end_y - st_h * 0.55))
-                line_box = get_line_box_with_single_text_line_and_jpn_from_image(cropped_for_check_circle_image)
+                cropped_for_check_circle_image = await run_blocking(lambda: binarized(crop_pil(cropped_image, (
+                    start_x + st_w * 0.07, start_y + st_h * 0.7, start_x + st_w * 0.435, end_y - st_h * 0.55)), 160))
+                line_box = await run_blocking(get_line_box_with_single_text_line_and_jpn_from_image,
+                                              cropped_for_check_circle_image)
                 if len(line_box) != 0:
                     (s_x, s_y), (e_x, e_y) = line_box[0].position
                     word_width = 24.7
-                    cropped_circle_image = crop_pil(cropped_for_check_circle_image, (e_x - word_width, s_y - 2, e_x + 2, e_y + 2))
+                    cropped_circle_image = await run_blocking(
+                        crop_pil, cropped_for_check_circle_image, (e_x - word_width, s_y - 2, e_x + 2, e_y + 2))
                     if self.debug:
-                        asyncio.run(self.local_file_driver.save_image(
+                        await self.local_file_driver.save_image(
                             cropped_circle_image,
                             os.path.join('tmp', 'get_skills_from_image', 'circle_test_' + str(index + 1) + '_cropped.png')
-                        ))
+                        )
 
                     # 要調整
                     border = 0.6
-                    cv2_image = pil2cv(cropped_circle_image)
-                    cv2_image = cv2.cvtColor(cv2_image, cv2.COLOR_BGR2GRAY)
-                    circle_files = [
-                        ['single.png', '◯'],
-                        ['double.png', '◎'],
-                    ]
-                    for (circle_file, circle) in circle_files:
-                        try:
-                            templ_circle_file = asyncio.run(self.local_file_driver.open_image(
-                                os.path.join(resources.__path__[0], 'circles', circle_file)
-                            ))
-                            templ_circle_file = resize_pil(templ_circle_file, 25)
-                            cv2_templ_circle_file = pil2cv(templ_circle_file)
-                            cv2_templ_circle_file = cv2.cvtColor(cv2_templ_circle_file, cv2.COLOR_BGR2GRAY)
-                            result = matching_template(cv2_image, cv2_templ_circle_file)
-                            ys, _ = np.where(result >= border)
-                            if len(ys) > 0:
-                                skill_name = skill_name.replace('◯', circle)
-                                break
-                        except Exception as e:
-                            self.logger.error(e)
-                            continue
+
+                    def find_circle():
+                        cv2_image = pil2cv(cropped_circle_image)
+                        cv2_image = cv2.cvtColor(cv2_image, cv2.COLOR_BGR2GRAY)
+                        for (templ_name, circle) in CIRCLE_TEMPLATES:
+                            try:
+                                result = matching_template(cv2_image, template_registry.get(templ_name))
+                                ys, _ = np.where(result >= border)
+                                if len(ys) > 0:
+                                    return circle
+                            except Exception as e:
+                                self.logger.error(e)
+                                continue
+                        return None
+
+                    circle = await run_blocking(find_circle)
+                    if circle is not None:
+                        skill_name = skill_name.replace('◯', circle)
 
 
             if index == 0:
                 # Lvがあるのは固有スキル（index = 0）だけ
-                cropped_level = crop_pil(binarized_image, (
-                    start_x + st_w * 0.435, start_y + st_h * 0.7, start_x + st_w * 0.5, end_y - st_h * 0.6))
-                skill_level = int(asyncio.run(self.get_skill_level_from_image(cropped_level)))
+                cropped_level = await run_blocking(lambda: binarized(crop_pil(cropped_image, (
+                    start_x + st_w * 0.435, start_y + st_h * 0.7, start_x + st_w * 0.5, end_y - st_h * 0.6)), 130))
+                skill_level = int(await self.get_skill_level_from_image(cropped_level))
 
                 if self.debug:
-                    asyncio.run(self.local_file_driver.save_image(
+                    await self.local_file_driver.save_image(
                         cropped_level,
                         os.path.join('tmp', 'get_skills_from_image', 'skill' + str(index + 1) + '_level_cropped.png')
-                    ))
+                    )
             else:
                 skill_level = 0
 
             skills[index] = NormalSkill(skill_name, skill_level)
 
-        future_list = []
-        with futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
-            for i in range(len(skill_frame_locs)):
-                future = executor.submit(fn=p, index=i)
-                future_list.append(future)
-            _ = futures.as_completed(fs=future_list)
+        # OCRなどのブロッキング処理は共有のワーカープールで実行し、スキルごとの処理を並行して待つ
+        async def read_skill(index: int):
+            # スキルごとのOCRのリトライ回数がタイミングの内訳から分かるようにする
+            with stage('skill.read_skill', index=index):
+                await p(index)
+
+        results = await asyncio.gather(*(read_skill(i) for i in range(len(skill_frame_locs))), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                # 読み取れなかったスキルは空のまま返す
+                self.logger.error(result)
 
         return NormalSkills(skills)
 
-    async def get_character_skills_from_character_modal_image(self, image: Image) -> CharacterSkills:
-        if image.width < IMAGE_MIN_WIDTH:
+    @timed('skill.get_character_skills_from_character_modal_image')
+    async def get_character_skills_from_character_modal_image(self, image: Image or ImageContext) -> CharacterSkills:
+        if ImageContext.of(image).source.width < IMAGE_MIN_WIDTH:
             unique_skill = UniqueSkill('', 0)
             normal_skill_array = []
             return CharacterSkills(unique_skill, NormalSkills(normal_skill_array))
 
-        # resize image width to 1024px
-        image = resize_pil(image, const.INPUT_IMAGE_WIDTH, None, Image.LANCZOS)
-        if self.debug:
-            await self.local_file_driver.save_image(
-                image, os.path.join('tmp', 'get_skills_from_character_modal_image', 'resize_width_1024.png')
-            )
-
-        # rough adjust
-        image = crop_pil(image, (0, image.size[1] * 0.4, image.size[0], image.size[1] * 0.95))
-        if self.debug:
-            await self.local_file_driver.save_image(
-                image, os.path.join('tmp', 'get_skills_from_character_modal_image', 'rough_adjust.png')
-            )
-
-        # get skills
-        skills = await self.get_skills_from_image(image)
-        skill_dict_array = skills.to_dict_array()
-
-        # get master_data
-        master_skills_map_by_type = await self.get_master_skills_map_by_type()
-        master_unique_skills = master_skills_map_by_type['unique_skills']
-
-        # sort unique && normal skills
-        unique_skill = UniqueSkill('', 0)
-        normal_skill_array = []
-        for skill_dict in skill_dict_array:
-            is_unique_skill = False
-            skill_name = skill_dict['name']
-            skill_level = skill_dict['level']
-            for master_unique_skill in master_unique_skills:
-                if master_unique_skill['name'] == skill_name and skill_level > 0:
-                    is_unique_skill = True
-            if is_unique_skill:
-                unique_skill = UniqueSkill(skill_name, skill_level)
-            else:
-                normal_skill_array.append(NormalSkill(skill_name, skill_level))
-
-        return CharacterSkills(unique_skill, NormalSkills(normal_skill_array))
-
-    async def get_skill_tab_location(self, image: Image):
-        # optimize
-        if image.size[0] != const.INPUT_IMAGE_WIDTH:
-            image = resize_pil(image, const.INPUT_IMAGE_WIDTH)
-
-        templ = await self.local_file_driver.open_image(
-            os.path.join(resources.__path__[0], 'images', 'ocr_skills', 'template_skill_tab_w_1024.png')
-        )
-        (tW, tH) = templ.size
+        skill_extraction = await self.get_skill_extraction_from_image(image)
+        return skill_extraction.character_skills()
 
-        multi_scale_matching_template_results = multi_scale_matching_template_impl(image, templ,
-                                                                                   linspace=np.linspace(1.1, 1.5, 3))
-        found = None
-        for multi_scale_matching_template_result in multi_scale_matching_template_results:
-            r = multi_scale_matching_template_result.ratio
-            result = multi_scale_matching_template_result.result
+    @timed('skill.get_skill_tab_location')
+    async def get_skill_tab_location(self, image: Image or ImageContext):
+        context = ImageContext.of(image)
 
-            (_, maxVal, _, maxLoc) = cv2.minMaxLoc(result)
+        templ = template_registry.get(SKILL_TAB_TEMPLATE)
 
-            if found is None or maxVal > found[0]:
-                found = (maxVal, maxLoc, r)
-
-        if found is None:
+        match = await run_blocking(lambda: template_locator.search(
+            SKILL_TAB_TEMPLATE, context.gray, templ, np.linspace(1.1, 1.5, 3), size=context.source.size,
+            mode=self.search_mode))
+        if match is None:
             self.logger.debug('not found get_skill_tab')
             return None
 
-        (_, maxLoc, r) = found
-        (start_x, start_y) = (int(maxLoc[0] * r), int(maxLoc[1] * r))
-        (end_x, end_y) = (int((maxLoc[0] + tW) * r), int((maxLoc[1] + tH) * r))
+        (start_x, start_y), (end_x, end_y) = match.loc
 
         if self.debug:
             await self.local_file_driver.save_image(
-                crop_pil(image, (start_x, start_y, end_x, end_y)),
+                crop_pil(context.image, (start_x, start_y, end_x, end_y)),
                 os.path.join('tmp', 'get_skill_tab_location', 'multi_scale_matching_template.png')
             )
 
         return (start_x, start_y), (end_x, end_y)
 
-    async def get_skill_frame_locations(self, image: Image):
-        # optimize
-        if image.size[0] != const.INPUT_IMAGE_WIDTH:
-            image = resize_pil(image, const.INPUT_IMAGE_WIDTH)
-
-        templ = await self.local_file_driver.open_image(
-            os.path.join(resources.__path__[0], 'images', 'ocr_skills', 'template_skill_frame_h_100.png')
-        )
-
-        cv2_image = pil2cv(image)
-        cv2_templ = pil2cv(templ)
-
-        multi_scale_matching_template_results = multi_scale_matching_template_impl(cv2_image, cv2_templ,
-                                                                                   linspace=np.linspace(1.0, 1.1, 3))
-
-        start_locs = []
-        locs = []
-
-        for i in range(len(multi_scale_matching_template_results)):
-            multi_scale_matching_template_result = multi_scale_matching_template_results[i]
-            r = multi_scale_matching_template_result.ratio
-            result = multi_scale_matching_template_result.result
-
-            ys, xs = np.where(result >= 0.7)
-            for x, y in zip(xs, ys):
-                if len(start_locs) == 0:
-                    start_locs.append((x, y))
-                    locs.append((
-                        (int(x * r), int(y * r)),
-                        (int((x + cv2_templ.shape[1]) * r), int((y + cv2_templ.shape[0]) * r))
-                    ))
-                else:
-                    _, (nearest_x, nearest_y) = func_search_neighbourhood(start_locs, np.array([x, y]))
-                    if abs(x - nearest_x) < 100 and abs(y - nearest_y) < 80:
-                        continue
-                    else:
-                        start_locs.append((x, y))
-                        locs.append((
-                            (int(x * r), int(y * r)),
-                            (int((x + cv2_templ.shape[1]) * r), int((y + cv2_templ.shape[0]) * r))
-                        ))
+    @timed('skill.get_skill_frame_locations')
+    async def get_skill_frame_locations(self, image: Image or ImageContext):
+        context = ImageContext.of(image)
+
+        cv2_templ = template_registry.get(SKILL_FRAME_TEMPLATE)
+
+        # 1つの枠の周辺ではしきい値を超える点が大量に見つかるので、近傍での最大値に絞ってから重なりを除く
+        detections = await run_blocking(lambda: detect_templates(
+            multi_scale_matching_template_impl(context.gray, cv2_templ, linspace=np.linspace(1.0, 1.1, 3)),
+            cv2_templ.shape, threshold=0.7, distance=(100, 80)))
+        skill_frame_raw_hits.observe(detections.raw_hits)
+        locs = detections.locs
 
         if self.debug:
-            dst = cv2_image.copy()
+            dst = pil2cv(context.image)
             for i in range(len(locs)):
                 (start_x, start_y), (end_x, end_y) = locs[i]
                 cv2.rectangle(
@@ -386,7 +331,13 @@ class SkillInteractor(SkillUsecase):
         return sorted_locs
 
     async def get_skill_name_from_image(self, image: Image) -> str or None:
-        line_box = get_line_box_with_single_text_line_and_jpn_from_image(image)
+        match = await self.match_skill_name_from_image(image)
+        return None if match is None else match[0]
+
+    @timed('skill.get_skill_name_from_image')
+    async def match_skill_name_from_image(self, image: Image) -> (str, float) or None:
+        # スキル名とマスターのスキル名との類似度を返す。見つからなければスキル名は空文字列、類似度は0
+        line_box = await run_blocking(get_line_box_with_single_text_line_and_jpn_from_image, image)
         if len(line_box) == 0:
             return None
         else:
@@ -396,12 +347,15 @@ class SkillInteractor(SkillUsecase):
             text = line_box[0].content.replace(' ', '')
             weight = int((e_x - s_x) / word_width + 1)
 
-            skill_name = await self.get_skill_name_from_text_and_weight(text, weight)
-            return skill_name
+            return await self.match_skill_name_from_text_and_weight(text, weight)
 
     async def get_skill_name_from_text_and_weight(self, text: str, weight: int) -> str or None:
-        master_skills_map_by_weight = await self.get_master_skills_map_by_weight()
-        if weight not in master_skills_map_by_weight:
+        match = await self.match_skill_name_from_text_and_weight(text, weight)
+        return None if match is None else match[0]
+
+    async def match_skill_name_from_text_and_weight(self, text: str, weight: int) -> (str, float) or None:
+        master_skill_names_by_weight = await self.get_master_skill_names_by_weight()
+        if weight not in master_skill_names_by_weight:
             return None
 
         # master定義されているスキルネームと類似度を計算し、最も類似度が高いスキルを返す
@@ -409,25 +363,17 @@ class SkillInteractor(SkillUsecase):
         found_str = ''
         found = 0
         border_found = 0.55
-        for master_skill in master_skills_map_by_weight[weight]:
-            skill_name = master_skill['name']
-            similar_names = master_skill['similar']['name']
-
-            aro_dist = Levenshtein.jaro_winkler(text, skill_name)
-            if aro_dist > found and aro_dist > border_found:
-                found_str = skill_name
-                found = aro_dist
-
-            for similar_skill_name in similar_names:
-                aro_dist = Levenshtein.jaro_winkler(text, similar_skill_name)
+        with stage('match.skill_name'):
+            for (name, skill_name) in master_skill_names_by_weight[weight]:
+                aro_dist = Levenshtein.jaro_winkler(text, name)
                 if aro_dist > found and aro_dist > border_found:
                     found_str = skill_name
                     found = aro_dist
 
-        return found_str
+        return found_str, found
 
     async def get_skill_level_from_image(self, image: Image) -> int:
-        digit_text = re.sub(self.pattern_digital, '', get_digit_with_single_text_line_and_eng_from_image(image))
+        digit_text = re.sub(self.pattern_digital, '', await run_blocking(get_digit_with_single_text_line_and_eng_from_image, image))
         return digit_text or 0
 
     async def get_master_skills_map_by_weight(self):
@@ -454,6 +400,25 @@ class SkillInteractor(SkillUsecase):
         self.cache_master_skills_map_by_weight = result
         return result
 
+    async def get_master_skill_names_by_weight(self):
+        # スキル名と類似名を (照合する名前, スキル名) の組にまとめ、照合のたびに辿り直さないようにしておく
+        if self.cache_master_skill_names_by_weight is not None:
+            return self.cache_master_skill_names_by_weight
+
+        result = dict()
+
+        master_skills_map_by_weight = await self.get_master_skills_map_by_weight()
+        for (weight, master_skills) in master_skills_map_by_weight.items():
+            names = []
+            for master_skill in master_skills:
+                names.append((master_skill['name'], master_skill['name']))
+                for similar_skill_name in master_skill['similar']['name']:
+                    names.append((similar_skill_name, master_skill['name']))
+            result[weight] = names
+
+        self.cache_master_skill_names_by_weight = result
+        return result
+
     async def get_master_skills_map_by_type(self):
         if self.cache_master_skills_map_by_type is not None:
             return self.cache_master_skills_map_by_type
@@ -472,12 +437,3 @@ class SkillInteractor(SkillUsecase):
         self.cache_master_skills_map_by_type = result
         return result
 
-
-def func_search_neighbourhood(list, p0):
-    ps = np.array(list)
-    L = np.array([])
-    for i in range(ps.shape[0]):
-        norm = np.sqrt((ps[i][0] - p0[0]) * (ps[i][0] - p0[0]) +
-                       (ps[i][1] - p0[1]) * (ps[i][1] - p0[1]))
-        L = np.append(L, norm)
-    return np.argmin(L), ps[np.argmin(L)]
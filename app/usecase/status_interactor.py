@@ -5,47 +5,76 @@ from logging import Logger
 import numpy as np
 from PIL import Image
 
-import resources
 from app.domain.parameters import Parameters, SupportParameters
 from app.interface.driver.file_driver import LocalFileDriver
 from app.interface.usecase.status_usecase import StatusUsecase
-from app.library.matching_template import multi_scale_matching_template
-from app.library.ocr import get_digit_with_single_text_line_and_eng_from_image
-from app.library.pillow import binarized, crop_pil, pil2cv, resize_pil
-from app.domain.image import CharacterDetailImage
+from app.library.executor import run_blocking
+from app.library.matching_template import SEARCH_MODE_FULL, multi_scale_matching_template
+from app.library.metrics import timed
+from app.library.ocr import (get_digit_with_single_text_line_and_eng_from_image,
+                             get_digits_with_single_text_line_and_eng_from_images)
+from app.library.pillow import crop_pil
+from app.domain.image import CharacterDetailImage, ImageContext
+from app.usecase.templates import SUPPORT_PARAMS_TEMPLATE, glyph_digit_reader, template_registry
 
 TEMPLATE_WIDTH = 1024
 TEMPLATE_HEIGHT = 100
 
+PARAMETER_NAMES = ['speed', 'stamina', 'power', 'guts', 'wise']
+GLYPH_LEARN_CONFIDENCE = 80
+
 
 class StatusInteractor(StatusUsecase):
 
-    def __init__(self, local_file_driver: LocalFileDriver, logger: Logger, *, debug=False):
+    def __init__(self, local_file_driver: LocalFileDriver, logger: Logger, *, debug=False, search_mode=SEARCH_MODE_FULL):
         self.local_file_driver = local_file_driver
         self.logger = logger
         self.pattern_digital = r'\D'
         self.debug = debug
+        self.search_mode = search_mode
         self.cache_master_skills_map_by_weight = None
 
-    async def get_support_parameters_from_image(self, image: Image) -> SupportParameters:
+    @timed('status.get_support_parameters_from_image')
+    async def get_support_parameters_from_image(self, image: Image or ImageContext) -> SupportParameters:
+        binarized_images = await self.crop_support_parameter_images(image)
+        if binarized_images is None:
+            return SupportParameters(0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+
+        values = await self.get_parameters_from_images(binarized_images)
+        (speed, stamina, power, guts, wise) = values[:5]
+        (max_speed, max_stamina, max_power, max_guts, max_wise) = [
+            max_value[1:] if len(max_value) > 3 else max_value for max_value in values[5:]
+        ]
 
-        templ = await self.local_file_driver.open_image(
-            os.path.join(resources.__path__[0], 'images', 'support_params', 'template.png')
+        return SupportParameters(
+            int(speed),
+            int(stamina),
+            int(power),
+            int(guts),
+            int(wise),
+            int(max_speed),
+            int(max_stamina),
+            int(max_power),
+            int(max_guts),
+            int(max_wise),
         )
-        (tW, tH) = templ.size
-        cv2_templ = pil2cv(templ)
 
-        image = resize_pil(image, TEMPLATE_WIDTH)
-        cv2_image = pil2cv(image)
+    async def crop_support_parameter_images(self, image: Image or ImageContext) -> [Image] or None:
+        # 5項目の値と上限値を二値化して、この順に返す。パラメータの表示が見つからなければNone
+        cv2_templ = template_registry.get(SUPPORT_PARAMS_TEMPLATE)
+
+        context = ImageContext.of(image)
 
         # マルチスケールテンプレートマッチングでtemplateと一致する箇所の座標を抽出
-        loc = multi_scale_matching_template(cv2_image, cv2_templ, np.linspace(1.0, 1.5, 10))
+        loc = await run_blocking(
+            lambda: multi_scale_matching_template(context.gray, cv2_templ, np.linspace(1.0, 1.5, 10), mode=self.search_mode))
         if loc is None:
-            return SupportParameters(0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+            return None
         if self.debug:
             (start_x, start_y), (end_x, end_y) = loc
+            # 全体のリサイズはイベントループ上で行わない
             await self.local_file_driver.save_image(
-                crop_pil(image, (start_x, start_y, end_x, end_y)),
+                await run_blocking(lambda: crop_pil(context.image, (start_x, start_y, end_x, end_y))),
                 os.path.join('tmp', 'get_support_parameters_from_image', 'multi_scale_matching_template.png')
             )
 
@@ -59,108 +88,45 @@ class StatusInteractor(StatusUsecase):
         lo2 = p * 0.5
 
         # パラメータ表示部分のcropped
-        cropped_speed = crop_pil(image, (start_x + p * 0 + lo, end_y, start_x + p * 1 - ro, end_y + h * 1.05))
-        binarized_speed = binarized(cropped_speed, 180)
-        speed = await self.get_parameter_from_image(binarized_speed)
-        if self.debug:
-            await self.local_file_driver.save_image(
-                cropped_speed, os.path.join('tmp', 'get_support_parameters_from_image', 'cropped_speed.png')
-            )
-        cropped_max_speed = crop_pil(image, (start_x + p * 0 + lo2, end_y + h, start_x + p * 1 - ro, end_y + h * 1.9))
-        binarized_max_speed = binarized(cropped_max_speed, 180)
-        max_speed = await self.get_parameter_from_image(binarized_max_speed)
-        if len(max_speed) > 3:
-            max_speed = max_speed[1:]
-        if self.debug:
-            await self.local_file_driver.save_image(
-                cropped_max_speed, os.path.join('tmp', 'get_support_parameters_from_image', 'cropped_max_speed.png')
-            )
-
-        cropped_stamina = crop_pil(image, (start_x + p * 1 + lo, end_y, start_x + p * 2 - ro, end_y + h * 1.05))
-        binarized_stamina = binarized(cropped_stamina, 180)
-        stamina = await self.get_parameter_from_image(binarized_stamina)
-        if self.debug:
-            await self.local_file_driver.save_image(
-                cropped_stamina, os.path.join('tmp', 'get_support_parameters_from_image', 'cropped_stamina.png')
-            )
-        cropped_max_stamina = crop_pil(image, (start_x + p * 1 + lo2, end_y + h, start_x + p * 2 - ro, end_y + h * 1.9))
-        binarized_max_stamina = binarized(cropped_max_stamina, 180)
-        max_stamina = await self.get_parameter_from_image(binarized_max_stamina)
-        if len(max_stamina) > 3:
-            max_stamina = max_stamina[1:]
-        if self.debug:
-            await self.local_file_driver.save_image(
-                cropped_max_stamina, os.path.join('tmp', 'get_support_parameters_from_image', 'cropped_max_stamina.png')
-            )
-
-        cropped_power = crop_pil(image, (start_x + p * 2 + lo, end_y, start_x + p * 3 - ro, end_y + h * 1.05))
-        binarized_power = binarized(cropped_power, 180)
-        power = await self.get_parameter_from_image(binarized_power)
-        if self.debug:
-            await self.local_file_driver.save_image(
-                cropped_power, os.path.join('tmp', 'get_support_parameters_from_image', 'cropped_power.png')
-            )
-        cropped_max_power = crop_pil(image, (start_x + p * 2 + lo2, end_y + h, start_x + p * 3 - ro, end_y + h * 1.9))
-        binarized_max_power = binarized(cropped_max_power, 180)
-        max_power = await self.get_parameter_from_image(binarized_max_power)
-        if len(max_power) > 3:
-            max_power = max_power[1:]
-        if self.debug:
-            await self.local_file_driver.save_image(
-                binarized_max_power, os.path.join('tmp', 'get_support_parameters_from_image', 'cropped_max_power.png')
-            )
-
-        cropped_guts = crop_pil(image, (start_x + p * 3 + lo, end_y, start_x + p * 4 - ro, end_y + h * 1.05))
-        binarized_guts = binarized(cropped_guts, 180)
-        guts = await self.get_parameter_from_image(binarized_guts)
-        if self.debug:
-            await self.local_file_driver.save_image(
-                cropped_guts, os.path.join('tmp', 'get_support_parameters_from_image', 'cropped_guts.png')
-            )
-        cropped_max_guts = crop_pil(image, (start_x + p * 3 + lo2, end_y + h, start_x + p * 4 - ro, end_y + h * 1.9))
-        binarized_max_guts = binarized(cropped_max_guts, 180)
-        max_guts = await self.get_parameter_from_image(binarized_max_guts)
-        if len(max_guts) > 3:
-            max_guts = max_guts[1:]
-        if self.debug:
-            await self.local_file_driver.save_image(
-                cropped_max_guts, os.path.join('tmp', 'get_support_parameters_from_image', 'cropped_max_guts.png')
-            )
+        binarized_images = []
+        for (i, name) in enumerate(PARAMETER_NAMES):
+            cropped = context.crop((start_x + p * i + lo, end_y, start_x + p * (i + 1) - ro, end_y + h * 1.05))
+            binarized_images.append(await run_blocking(cropped.binarized, 180))
+            if self.debug:
+                await self.local_file_driver.save_image(
+                    cropped.image, os.path.join('tmp', 'get_support_parameters_from_image', 'cropped_' + name + '.png')
+                )
+        for (i, name) in enumerate(PARAMETER_NAMES):
+            cropped_max = context.crop((start_x + p * i + lo2, end_y + h, start_x + p * (i + 1) - ro, end_y + h * 1.9))
+            binarized_images.append(await run_blocking(cropped_max.binarized, 180))
+            if self.debug:
+                await self.local_file_driver.save_image(
+                    cropped_max.image, os.path.join('tmp', 'get_support_parameters_from_image', 'cropped_max_' + name + '.png')
+                )
+
+        return binarized_images
+
+    @timed('status.get_parameters_from_image')
+    async def get_parameters_from_image(self, character_detail_image: CharacterDetailImage) -> Parameters:
+        binarized_images = await self.crop_parameter_images(character_detail_image)
+        if binarized_images is None:
+            return Parameters(0, 0, 0, 0, 0)
 
-        cropped_wise = crop_pil(image, (start_x + p * 4 + lo, end_y, start_x + p * 5 - ro, end_y + h * 1.05))
-        binarized_wise = binarized(cropped_wise, 180)
-        wise = await self.get_parameter_from_image(binarized_wise)
-        if self.debug:
-            await self.local_file_driver.save_image(
-                cropped_wise, os.path.join('tmp', 'get_support_parameters_from_image', 'cropped_wise.png')
-            )
-        cropped_max_wise = crop_pil(image, (start_x + p * 4 + lo2, end_y + h, start_x + p * 5 - ro, end_y + h * 1.9))
-        binarized_max_wise = binarized(cropped_max_wise, 180)
-        max_wise = await self.get_parameter_from_image(binarized_max_wise)
-        if len(max_wise) > 3:
-            max_wise = max_wise[1:]
-        if self.debug:
-            await self.local_file_driver.save_image(
-                cropped_max_wise, os.path.join('tmp', 'get_support_parameters_from_image', 'cropped_max_wise.png')
-            )
+        (speed, stamina, power, guts, wise) = await self.get_parameters_from_images(binarized_images)
 
-        return SupportParameters(
-            int(speed),
-            int(stamina),
-            int(power),
-            int(guts),
-            int(wise),
-            int(max_speed),
-            int(max_stamina),
-            int(max_power),
-            int(max_guts),
-            int(max_wise),
+        return Parameters(
+            speed,
+            stamina,
+            power,
+            guts,
+            wise,
         )
 
-    async def get_parameters_from_image(self, character_detail_image: CharacterDetailImage) -> Parameters:
+    async def crop_parameter_images(self, character_detail_image: CharacterDetailImage) -> [Image] or None:
+        # 5項目の値を二値化して、この順に返す。パラメータ枠が見つからなければNone
         if character_detail_image.params_frame_loc is None:
             self.logger.debug('not found params_frame_loc')
-            return Parameters(0, 0, 0, 0, 0)
+            return None
 
         (start_x, start_y), (end_x, end_y) = character_detail_image.params_frame_loc
 
@@ -170,70 +136,49 @@ class StatusInteractor(StatusUsecase):
         lo = p * 0.365
         ro = p * 0.05
 
-        # TODO: 並列化
-        cropped_speed = crop_pil(character_detail_image.image, (start_x + p * 0 + lo, end_y, start_x + p * 1 - ro, end_y + h))
-        binarized_speed = binarized(cropped_speed, 210)
-        speed = await self.get_parameter_from_image(binarized_speed)
-        if self.debug:
-            await self.local_file_driver.save_image(
-                cropped_speed, os.path.join('tmp', 'get_parameters_from_image', 'cropped_speed.png')
-            )
-            await self.local_file_driver.save_image(
-                binarized_speed, os.path.join('tmp', 'get_parameters_from_image', 'binarized_speed.png')
-            )
-
-        cropped_stamina = crop_pil(character_detail_image.image, (start_x + p * 1 + lo, end_y, start_x + p * 2 - ro, end_y + h))
-        binarized_stamina = binarized(cropped_stamina, 210)
-        stamina = await self.get_parameter_from_image(binarized_stamina)
-        if self.debug:
-            await self.local_file_driver.save_image(
-                cropped_stamina, os.path.join('tmp', 'get_parameters_from_image', 'cropped_stamina.png')
-            )
-            await self.local_file_driver.save_image(
-                binarized_stamina, os.path.join('tmp', 'get_parameters_from_image', 'binarized_stamina.png')
-            )
-
-        cropped_power = crop_pil(character_detail_image.image, (start_x + p * 2 + lo, end_y, start_x + p * 3 - ro, end_y + h))
-        binarized_power = binarized(cropped_power, 210)
-        power = await self.get_parameter_from_image(binarized_power)
-        if self.debug:
-            await self.local_file_driver.save_image(
-                cropped_power, os.path.join('tmp', 'get_parameters_from_image', 'cropped_power.png')
-            )
-            await self.local_file_driver.save_image(
-                binarized_power, os.path.join('tmp', 'get_parameters_from_image', 'binarized_power.png')
-            )
-
-        cropped_guts = crop_pil(character_detail_image.image, (start_x + p * 3 + lo, end_y, start_x + p * 4 - ro, end_y + h))
-        binarized_guts = binarized(cropped_guts, 210)
-        guts = await self.get_parameter_from_image(binarized_guts)
-        if self.debug:
-            await self.local_file_driver.save_image(
-                cropped_guts, os.path.join('tmp', 'get_parameters_from_image', 'cropped_guts.png')
-            )
-            await self.local_file_driver.save_image(
-                binarized_guts, os.path.join('tmp', 'get_parameters_from_image', 'binarized_guts.png')
-            )
-
-        cropped_wise = crop_pil(character_detail_image.image, (start_x + p * 4 + lo, end_y, start_x + p * 5 - ro, end_y + h))
-        binarized_wise = binarized(cropped_wise, 210)
-        wise = await self.get_parameter_from_image(binarized_wise)
-        if self.debug:
-            await self.local_file_driver.save_image(
-                cropped_wise, os.path.join('tmp', 'get_parameters_from_image', 'cropped_wise.png')
-            )
-            await self.local_file_driver.save_image(
-                binarized_wise, os.path.join('tmp', 'get_parameters_from_image', 'binarized_wise.png')
-            )
-
-        return Parameters(
-            speed,
-            stamina,
-            power,
-            guts,
-            wise,
-        )
+        binarized_images = []
+        for (i, name) in enumerate(PARAMETER_NAMES):
+            cropped = character_detail_image.context.crop((start_x + p * i + lo, end_y, start_x + p * (i + 1) - ro, end_y + h))
+            binarized_image = await run_blocking(cropped.binarized, 210)
+            binarized_images.append(binarized_image)
+            if self.debug:
+                await self.local_file_driver.save_image(
+                    cropped.image, os.path.join('tmp', 'get_parameters_from_image', 'cropped_' + name + '.png')
+                )
+                await self.local_file_driver.save_image(
+                    binarized_image, os.path.join('tmp', 'get_parameters_from_image', 'binarized_' + name + '.png')
+                )
+
+        return binarized_images
+
+    async def get_parameters_from_images(self, images: [Image]) -> list:
+        values = [None] * len(images)
+
+        # 字形バンクで読めるものはTesseractを使わずに読み取る
+        glyph_fields = await run_blocking(lambda: [glyph_digit_reader.read(image) for image in images])
+        for (i, field) in enumerate(glyph_fields):
+            if field is not None:
+                values[i] = field.text
+
+        # 残りはまとめて1回で読み取り、読み取れなかった項目だけ個別に読み直す
+        indexes = [i for (i, value) in enumerate(values) if value is None]
+        if len(indexes) == 0:
+            return values
+
+        fields = await run_blocking(get_digits_with_single_text_line_and_eng_from_images, [images[i] for i in indexes])
+        for (i, field) in zip(indexes, fields):
+            digit_text = re.sub(self.pattern_digital, '', field.text)
+            self.logger.debug('parameter: {}, confidence: {}'.format(digit_text, field.confidence))
+            if len(digit_text) == 0:
+                values[i] = await self.get_parameter_from_image(images[i])
+                continue
+
+            values[i] = digit_text
+            if glyph_digit_reader.collecting() and field.confidence >= GLYPH_LEARN_CONFIDENCE:
+                await run_blocking(glyph_digit_reader.learn, images[i], digit_text)
+
+        return values
 
     async def get_parameter_from_image(self, image: Image) -> int:
-        digit_text = re.sub(self.pattern_digital, '', get_digit_with_single_text_line_and_eng_from_image(image))
+        digit_text = re.sub(self.pattern_digital, '', await run_blocking(get_digit_with_single_text_line_and_eng_from_image, image))
         return digit_text or 0
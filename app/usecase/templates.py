@@ -0,0 +1,80 @@
+import os
+
+import resources
+from app.library.glyph_digits import GlyphDigitReader
+from app.library.rank_classifier import RankClassifier
+from app.library.template_locator import LayoutPrior, TemplateLocator
+from app.library.template_registry import TemplateRegistry, TemplateSpec
+
+ABILITY_RANK_TEMPLATE_WIDTH = 38
+CHARACTER_RANK_TEMPLATE_WIDTH = 120
+CIRCLE_TEMPLATE_WIDTH = 25
+
+ABILITY_RANK_TEMPLATES = [
+    ['ability/s', 'S'],
+    ['ability/a', 'A'],
+    ['ability/b', 'B'],
+    ['ability/c', 'C'],
+    ['ability/d', 'D'],
+    ['ability/e', 'E'],
+    ['ability/f', 'F'],
+    ['ability/g', 'G'],
+]
+
+CHARACTER_RANK_TEMPLATES = [
+    ['ranks/s_plus', 'S+'],
+    ['ranks/s', 'S'],
+    ['ranks/a_plus', 'A+'],
+    ['ranks/a', 'A'],
+    ['ranks/b_plus', 'B+'],
+    ['ranks/b', 'B'],
+    ['ranks/c_plus', 'C+'],
+    ['ranks/c', 'C'],
+    ['ranks/d_plus', 'D+'],
+    ['ranks/d', 'D'],
+    ['ranks/e_plus', 'E+'],
+    ['ranks/e', 'E'],
+    ['ranks/f_plus', 'F+'],
+    ['ranks/f', 'F'],
+    ['ranks/g_plus', 'G+'],
+]
+
+CIRCLE_TEMPLATES = [
+    ['circles/single', '◯'],
+    ['circles/double', '◎'],
+]
+
+PARAMS_FRAME_TEMPLATE = 'params_frame'
+SKILL_TAB_TEMPLATE = 'skill_tab'
+SKILL_FRAME_TEMPLATE = 'skill_frame'
+SUPPORT_PARAMS_TEMPLATE = 'support_params'
+
+
+def resource_path(*paths):
+    return os.path.join(resources.__path__[0], *paths)
+
+
+template_registry = TemplateRegistry(
+    [TemplateSpec(name, resource_path('template_matching', name + '.png'), ABILITY_RANK_TEMPLATE_WIDTH)
+     for (name, _) in ABILITY_RANK_TEMPLATES] +
+    [TemplateSpec(name, resource_path(name + '.png'), CHARACTER_RANK_TEMPLATE_WIDTH)
+     for (name, _) in CHARACTER_RANK_TEMPLATES] +
+    [TemplateSpec(name, resource_path(name + '.png'), CIRCLE_TEMPLATE_WIDTH)
+     for (name, _) in CIRCLE_TEMPLATES] +
+    [
+        TemplateSpec(PARAMS_FRAME_TEMPLATE, resource_path('template_matching', 'character', 'template_1024.png'), 1024),
+        TemplateSpec(SKILL_TAB_TEMPLATE, resource_path('images', 'ocr_skills', 'template_skill_tab_w_1024.png')),
+        TemplateSpec(SKILL_FRAME_TEMPLATE, resource_path('images', 'ocr_skills', 'template_skill_frame_h_100.png')),
+        TemplateSpec(SUPPORT_PARAMS_TEMPLATE, resource_path('images', 'support_params', 'template.png')),
+    ]
+)
+
+# パラメータ欄はキャラクター詳細画面の中ほど、スキルタブはスキル欄のあたりを切り出した画像の上半分にある
+template_locator = TemplateLocator({
+    PARAMS_FRAME_TEMPLATE: LayoutPrior((0.0, 0.2, 1.0, 0.65)),
+    SKILL_TAB_TEMPLATE: LayoutPrior((0.0, 0.0, 1.0, 0.6)),
+})
+
+ability_rank_classifier = RankClassifier(template_registry, ABILITY_RANK_TEMPLATES)
+
+glyph_digit_reader = GlyphDigitReader()
@@ -0,0 +1,261 @@
+import asyncio
+import functools
+import json
+import zipfile
+from logging import getLogger
+
+from aiohttp import web
+
+from app.library.executor import run_blocking
+from app.library.job_queue import JobQueueFull
+from app.library.metrics import Timings, generate_metrics
+from app.views.api import JOB_RETRY_AFTER, APIResource, get_batch_items, open_image, with_timings
+
+logger = getLogger(__name__)
+
+
+class AioAPIResource:
+    # aiohttpのイベントループ上でリクエストを受け、読み取りはAPIResourceのコルーチンをそのまま使う
+    # CV・OCRの重い処理は共有のワーカープールで行い、同時に読み取る画像の数はmax_concurrencyで抑える
+    api_resource: APIResource
+
+    def __init__(self, api_resource: APIResource, *, max_concurrency: int, max_content_length: int,
+                 max_batch_content_length: int):
+        self.api_resource = api_resource
+        self.max_concurrency = max_concurrency
+        self.max_content_length = max_content_length
+        self.max_batch_content_length = max_batch_content_length
+        self.semaphore = None
+        self.ready = False
+
+    async def on_startup(self, _: web.Application):
+        # fork後のプロセスでもジョブのワーカーを起動してから受け付ける
+        # ワーカープールのスレッドもこのプロセスで作っておく
+        self.api_resource.job_worker_pool.start()
+        await run_blocking(lambda: None)
+        self.ready = True
+
+    async def on_shutdown(self, _: web.Application):
+        self.ready = False
+
+    async def get_ready(self, _: web.Request) -> web.Response:
+        # 起動が終わっていて、ジョブのワーカーが動いていて、待ち行列に届く場合だけ受け付けられる
+        if not self.ready:
+            return web.json_response({'result': 'not ready'}, status=503)
+
+        job_worker_pool = self.api_resource.job_worker_pool
+        if not job_worker_pool.alive():
+            return web.json_response({'result': 'job workers are not running'}, status=503)
+        try:
+            await run_blocking(job_worker_pool.job_queue.depth)
+        except Exception:
+            logger.exception('failed to reach the job queue')
+            return web.json_response({'result': 'job queue is unavailable'}, status=503)
+
+        return web.json_response({'result': 'OK'}, status=200)
+
+    def bounded(self, get_data):
+        async def get_bounded_data(image):
+            # Semaphoreは作成時のイベントループに紐づくので、最初のリクエストで作る
+            if self.semaphore is None:
+                self.semaphore = asyncio.Semaphore(self.max_concurrency)
+            async with self.semaphore:
+                return await get_data(image)
+
+        return get_bounded_data
+
+    async def post_ocr_status(self, request: web.Request) -> web.Response:
+        return await self.post_ocr(request, self.api_resource.get_status_data)
+
+    async def post_ocr_support_params(self, request: web.Request) -> web.Response:
+        return await self.post_ocr(request, self.api_resource.get_support_params_data)
+
+    async def post_ocr(self, request: web.Request, get_data) -> web.Response:
+        try:
+            fields = await read_multipart(request, self.max_content_length)
+        except UploadTooLarge:
+            return web.json_response({'result': 'file is too large'}, status=413)
+
+        file = next(((filename, data) for (name, filename, data) in fields if name == 'file'), None)
+        if file is None:
+            return web.json_response({'result': 'file is required'}, status=400)
+        (filename, data) = file
+        if filename == '':
+            return web.json_response({'result': 'filename must not empty'}, status=400)
+
+        try:
+            image = await run_blocking(open_image, functools.partial(bytes, data))
+        except ValueError as e:
+            return web.json_response({'result': str(e)}, status=400)
+        except OSError:
+            return web.json_response({'result': 'cannot identify image file'}, status=400)
+
+        timings = Timings() if request.query.get('timings') in ('1', 'true') else None
+        data = await self.bounded(functools.partial(get_data, timings=timings))(image)
+
+        return web.json_response(with_timings({'result': 'OK', 'data': data}, timings), status=200)
+
+    async def post_ocr_status_batch(self, request: web.Request) -> web.StreamResponse:
+        return await self.post_ocr_batch(request, self.api_resource.get_status_data)
+
+    async def post_ocr_support_params_batch(self, request: web.Request) -> web.StreamResponse:
+        return await self.post_ocr_batch(request, self.api_resource.get_support_params_data)
+
+    async def post_ocr_batch(self, request: web.Request, get_data) -> web.StreamResponse:
+        try:
+            (files, archive) = await get_uploads(request, self.max_batch_content_length)
+        except UploadTooLarge:
+            return web.json_response({'result': 'file is too large'}, status=413)
+
+        try:
+            items = get_batch_items(files, archive, self.max_content_length)
+        except zipfile.BadZipFile:
+            return web.json_response({'result': 'archive must be a zip file'}, status=400)
+
+        if len(items) == 0:
+            return web.json_response({'result': 'files or archive is required'}, status=400)
+        if len(items) > self.api_resource.max_batch_size:
+            return web.json_response(
+                {'result': 'too many files (max {})'.format(self.api_resource.max_batch_size)}, status=400)
+
+        if request.query.get('stream') in ('1', 'true'):
+            return await self.stream_batch_data(request, items, self.bounded(get_data))
+
+        data = await self.api_resource.get_batch_data(items, self.bounded(get_data))
+
+        return web.json_response({'result': 'OK', 'data': data}, status=200)
+
+    async def stream_batch_data(self, request: web.Request, items: [(str, callable)], get_data) -> web.StreamResponse:
+        # 読み取りが終わった画像から順に1行ずつJSONを返す
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(request)
+
+        item_data_queue = asyncio.Queue()
+        task = asyncio.create_task(
+            self.api_resource.get_batch_data(items, get_data, on_item=item_data_queue.put_nowait))
+        task.add_done_callback(lambda _: item_data_queue.put_nowait(None))
+        try:
+            for _ in range(len(items)):
+                item_data = await item_data_queue.get()
+                if item_data is None:
+                    break
+                await response.write((json.dumps(item_data) + '\n').encode())
+
+            # ヘッダーを送った後はステータスコードで失敗を返せないので、最後の行で知らせる
+            await asyncio.wait([task])
+            if task.cancelled() or task.exception() is not None:
+                logger.error('failed to read batch', exc_info=None if task.cancelled() else task.exception())
+                await response.write((json.dumps({'result': 'failed to read images'}) + '\n').encode())
+        finally:
+            # クライアントが途中で切断した場合は残りの読み取りを止める
+            task.cancel()
+
+        await response.write_eof()
+        return response
+
+    async def post_ocr_status_job(self, request: web.Request) -> web.Response:
+        return await self.post_ocr_job(request, 'status')
+
+    async def post_ocr_support_params_job(self, request: web.Request) -> web.Response:
+        return await self.post_ocr_job(request, 'support_params')
+
+    async def post_ocr_job(self, request: web.Request, endpoint: str) -> web.Response:
+        try:
+            (files, archive) = await get_uploads(request, self.max_batch_content_length)
+        except UploadTooLarge:
+            return web.json_response({'result': 'file is too large'}, status=413)
+
+        try:
+            items = get_batch_items(files, archive, self.max_content_length)
+        except zipfile.BadZipFile:
+            return web.json_response({'result': 'archive must be a zip file'}, status=400)
+
+        if len(items) == 0:
+            return web.json_response({'result': 'file, files or archive is required'}, status=400)
+        if len(items) > self.api_resource.max_batch_size:
+            return web.json_response(
+                {'result': 'too many files (max {})'.format(self.api_resource.max_batch_size)}, status=400)
+
+        payload = {'files': files, 'archive': archive, 'max_content_length': self.max_content_length}
+        # Redisの待ち行列への登録はブロックするのでワーカープールで行う
+        try:
+            job = await run_blocking(self.api_resource.job_worker_pool.submit, endpoint, payload, len(items))
+        except JobQueueFull:
+            return web.json_response({'result': 'job queue is full'}, status=503,
+                                     headers={'Retry-After': JOB_RETRY_AFTER})
+
+        return web.json_response({'result': 'OK', 'data': job.to_dict()}, status=202)
+
+    async def get_job(self, request: web.Request) -> web.Response:
+        job = await run_blocking(self.api_resource.job_worker_pool.get, request.match_info['job_id'])
+        if job is None:
+            return web.json_response({'result': 'job not found'}, status=404)
+
+        return web.json_response({'result': 'OK', 'data': job.to_dict()}, status=200)
+
+    async def get_template_stats(self, _: web.Request) -> web.Response:
+        stats = self.api_resource.template_registry.stats()
+
+        return web.json_response({'result': 'OK', 'data': stats.to_dict()}, status=200)
+
+    async def get_result_cache_stats(self, _: web.Request) -> web.Response:
+        stats = self.api_resource.result_cache.stats()
+
+        return web.json_response({'result': 'OK', 'data': stats.to_dict()}, status=200)
+
+    async def get_job_stats(self, _: web.Request) -> web.Response:
+        stats = await run_blocking(self.api_resource.job_worker_pool.stats)
+
+        return web.json_response({'result': 'OK', 'data': stats.to_dict()}, status=200)
+
+    async def get_metrics(self, _: web.Request) -> web.Response:
+        # 待ち行列の長さをRedisに問い合わせることがあるのでワーカープールで実行する
+        (body, content_type) = await run_blocking(generate_metrics)
+
+        # aiohttpはcharsetを含むContent-Typeをcontent_typeに渡せないのでヘッダーで指定する
+        return web.Response(body=body, headers={'Content-Type': content_type})
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+async def read_multipart(request: web.Request, max_size: int) -> [(str, str, bytes)]:
+    # Content-Lengthのないチャンク形式でも上限を超えた時点で読むのをやめるよう、読みながら大きさを確かめる
+    # client_max_size はアプリ全体で1つなので、エンドポイントごとの上限はここで確かめる
+    if request.content_length is not None and request.content_length > max_size:
+        raise UploadTooLarge()
+    if request.content_type != 'multipart/form-data':
+        return []
+
+    fields = []
+    size = 0
+    reader = await request.multipart()
+    while True:
+        part = await reader.next()
+        if part is None:
+            break
+        if part.filename is None:
+            await part.release()
+            continue
+
+        data = bytearray()
+        while True:
+            chunk = await part.read_chunk()
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_size:
+                raise UploadTooLarge()
+            data.extend(chunk)
+        fields.append((part.name, part.filename, bytes(data)))
+
+    return fields
+
+
+async def get_uploads(request: web.Request, max_size: int) -> ([(str, bytes)], bytes or None):
+    # Flask版の get_uploads と同じく file・files・archive を受け付け、内容をここで読み込んでおく
+    fields = await read_multipart(request, max_size)
+    files = [(filename, data) for (name, filename, data) in fields if name in ('file', 'files')]
+    archive = next((data for (name, _, data) in fields if name == 'archive'), None)
+    return files, archive
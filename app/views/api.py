@@ -1,7 +1,13 @@
 import asyncio
-import imghdr
+import functools
+import io
+import json
+import queue
+import time
+import zipfile
+from logging import getLogger
 
-from flask import jsonify, make_response, request
+from flask import Request, Response, current_app, jsonify, make_response, request, stream_with_context
 from PIL import Image
 
 from app.interface.usecase.appropriate import AppropriateUsecase
@@ -9,33 +15,68 @@ from app.interface.usecase.character import CharacterUsecase
 from app.interface.usecase.skill_usecase import SkillUsecase
 from app.interface.usecase.status_usecase import StatusUsecase
 from app.interface.usecase.image import ImageUsecase
-from app.domain.image import CharacterDetailImage
+from app.domain.image import ImageContext
+from app.library.executor import run_blocking, run_coroutine, submit_coroutine
+from app.library.job_queue import JobQueueFull, JobWorkerPool
+from app.library.metrics import Timings, generate_metrics, request_stage, stage, timed
+from app.library.result_cache import ResultCache
+from app.library.template_registry import TemplateRegistry
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+# 待ち行列が上限に達したとき、投入し直すまでに待ってほしい秒数
+JOB_RETRY_AFTER = '5'
+
+logger = getLogger(__name__)
 
 
 def allowed_file(format: str):
     return format.lower() in ALLOWED_EXTENSIONS
 
 
+class APIRequest(Request):
+    # バッチとジョブのエンドポイントは複数枚の画像を受け付けるので、リクエストサイズの上限を別に設定する
+    @property
+    def max_content_length(self):
+        if self.path.endswith(':batch') or self.path.startswith('/api/v1/jobs/'):
+            return current_app.config['MAX_BATCH_CONTENT_LENGTH']
+        return current_app.config['MAX_CONTENT_LENGTH']
+
+
 class APIResource:
     character_usecase: CharacterUsecase
     status_usecase: StatusUsecase
     ability_usecase: AppropriateUsecase
     skill_usecase: SkillUsecase
     image_usecase: ImageUsecase
+    template_registry: TemplateRegistry
+    result_cache: ResultCache
+    job_worker_pool: JobWorkerPool
 
     def __init__(self,
                  status_usecase: StatusUsecase,
                  character_usecase: CharacterUsecase,
                  ability_usecase: AppropriateUsecase,
                  skill_usecase: SkillUsecase,
-                 image_usecase: ImageUsecase):
+                 image_usecase: ImageUsecase,
+                 template_registry: TemplateRegistry,
+                 result_cache: ResultCache,
+                 job_worker_pool: JobWorkerPool,
+                 *,
+                 batch_concurrency=1,
+                 max_batch_size=100):
         self.status_usecase = status_usecase
         self.character_usecase = character_usecase
         self.ability_usecase = ability_usecase
         self.skill_usecase = skill_usecase
         self.image_usecase = image_usecase
+        self.template_registry = template_registry
+        self.result_cache = result_cache
+        self.job_worker_pool = job_worker_pool
+        self.job_worker_pool.register('status', functools.partial(self.run_batch_job, get_data=self.get_status_data))
+        self.job_worker_pool.register('support_params',
+                                      functools.partial(self.run_batch_job, get_data=self.get_support_params_data))
+        self.batch_concurrency = batch_concurrency
+        self.max_batch_size = max_batch_size
 
     def post_ocr_status(self):
         if 'file' not in request.files:
@@ -50,15 +91,110 @@ class APIResource:
         if not allowed_file(image.format):
             return make_response(
                 jsonify({'result': 'support extension jpg, jpeg or png'}), 400)
+        with stage('decode'):
+            image.load()
+
+        timings = Timings() if request.args.get('timings') in ('1', 'true') else None
+        data = run_coroutine(self.get_status_data(image, timings=timings))
+
+        return make_response(jsonify(with_timings({'result': 'OK', 'data': data}, timings)), 200)
+
+    def post_ocr_support_params(self):
+        if 'file' not in request.files:
+            return make_response(jsonify({'result': 'file is required'}), 400)
+
+        file = request.files['file']
+        if file.filename == '':
+            return make_response(
+                jsonify({'result': 'filename must not empty'}), 400)
+
+        image = Image.open(file.stream)
+        if not allowed_file(image.format):
+            return make_response(
+                jsonify({'result': 'support extension jpg, jpeg or png'}), 400)
+        with stage('decode'):
+            image.load()
+
+        timings = Timings() if request.args.get('timings') in ('1', 'true') else None
+        data = run_coroutine(self.get_support_params_data(image, timings=timings))
+
+        return make_response(jsonify(with_timings({'result': 'OK', 'data': data}, timings)), 200)
+
+    def post_ocr_status_batch(self):
+        return self.post_ocr_batch(self.get_status_data)
 
-        character_detail_image = asyncio.run(self.image_usecase.create_character_detail_image(image))
+    def post_ocr_support_params_batch(self):
+        return self.post_ocr_batch(self.get_support_params_data)
+
+    def post_ocr_batch(self, get_data):
+        (files, archive) = get_uploads()
+        try:
+            items = get_batch_items(files, archive, current_app.config['MAX_CONTENT_LENGTH'])
+        except zipfile.BadZipFile:
+            return make_response(jsonify({'result': 'archive must be a zip file'}), 400)
+
+        if len(items) == 0:
+            return make_response(jsonify({'result': 'files or archive is required'}), 400)
+        if len(items) > self.max_batch_size:
+            return make_response(
+                jsonify({'result': 'too many files (max {})'.format(self.max_batch_size)}), 400)
+
+        if request.args.get('stream') in ('1', 'true'):
+            return Response(stream_with_context(self.stream_batch_data(items, get_data)),
+                            mimetype='application/x-ndjson')
+
+        data = run_coroutine(self.get_batch_data(items, get_data))
+
+        return make_response(jsonify({'result': 'OK', 'data': data}), 200)
+
+    async def get_batch_data(self, items: [(str, callable)], get_data, on_item=None) -> [dict]:
+        # 画像のデコードと読み取りはワーカープールで並行して行い、結果は送られてきた順に返す
+        semaphore = asyncio.Semaphore(self.batch_concurrency)
+
+        async def get_item_data(index: int, filename: str, read):
+            async with semaphore:
+                item_data = await get_batch_item_data(index, filename, read, get_data)
+            if on_item is not None:
+                on_item(item_data)
+            return item_data
+
+        return await asyncio.gather(*(get_item_data(i, filename, read) for (i, (filename, read)) in enumerate(items)))
+
+    def stream_batch_data(self, items: [(str, callable)], get_data):
+        # 読み取りが終わった画像から順に1行ずつJSONを返す（順序は完了順なのでindexで対応付ける）
+        item_data_queue = queue.Queue()
+        future = submit_coroutine(self.get_batch_data(items, get_data, on_item=item_data_queue.put))
+        # 全件そろう前に失敗した場合も待ち続けないよう、終了を知らせる
+        future.add_done_callback(lambda _: item_data_queue.put(None))
+        try:
+            for _ in range(len(items)):
+                item_data = item_data_queue.get()
+                if item_data is None:
+                    break
+                yield json.dumps(item_data) + '\n'
+
+            # ヘッダーを送った後はステータスコードで失敗を返せないので、最後の行で知らせる
+            if future.cancelled() or future.exception() is not None:
+                logger.error('failed to read batch', exc_info=None if future.cancelled() else future.exception())
+                yield json.dumps({'result': 'failed to read images'}) + '\n'
+        finally:
+            # クライアントが途中で切断した場合は残りの読み取りを止める
+            future.cancel()
+
+    async def get_status_data(self, image: Image, *, timings: Timings = None) -> dict:
+        # リサイズ・グレースケール化・二値化はリクエスト内で一度だけ行い、全ユースケースで共有する
+        context = ImageContext(image)
 
         async def get_data():
+            # スキルの読み取りはパラメータ枠の位置に依存しないので先に始めておく
+            character_skills_task = asyncio.create_task(
+                self.skill_usecase.get_character_skills_from_character_modal_image(context))
+            character_detail_image = await self.image_usecase.create_character_detail_image(context)
             tasks = [
                 asyncio.create_task(self.character_usecase.get_character_from_image(character_detail_image)),
                 asyncio.create_task(self.character_usecase.get_character_rank_from_image(character_detail_image)),
                 asyncio.create_task(self.status_usecase.get_parameters_from_image(character_detail_image)),
-                asyncio.create_task(self.skill_usecase.get_character_skills_from_character_modal_image(image)),
+                character_skills_task,
                 asyncio.create_task(self.ability_usecase.get_character_appropriate_fields_from_image(character_detail_image)),
                 asyncio.create_task(self.ability_usecase.get_character_appropriate_distances_from_image(character_detail_image)),
                 asyncio.create_task(self.ability_usecase.get_character_appropriate_strategies_from_image(character_detail_image)),
@@ -81,28 +217,16 @@ class APIResource:
                 }
             }
 
-        data = asyncio.run(get_data())
+        with request_stage('api.status', timings=timings):
+            return await self.result_cache.get_or_create('status', image, get_data)
 
-        return make_response(jsonify({'result': 'OK', 'data': data}), 200)
-
-    def post_ocr_support_params(self):
-        if 'file' not in request.files:
-            return make_response(jsonify({'result': 'file is required'}), 400)
-
-        file = request.files['file']
-        if file.filename == '':
-            return make_response(
-                jsonify({'result': 'filename must not empty'}), 400)
-
-        image = Image.open(file.stream)
-        if not allowed_file(image.format):
-            return make_response(
-                jsonify({'result': 'support extension jpg, jpeg or png'}), 400)
+    async def get_support_params_data(self, image: Image, *, timings: Timings = None) -> dict:
+        context = ImageContext(image)
 
         async def get_data():
             tasks = [
-                asyncio.create_task(self.status_usecase.get_support_parameters_from_image(image)),
-                asyncio.create_task(self.character_usecase.get_character_name_from_support_image(image)),
+                asyncio.create_task(self.status_usecase.get_support_parameters_from_image(context)),
+                asyncio.create_task(self.character_usecase.get_character_name_from_support_image(context)),
             ]
             results = await asyncio.gather(*tasks)
 
@@ -113,6 +237,144 @@ class APIResource:
                 'params': support_params.to_dict(),
             }
 
-        data = asyncio.run(get_data())
+        with request_stage('api.support_params', timings=timings):
+            return await self.result_cache.get_or_create('support_params', image, get_data)
+
+    def post_ocr_status_job(self):
+        return self.post_ocr_job('status')
+
+    def post_ocr_support_params_job(self):
+        return self.post_ocr_job('support_params')
+
+    def post_ocr_job(self, endpoint: str):
+        # 受け付けたらすぐにジョブIDを返し、読み取りはジョブのワーカーで行う
+        (files, archive) = get_uploads()
+        max_content_length = current_app.config['MAX_CONTENT_LENGTH']
+        try:
+            items = get_batch_items(files, archive, max_content_length)
+        except zipfile.BadZipFile:
+            return make_response(jsonify({'result': 'archive must be a zip file'}), 400)
+
+        if len(items) == 0:
+            return make_response(jsonify({'result': 'file, files or archive is required'}), 400)
+        if len(items) > self.max_batch_size:
+            return make_response(
+                jsonify({'result': 'too many files (max {})'.format(self.max_batch_size)}), 400)
+
+        payload = {'files': files, 'archive': archive, 'max_content_length': max_content_length}
+        try:
+            job = self.job_worker_pool.submit(endpoint, payload, len(items))
+        except JobQueueFull:
+            return make_response(jsonify({'result': 'job queue is full'}), 503, {'Retry-After': JOB_RETRY_AFTER})
+
+        return make_response(jsonify({'result': 'OK', 'data': job.to_dict()}), 202)
+
+    def get_job(self, job_id: str):
+        job = self.job_worker_pool.get(job_id)
+        if job is None:
+            return make_response(jsonify({'result': 'job not found'}), 404)
+
+        return make_response(jsonify({'result': 'OK', 'data': job.to_dict()}), 200)
+
+    async def run_batch_job(self, payload: dict, on_progress, *, get_data) -> [dict]:
+        items = get_batch_items(payload['files'], payload['archive'], payload['max_content_length'])
+        return await self.get_batch_data(items, get_data, on_item=on_progress)
+
+    def get_template_stats(self):
+        stats = self.template_registry.stats()
+
+        return make_response(jsonify({'result': 'OK', 'data': stats.to_dict()}), 200)
+
+    def get_result_cache_stats(self):
+        stats = self.result_cache.stats()
+
+        return make_response(jsonify({'result': 'OK', 'data': stats.to_dict()}), 200)
+
+    def get_job_stats(self):
+        stats = self.job_worker_pool.stats()
+
+        return make_response(jsonify({'result': 'OK', 'data': stats.to_dict()}), 200)
+
+    def get_metrics(self):
+        (body, content_type) = generate_metrics()
+
+        return Response(body, content_type=content_type)
+
+
+def with_timings(body: dict, timings: Timings or None) -> dict:
+    if timings is not None:
+        body['timings'] = timings.to_list()
+    return body
+
+
+def get_uploads() -> ([(str, bytes)], bytes or None):
+    # multipartで送られた file・files と、zipでまとめて送られた archive のどちらも受け付ける
+    # ストリーミングやジョブで後から読めるよう、アップロードされたファイルの内容はここで読み込んでおく
+    files = [(file.filename, file.read()) for file in request.files.getlist('file') + request.files.getlist('files')]
+    archive = request.files['archive'].read() if 'archive' in request.files else None
+    return files, archive
+
+
+def get_batch_items(files: [(str, bytes)], archive: bytes or None, max_content_length: int) -> [(str, callable)]:
+    # 1枚ごとの大きさは単体のエンドポイントと同じ上限で確かめ、超えた画像はその画像だけを失敗にする
+    items = [(filename, functools.partial(read_file, data, max_content_length)) for (filename, data) in files]
+
+    if archive is not None:
+        archive = zipfile.ZipFile(io.BytesIO(archive))
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            items.append((info.filename, functools.partial(read_archive_member, archive, info, max_content_length)))
+
+    return items
+
+
+def read_file(data: bytes, max_content_length: int) -> bytes:
+    if max_content_length is not None and len(data) > max_content_length:
+        raise ValueError('file is too large')
+    return data
+
+
+def read_archive_member(archive: zipfile.ZipFile, info: zipfile.ZipInfo, max_content_length: int) -> bytes:
+    if max_content_length is not None and info.file_size > max_content_length:
+        raise ValueError('file is too large')
+    return archive.read(info)
+
+
+@timed('decode')
+def open_image(read) -> Image:
+    image = Image.open(io.BytesIO(read()))
+    if not allowed_file(image.format):
+        raise ValueError('support extension jpg, jpeg or png')
+    image.load()
+    return image
+
+
+async def get_batch_item_data(index: int, filename: str, read, get_data) -> dict:
+    start = time.perf_counter()
+
+    def item_data(result: str, data=None) -> dict:
+        item = {
+            'index': index,
+            'filename': filename,
+            'result': result,
+            'elapsed_ms': round((time.perf_counter() - start) * 1000, 1),
+        }
+        if data is not None:
+            item['data'] = data
+        return item
+
+    try:
+        image = await run_blocking(open_image, read)
+    except ValueError as e:
+        return item_data(str(e))
+    except OSError:
+        return item_data('cannot identify image file')
+
+    try:
+        data = await get_data(image)
+    except Exception:
+        logger.exception('failed to read image: %s', filename)
+        return item_data('failed to read image')
 
-        return make_response(jsonify({'result': 'OK', 'data': data}), 200)
\ No newline at end of file
+    return item_data('OK', data)
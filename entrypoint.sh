@@ -1 +1,13 @@
-flask run --debugger --reload -h ${HOST-"0.0.0.0"} -p ${PORT-8080} --with-threads
\ No newline at end of file
+case "${SERVER_MODE}" in
+  aio)
+    exec python -m app.aio
+    ;;
+  prefork)
+    # 子プロセスごとのヒストグラム・カウンターを/metricsで合算する
+    export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR-/tmp/umaocr_metrics}
+    exec python -m app.prefork
+    ;;
+  *)
+    flask run --debugger --reload -h ${HOST-"0.0.0.0"} -p ${PORT-8080} --with-threads
+    ;;
+esac
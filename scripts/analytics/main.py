@@ -1,111 +1,140 @@
-import asyncio
+# samples/<id>/ 以下の画像をまとめて読み取り、結果を1行1件のJSON（NDJSON）で書き出す
+# 中断しても同じ --output を指定して実行し直せば、読み取れた画像は飛ばして続きと失敗した画像を読み取る
+#
+#   python -m scripts.analytics.main --samples-dir ./samples --output analytics.ndjson --processes 4
+import argparse
+import json
 import logging
 import os
-
+import time
 from multiprocessing import Pool
+
+import numpy as np
 from PIL import Image
 
-from app.driver.file_driver import LocalFileDriverImpl
-from app.usecase.ability import AbilityInteractor
-from app.usecase.character import CharacterInteractor
-from app.usecase.skill_interactor import SkillInteractor
-from app.usecase.status_interactor import StatusInteractor
-from app.usecase.image import ImageInteractor
-from app.views.api import APIResource
-from app.library.pillow import resize_pil
-from app.usecase.const import INPUT_IMAGE_WIDTH
-
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger()
-
-status_usecase = StatusInteractor(
-    LocalFileDriverImpl(''),
-    logger,
-)
-character_usecase = CharacterInteractor(
-    LocalFileDriverImpl(''),
-    logger,
-)
-ability_usecase = AbilityInteractor(
-    LocalFileDriverImpl(''),
-    logger,
-)
-skill_usecase = SkillInteractor(
-    LocalFileDriverImpl(''),
-    logger,
-)
-image_usecase = ImageInteractor(
-    LocalFileDriverImpl(''),
-    logger,
-)
-
-def get_samples_ids():
-    return os.listdir(path='./samples')
-
-def get_sample_paths_from_id(id):
-    file_names = os.listdir(path=f'./samples/{id}')
-    file_names = sorted(file_names)
+from app import create_api_resource
+from app.aio import load_config
+from app.library.executor import run_coroutine, worker_pool
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+logger = logging.getLogger(__name__)
+
+# 子プロセスごとに一度だけ作る
+api_resource = None
+
+
+def init_worker(threads: int):
+    # テンプレート・マスターデータ・OCRエンジンは子プロセスの起動時に読み込み、全画像で使い回す
+    global api_resource
+    logging.basicConfig(level=logging.WARNING)
+    worker_pool.max_workers = threads
+    api_resource = create_api_resource(load_config(), logger, debug=False)
+
+
+def get_status(path: str) -> dict:
+    start = time.perf_counter()
+    record = {'path': path}
+    try:
+        with Image.open(path) as image:
+            image.load()
+            record['data'] = run_coroutine(api_resource.get_status_data(image))
+        record['result'] = 'OK'
+    except Exception as e:
+        logger.exception('failed to read %s', path)
+        record['result'] = 'failed to read image'
+        record['error'] = repr(e)
+    record['elapsed_ms'] = round((time.perf_counter() - start) * 1000, 1)
+    return record
+
+
+def get_sample_paths(samples_dir: str) -> [str]:
     paths = []
-    for file_name in file_names:
-        paths.append(f'./samples/{id}/{file_name}')
+    for id in sorted(os.listdir(samples_dir)):
+        sample_dir = os.path.join(samples_dir, id)
+        if not os.path.isdir(sample_dir):
+            continue
+        for file_name in sorted(os.listdir(sample_dir)):
+            if os.path.splitext(file_name)[1].lower() in IMAGE_EXTENSIONS:
+                paths.append(os.path.join(sample_dir, file_name))
     return paths
 
-def get_chunks(lst, n):
-    """Yield successive n-sized chunks from lst."""
-    for i in range(0, len(lst), n):
-        yield lst[i:i + n]
-
-def get_status(path):
-    image = Image.open(path)
-    character_detail_image = asyncio.run(image_usecase.create_character_detail_image(image))
-
-    async def get_data():
-        tasks = [
-            asyncio.create_task(character_usecase.get_character_from_image(character_detail_image)),
-            asyncio.create_task(character_usecase.get_character_rank_from_image(character_detail_image)),
-            asyncio.create_task(status_usecase.get_parameters_from_image(character_detail_image)),
-            asyncio.create_task(skill_usecase.get_character_skills_from_character_modal_image(image)),
-            asyncio.create_task(ability_usecase.get_character_appropriate_fields_from_image(character_detail_image)),
-            asyncio.create_task(ability_usecase.get_character_appropriate_distances_from_image(character_detail_image)),
-            asyncio.create_task(ability_usecase.get_character_appropriate_strategies_from_image(character_detail_image)),
-        ]
-        results = await asyncio.gather(*tasks)
-
-        character, character_rank, parameters, character_skills, ability_fields, ability_distances, ability_strategies = results
-        character_skills_dict = character_skills.to_dict()
-        return {
-            'character': character.name,
-            'nickname': character.nickname,
-            'rank': character_rank,
-            'params': parameters.to_dict(),
-            'unique_skill': character_skills_dict['unique_skill'],
-            'skills': character_skills_dict['normal_skills'],
-            'abilities': {
-                'fields': ability_fields.to_dict(),
-                'distances': ability_distances.to_dict(),
-                'strategies': ability_strategies.to_dict(),
-            }
-        }
-
-    return asyncio.run(get_data())
 
-def main():
-    concurrency_count = 1
-    chunks_num = 1
+def load_checkpoint(output: str) -> set:
+    # 読み取れた画像のパスを返す。書き込み途中で中断した最後の行は切り詰めてから追記する
+    # 失敗した画像は読み直して新しい行を追記するので、同じパスの行が複数ある場合は後の行が新しい結果
+    if not os.path.exists(output):
+        return set()
 
-    ids = get_samples_ids()
-    chunk_ids = list(get_chunks(ids, chunks_num))
+    with open(output, 'rb+') as f:
+        content = f.read()
+        end = content.rfind(b'\n') + 1
+        if end != len(content):
+            f.truncate(end)
 
-    chunks_index = 0
-    for ids in chunk_ids:
-        chunks_index += 1
-        print(f'chunks: {chunks_index}/{len(chunk_ids)}')
+    done = set()
+    for line in content[:end].splitlines():
+        try:
+            record = json.loads(line)
+            if record['result'] == 'OK':
+                done.add(record['path'])
+        except (ValueError, KeyError, TypeError):
+            continue
+    return done
 
-        paths = []
-        for id in ids:
-            paths.extend(get_sample_paths_from_id(id))
-        with Pool(processes=concurrency_count) as p:
-            result_list = p.map(func=get_status, iterable=paths)
-        print(result_list)
 
-main()
\ No newline at end of file
+def main():
+    parser = argparse.ArgumentParser(description='Read status screenshots under samples/ in parallel.')
+    parser.add_argument('--samples-dir', default='./samples')
+    parser.add_argument('--output', default='analytics.ndjson', help='NDJSON file to append results to')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--threads', type=int, default=None,
+                        help='worker threads per process (default: cpu count / processes)')
+    parser.add_argument('--chunksize', type=int, default=1)
+    parser.add_argument('--progress-interval', type=int, default=10, help='log progress every N images')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    threads = args.threads or max((os.cpu_count() or 1) // args.processes, 1)
+
+    paths = get_sample_paths(args.samples_dir)
+    done = load_checkpoint(args.output)
+    pending = [path for path in paths if path not in done]
+    logger.info('%d images, %d already done, %d to read with %d processes x %d threads',
+                len(paths), len(paths) - len(pending), len(pending), args.processes, threads)
+
+    start = time.perf_counter()
+    elapsed_ms = []
+    failed = 0
+    with Pool(processes=args.processes, initializer=init_worker, initargs=(threads,)) as pool, \
+            open(args.output, 'a', encoding='utf-8') as f:
+        # 終わった順に書き出すので、中断しても読み取り済みの結果は残る
+        for (i, record) in enumerate(pool.imap_unordered(get_status, pending, chunksize=args.chunksize), 1):
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            f.flush()
+
+            elapsed_ms.append(record['elapsed_ms'])
+            if record['result'] != 'OK':
+                failed += 1
+            if i % args.progress_interval == 0 or i == len(pending):
+                rate = i / (time.perf_counter() - start)
+                logger.info('%d/%d images (%.2f images/s, ETA %.0fs)', i, len(pending), rate,
+                            (len(pending) - i) / rate)
+
+    wall_seconds = time.perf_counter() - start
+    print(json.dumps({
+        'images': len(elapsed_ms),
+        'skipped': len(paths) - len(pending),
+        'failed': failed,
+        'wall_seconds': round(wall_seconds, 1),
+        'images_per_second': round(len(elapsed_ms) / wall_seconds, 2) if wall_seconds > 0 else None,
+        'latency_ms': {
+            'mean': round(float(np.mean(elapsed_ms)), 1),
+            'p50': round(float(np.percentile(elapsed_ms, 50)), 1),
+            'p90': round(float(np.percentile(elapsed_ms, 90)), 1),
+        } if len(elapsed_ms) > 0 else None,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+# cv2.matchTemplate とDFTによる正規化相互相関の速度を、画像とテンプレートの大きさごとに計測する
+# DFTの方が速くなる演算量の比（crossover）を求め、CORRELATION_FFT_CROSSOVER に設定する値として出力する
+#
+#   python -m scripts.benchmark.correlation --repeat 5 --output correlation.json
+import argparse
+import json
+import time
+
+import cv2
+import numpy as np
+
+from app.library.matching_template import CORRELATION_FFT, CorrelationBackend, cost_ratio, resize
+from app.usecase.templates import (PARAMS_FRAME_TEMPLATE, SKILL_FRAME_TEMPLATE, SKILL_TAB_TEMPLATE,
+                                   SUPPORT_PARAMS_TEMPLATE, template_registry)
+
+# 各テンプレートを実際に探索する画像の大きさとスケール
+PIPELINE_CASES = [
+    (PARAMS_FRAME_TEMPLATE, (1820, 1024), np.linspace(1.1, 1.5, 10)),
+    (SKILL_TAB_TEMPLATE, (1001, 1024), np.linspace(1.1, 1.5, 3)),
+    (SKILL_FRAME_TEMPLATE, (1060, 1024), np.linspace(1.0, 1.1, 3)),
+    (SUPPORT_PARAMS_TEMPLATE, (1820, 1024), np.linspace(1.0, 1.5, 10)),
+]
+SYNTHETIC_IMAGE_SIZES = (256, 512, 1024, 2048)
+SYNTHETIC_TEMPLATE_FRACTIONS = (0.05, 0.1, 0.25, 0.5)
+
+
+def measure(func, repeat: int) -> float:
+    func()
+    elapsed = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed.append((time.perf_counter() - start) * 1000)
+    return min(elapsed)
+
+
+def run_case(name: str, image: np.ndarray, templ: np.ndarray, repeat: int) -> dict:
+    backend = CorrelationBackend(mode=CORRELATION_FFT)
+    spatial_ms = measure(lambda: cv2.matchTemplate(image, templ, cv2.TM_CCOEFF_NORMED), repeat)
+    fft_ms = measure(lambda: backend.match(image, templ, cv2.TM_CCOEFF_NORMED), repeat)
+    error = np.abs(cv2.matchTemplate(image, templ, cv2.TM_CCOEFF_NORMED) -
+                   backend.match(image, templ, cv2.TM_CCOEFF_NORMED)).max()
+    return {
+        'name': name,
+        'image': list(image.shape),
+        'template': list(templ.shape),
+        'cost_ratio': round(cost_ratio(image.shape, templ.shape), 2),
+        'spatial_ms': round(spatial_ms, 3),
+        'fft_ms': round(fft_ms, 3),
+        'max_error': float(error),
+    }
+
+
+def pipeline_cases(rng) -> [(str, np.ndarray, np.ndarray)]:
+    cases = []
+    for (templ_name, (h, w), linspace) in PIPELINE_CASES:
+        templ = template_registry.get(templ_name)
+        image = rng.integers(0, 256, (h, w), dtype=np.uint8)
+        for scale in linspace:
+            resized = resize(image, int(w * scale))
+            if resized.shape[0] >= templ.shape[0] and resized.shape[1] >= templ.shape[1]:
+                cases.append(('{}@{:.2f}'.format(templ_name, scale), resized, templ))
+    return cases
+
+
+def synthetic_cases(rng) -> [(str, np.ndarray, np.ndarray)]:
+    cases = []
+    for size in SYNTHETIC_IMAGE_SIZES:
+        image = rng.integers(0, 256, (size, size), dtype=np.uint8)
+        for fraction in SYNTHETIC_TEMPLATE_FRACTIONS:
+            t = max(int(size * fraction), 1)
+            cases.append(('{}px/{}'.format(size, fraction), image, image[:t, :t].copy()))
+    return cases
+
+
+def find_crossover(results: [dict]) -> float or None:
+    # これ以上の比ではすべてDFTの方が速い、という最小の演算量の比
+    crossover = None
+    for result in sorted(results, key=lambda k: -k['cost_ratio']):
+        if result['fft_ms'] >= result['spatial_ms']:
+            break
+        crossover = result['cost_ratio']
+    return crossover
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare cv2.matchTemplate with DFT-based correlation.')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per case (the fastest one is reported)')
+    parser.add_argument('--output', help='write the JSON report to this path')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    template_registry.load()
+    results = [run_case(name, image, templ, args.repeat)
+               for (name, image, templ) in pipeline_cases(rng) + synthetic_cases(rng)]
+
+    print('{:<28} {:>12} {:>12} {:>12} {:>11} {:>9}  {}'.format(
+        'Name', 'Image', 'Template', 'Cost ratio', 'Spatial ms', 'FFT ms', 'Faster'))
+    for result in results:
+        print('{:<28} {:>12} {:>12} {:>12} {:>11} {:>9}  {}'.format(
+            result['name'], '{}x{}'.format(*result['image']), '{}x{}'.format(*result['template']),
+            result['cost_ratio'], result['spatial_ms'], result['fft_ms'],
+            'fft' if result['fft_ms'] < result['spatial_ms'] else 'spatial'))
+
+    crossover = find_crossover(results)
+    if crossover is None:
+        print('DFT was not faster at the largest cost ratio measured; keep CORRELATION_FFT_CROSSOVER=inf')
+    else:
+        print('CORRELATION_FFT_CROSSOVER={}'.format(crossover))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'crossover': crossover, 'cases': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
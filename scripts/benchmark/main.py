@@ -0,0 +1,299 @@
+# resources/tests の画像で status・skills・support_params の読み取りを実行し、速度と正解率を計測する
+#
+#   python -m scripts.benchmark.main --repeat 3 --output benchmark.json
+#   python -m scripts.benchmark.main --compare benchmark.json
+#
+# --compare を指定すると前回のレポートと比較し、遅くなった・正解率が下がった場合は終了コード1で終わる
+import argparse
+import csv
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from dataclasses import dataclass
+
+import numpy as np
+from PIL import Image
+
+import resources
+from app import create_api_resource
+from app.aio import load_config
+from app.library.executor import run_coroutine
+from app.library.metrics import Timings, request_stage
+from app.library.pillow import crop_pil, resize_pil
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+PERCENTILES = (50, 90, 99)
+
+PARAMETER_FIELDS = ['speed', 'stamina', 'power', 'guts', 'wise']
+SUPPORT_PARAMETER_FIELDS = PARAMETER_FIELDS + ['max_' + field for field in PARAMETER_FIELDS]
+
+
+@dataclass(frozen=True)
+class Sample:
+    name: str
+    image_path: str
+    want: object
+
+
+@dataclass(frozen=True)
+class Suite:
+    # directory の画像と同名のCSVを正解として読み込み、read で読み取った結果と fields で項目ごとに突き合わせる
+    name: str
+    directory: str
+    load_want: callable
+    read: callable
+    fields: callable
+
+
+async def read_status(api_resource, image: Image, timings: Timings) -> dict:
+    return await api_resource.get_status_data(image, timings=timings)
+
+
+async def read_support_params(api_resource, image: Image, timings: Timings) -> dict:
+    return await api_resource.get_support_params_data(image, timings=timings)
+
+
+async def read_skills(api_resource, image: Image, timings: Timings) -> dict:
+    # tests/usecase/test_skill_interactor.py と同じくスキル欄のあたりを切り出してから読み取る
+    with request_stage('api.skills', timings=timings):
+        image = resize_pil(image, 1024, None, Image.LANCZOS)
+        image = crop_pil(image, (0, image.size[1] * 0.4, image.size[0], image.size[1] * 0.95))
+        skills = await api_resource.skill_usecase.get_skills_from_image(image)
+    return {'skills': skills.to_dict_array()}
+
+
+def character_fields(want: [str], got: dict) -> [(str, object, object)]:
+    return [
+        ('character', want[0], got.get('character')),
+        ('nickname', want[1], got.get('nickname')),
+    ]
+
+
+def parameter_fields(want: [str], got: dict) -> [(str, object, object)]:
+    params = got.get('params', {})
+    return [('params.' + field, want[i], params.get(field)) for (i, field) in enumerate(PARAMETER_FIELDS)]
+
+
+def support_parameter_fields(want: [str], got: dict) -> [(str, object, object)]:
+    params = got.get('params', {})
+    return [('params.' + field, want[i + 1], params.get(field)) for (i, field) in enumerate(SUPPORT_PARAMETER_FIELDS)]
+
+
+def skill_fields(want: [[str]], got: dict) -> [(str, object, object)]:
+    skills = got.get('skills', [])
+    fields = [('skills.count', len(want), len(skills))]
+    for (i, row) in enumerate(want):
+        skill = skills[i] if i < len(skills) else {}
+        fields.append(('skills.name', row[0], skill.get('name')))
+        fields.append(('skills.level', row[1], skill.get('level')))
+    return fields
+
+
+SUITES = [
+    Suite('status', 'get_character_nickname_from_image_and_name', lambda rows: rows[0], read_status, character_fields),
+    Suite('status_params', 'get_parameters_from_image', lambda rows: rows[0], read_status, parameter_fields),
+    Suite('skills', 'cropped_skills', lambda rows: rows, read_skills, skill_fields),
+    Suite('support_params', 'support_character_modal_aoharu', lambda rows: rows[0], read_support_params,
+          support_parameter_fields),
+]
+
+
+def load_samples(tests_path: str, suite: Suite) -> [Sample]:
+    path = os.path.join(tests_path, suite.directory)
+    if not os.path.isdir(path):
+        return []
+
+    samples = []
+    for file_name in sorted(os.listdir(path)):
+        (name, ext) = os.path.splitext(file_name)
+        csv_path = os.path.join(path, name + '.csv')
+        if ext.lower() not in IMAGE_EXTENSIONS or not os.path.exists(csv_path):
+            continue
+        with open(csv_path, encoding='utf-8') as f:
+            rows = [row for row in csv.reader(f) if len(row) > 0]
+        samples.append(Sample(name, os.path.join(path, file_name), suite.load_want(rows)))
+    return samples
+
+
+def summarize(values: [float]) -> dict:
+    if len(values) == 0:
+        return {'count': 0}
+
+    values = np.array(values)
+    summary = {
+        'count': len(values),
+        'min': round(float(values.min()), 2),
+        'max': round(float(values.max()), 2),
+        'mean': round(float(values.mean()), 2),
+    }
+    for percentile in PERCENTILES:
+        summary['p{}'.format(percentile)] = round(float(np.percentile(values, percentile)), 2)
+    return summary
+
+
+def peak_rss_mb() -> float:
+    # プロセス全体の最大値なので、スイートごとではなくレポート全体で1つだけ記録する。Linuxのru_maxrssはKB単位
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def run_suite(api_resource, suite: Suite, samples: [Sample], repeat: int) -> dict:
+    latencies = []
+    stages = dict()
+    ocr_calls = []
+    accuracy = dict()
+    mismatches = []
+    errors = []
+
+    for sample in samples:
+        for _ in range(repeat):
+            # 結果のキャッシュを使うと2回目以降が計測にならない
+            api_resource.result_cache.clear()
+            with Image.open(sample.image_path) as image:
+                image.load()
+                timings = Timings()
+                start = time.perf_counter()
+                try:
+                    got = run_coroutine(suite.read(api_resource, image, timings))
+                except Exception as e:
+                    logger.exception('failed to read %s', sample.image_path)
+                    got = {}
+                    errors.append({'sample': sample.name, 'error': repr(e)})
+                latencies.append((time.perf_counter() - start) * 1000)
+
+            items = timings.to_list()
+            for item in items:
+                if item['elapsed_ms'] is not None:
+                    stages.setdefault(item['stage'], []).append(item['elapsed_ms'])
+            ocr_calls.append(sum(1 for item in items if item['stage'] == 'ocr'))
+
+        for (field, want, got_value) in suite.fields(sample.want, got):
+            (correct, total) = accuracy.get(field, (0, 0))
+            matched = str(want) == str(got_value)
+            accuracy[field] = (correct + int(matched), total + 1)
+            if not matched:
+                mismatches.append({'sample': sample.name, 'field': field, 'want': want, 'got': got_value})
+
+    correct = sum(correct for (correct, _) in accuracy.values())
+    total = sum(total for (_, total) in accuracy.values())
+    return {
+        'samples': len(samples),
+        'runs': len(latencies),
+        'latency_ms': summarize(latencies),
+        'stages_ms': {name: summarize(values) for (name, values) in sorted(stages.items())},
+        'ocr_calls': {
+            'total': int(sum(ocr_calls)),
+            'per_run': round(float(np.mean(ocr_calls)), 2) if len(ocr_calls) > 0 else 0,
+        },
+        'accuracy': {
+            'rate': round(correct / total, 4) if total > 0 else None,
+            'fields': {field: {'correct': c, 'total': t, 'rate': round(c / t, 4)}
+                       for (field, (c, t)) in sorted(accuracy.items())},
+        },
+        'mismatches': mismatches,
+        'errors': errors,
+    }
+
+
+def git_commit() -> str or None:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report: dict):
+    print('{:<16} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>6} {:>9} {:>9}'.format(
+        'Name (ms)', 'Min', 'Max', 'Mean', 'P50', 'P90', 'P99', 'Runs', 'OCR/run', 'Accuracy'))
+    for (name, suite) in report['suites'].items():
+        latency = suite['latency_ms']
+        if latency['count'] == 0:
+            print('{:<16} (no samples)'.format(name))
+            continue
+        rate = suite['accuracy']['rate']
+        print('{:<16} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>6} {:>9} {:>9}'.format(
+            name, latency['min'], latency['max'], latency['mean'], latency['p50'], latency['p90'], latency['p99'],
+            suite['runs'], suite['ocr_calls']['per_run'], '-' if rate is None else '{:.2%}'.format(rate)))
+    print('peak RSS: {} MB'.format(report['peak_rss_mb']))
+
+
+def compare(base: dict, report: dict, *, max_latency_regression: float) -> [str]:
+    # 前回のレポートより遅くなった、または正解率が下がったスイートを返す
+    regressions = []
+    for (name, suite) in report['suites'].items():
+        base_suite = base.get('suites', {}).get(name)
+        if base_suite is None or base_suite['latency_ms']['count'] == 0 or suite['latency_ms']['count'] == 0:
+            continue
+
+        for key in ('p50', 'p90'):
+            (old, new) = (base_suite['latency_ms'][key], suite['latency_ms'][key])
+            change = (new - old) / old if old > 0 else 0
+            print('{:<16} {} {:>9} -> {:>9} ms ({:+.1%})'.format(name, key, old, new, change))
+            if change > max_latency_regression:
+                regressions.append('{} {} latency {:+.1%}'.format(name, key, change))
+
+        (old, new) = (base_suite['accuracy']['rate'], suite['accuracy']['rate'])
+        if old is not None and new is not None:
+            print('{:<16} accuracy {:.2%} -> {:.2%}'.format(name, old, new))
+            if new < old:
+                regressions.append('{} accuracy {:.2%} -> {:.2%}'.format(name, old, new))
+
+    return regressions
+
+
+def run_benchmark(api_resource, suites: [Suite], tests_path: str, repeat: int) -> dict:
+    report = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'repeat': repeat,
+        'suites': dict(),
+    }
+    for suite in suites:
+        samples = load_samples(tests_path, suite)
+        report['suites'][suite.name] = run_suite(api_resource, suite, samples, repeat)
+    report['peak_rss_mb'] = peak_rss_mb()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the OCR pipelines over resources/tests.')
+    parser.add_argument('--suite', action='append', choices=[suite.name for suite in SUITES],
+                        help='suite to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per sample')
+    parser.add_argument('--tests-path', default=os.path.join(resources.__path__[0], 'tests'))
+    parser.add_argument('--output', help='write the JSON report to this path')
+    parser.add_argument('--compare', help='compare with a previous JSON report')
+    parser.add_argument('--max-latency-regression', type=float, default=0.1,
+                        help='allowed p50/p90 latency increase against --compare (default: 0.1 = 10%%)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    api_resource = create_api_resource(load_config(), logger, debug=False)
+
+    suites = [suite for suite in SUITES if not args.suite or suite.name in args.suite]
+    report = run_benchmark(api_resource, suites, args.tests_path, args.repeat)
+
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            base = json.load(f)
+        regressions = compare(base, report, max_latency_regression=args.max_latency_regression)
+        for regression in regressions:
+            print('REGRESSION: ' + regression)
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+# resources/tests の正解付きの画像からステータスの数字を切り出し、CSVの値を正解として数字の字形バンクを作る
+# --samples-dir を指定すると、正解のない画像もTesseractで確度高く読めた結果から学習に加える
+# 0〜9のすべてに十分なサンプルが集まった場合だけ --output（既定ではパッケージ内の resources/glyph_digits.npz）に書き出す
+#
+#   python -m scripts.glyph_bank.main
+#   python -m scripts.glyph_bank.main --samples-dir ./samples
+import argparse
+import json
+import logging
+import os
+import sys
+
+from PIL import Image
+
+import resources
+from app import create_api_resource
+from app.aio import load_config
+from app.domain.image import ImageContext
+from app.library.executor import run_coroutine
+from app.library.glyph_digits import DIGITS
+from app.usecase.templates import glyph_digit_reader, resource_path
+from scripts.analytics.main import get_sample_paths
+from scripts.benchmark.main import SUITES, load_samples
+
+logger = logging.getLogger(__name__)
+
+
+async def crop_status_parameters(api_resource, image: Image) -> [Image] or None:
+    character_detail_image = await api_resource.image_usecase.create_character_detail_image(ImageContext(image))
+    return await api_resource.status_usecase.crop_parameter_images(character_detail_image)
+
+
+async def crop_support_parameters(api_resource, image: Image) -> [Image] or None:
+    return await api_resource.status_usecase.crop_support_parameter_images(ImageContext(image))
+
+
+# ベンチマークのスイート名と、切り出した画像の順に並べた正解
+LABELLED_SUITES = {
+    'status_params': (crop_status_parameters, lambda want: want[:5]),
+    'support_params': (crop_support_parameters, lambda want: want[1:11]),
+}
+
+
+def learn_labelled(api_resource, tests_path: str) -> int:
+    # 字形の数と正解の桁数が合わない画像（上限値の「/」など）は学習しない
+    learned = 0
+    for suite in SUITES:
+        if suite.name not in LABELLED_SUITES:
+            continue
+        (crop, labels) = LABELLED_SUITES[suite.name]
+        for sample in load_samples(tests_path, suite):
+            try:
+                with Image.open(sample.image_path) as image:
+                    image.load()
+                    images = run_coroutine(crop(api_resource, image))
+            except Exception:
+                logger.exception('failed to crop %s', sample.image_path)
+                continue
+            if images is None:
+                logger.warning('parameters not found in %s', sample.image_path)
+                continue
+            for (image, text) in zip(images, labels(sample.want)):
+                if glyph_digit_reader.learn(image, text.strip()):
+                    learned += 1
+    return learned
+
+
+def learn_samples(api_resource, samples_dir: str):
+    paths = get_sample_paths(samples_dir)
+    for (i, path) in enumerate(paths, 1):
+        try:
+            with Image.open(path) as image:
+                image.load()
+                run_coroutine(api_resource.get_status_data(image))
+        except Exception:
+            logger.exception('failed to read %s', path)
+        if i % 10 == 0 or i == len(paths):
+            logger.info('%d/%d images, %d parameters learned', i, len(paths), glyph_digit_reader.learned)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the digit glyph bank from status screenshots.')
+    parser.add_argument('--tests-dir', default=os.path.join(resources.__path__[0], 'tests'))
+    parser.add_argument('--samples-dir', default=None)
+    parser.add_argument('--output', default=resource_path('glyph_digits.npz'))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    # 既存のバンクは読み込まず、一から学習する
+    config = dict(load_config(), GLYPH_BANK_PATH=None, GLYPH_BANK_BOOTSTRAP_PATH=None)
+    api_resource = create_api_resource(config, logger, debug=False)
+    glyph_digit_reader.configure(learning=True)
+
+    logger.info('%d parameters learned from %s', learn_labelled(api_resource, args.tests_dir), args.tests_dir)
+    if args.samples_dir is not None:
+        learn_samples(api_resource, args.samples_dir)
+
+    counts = {digit: int(count) for (digit, count) in zip(DIGITS, glyph_digit_reader.counts)}
+    print(json.dumps({'learned': glyph_digit_reader.learned, 'counts': counts}, indent=2))
+
+    if glyph_digit_reader.bank is None:
+        logger.error('some digits have fewer than %d samples; %s was not written',
+                     glyph_digit_reader.min_samples, args.output)
+        sys.exit(1)
+
+    glyph_digit_reader.save(args.output)
+    logger.info('wrote %s', args.output)
+
+
+if __name__ == '__main__':
+    main()
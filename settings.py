@@ -1,7 +1,45 @@
+import json
 import os
 
+import resources
+
 HOST = '0.0.0.0'
 PORT = int(os.environ.get('PORT', 8080))
 DEBUG = os.environ.get('ENABLE_DEBUG', False)
 THREADED = True
 MAX_CONTENT_LENGTH = 5 * 1024 * 1024  # default is 5MB
+TEMPLATE_SEARCH_MODE = os.environ.get('TEMPLATE_SEARCH_MODE', 'full')
+TEMPLATE_LAYOUT_PRIORS = os.environ.get('TEMPLATE_LAYOUT_PRIORS', '') in ('1', 'true')
+# {"params_frame": [0.0, 0.2, 1.0, 0.65]} のように、テンプレートごとの探索範囲を画像に対する割合で上書きする
+TEMPLATE_LAYOUT_PRIOR_BOXES = json.loads(os.environ.get('TEMPLATE_LAYOUT_PRIOR_BOXES', '{}'))
+TEMPLATE_CALIBRATION = os.environ.get('TEMPLATE_CALIBRATION', '') in ('1', 'true')
+# tmp/ はデバッグ画像の出力先なので、キャッシュの置き場所に書き出す
+TEMPLATE_CALIBRATION_PATH = os.environ.get('TEMPLATE_CALIBRATION_PATH', os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), 'umaocr',
+    'template_calibration.json'))
+# spatial / fft / auto。autoでは python -m scripts.benchmark.correlation で計測した crossover を超える場合だけDFTを使う
+CORRELATION_BACKEND = os.environ.get('CORRELATION_BACKEND', 'auto')
+CORRELATION_FFT_CROSSOVER = float(os.environ.get('CORRELATION_FFT_CROSSOVER', 'inf'))
+# python -m scripts.glyph_bank.main で作った字形バンク。0〜9がすべて揃っていなければ使わない
+GLYPH_BANK_PATH = os.environ.get('GLYPH_BANK_PATH', os.path.join(resources.__path__[0], 'glyph_digits.npz'))
+# 指定すると、字形バンクがない間は確度高く読めたステータスから学習し、0〜9が揃った時点でここに書き出して使い始める
+# Tesseractの読み間違いもそのまま学習するので、既定では学習しない
+GLYPH_BANK_BOOTSTRAP_PATH = os.environ.get('GLYPH_BANK_BOOTSTRAP_PATH')
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', 1024))
+RESULT_CACHE_TTL = int(os.environ.get('RESULT_CACHE_TTL', 60 * 60))
+RESULT_CACHE_REDIS_URL = os.environ.get('RESULT_CACHE_REDIS_URL')
+MAX_BATCH_CONTENT_LENGTH = int(os.environ.get('MAX_BATCH_CONTENT_LENGTH', 200 * 1024 * 1024))
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 500))
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', os.cpu_count() or 1))
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_TTL = int(os.environ.get('JOB_TTL', 24 * 60 * 60))
+JOB_QUEUE_REDIS_URL = os.environ.get('JOB_QUEUE_REDIS_URL')
+# 待っているジョブはアップロードされた画像をそのまま持つので、これを超える投入は503で断る
+JOB_QUEUE_MAX_DEPTH = int(os.environ.get('JOB_QUEUE_MAX_DEPTH', 32))
+# 実行中のジョブの進捗を保存する間隔（秒）
+JOB_PROGRESS_INTERVAL = float(os.environ.get('JOB_PROGRESS_INTERVAL', 1.0))
+AIO_MAX_CONCURRENCY = int(os.environ.get('AIO_MAX_CONCURRENCY', (os.cpu_count() or 1) * 2))
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', os.cpu_count() or 1))
+SERVER_SHUTDOWN_TIMEOUT = int(os.environ.get('SERVER_SHUTDOWN_TIMEOUT', 30))
+TRACING_ENABLED = os.environ.get('TRACING_ENABLED', '') in ('1', 'true')
+TRACING_SAMPLING_RATE = float(os.environ.get('TRACING_SAMPLING_RATE', 1.0))
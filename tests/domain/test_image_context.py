@@ -0,0 +1,76 @@
+from unittest import TestCase
+
+import numpy as np
+from PIL import Image
+
+from app.domain.image import ImageContext
+from app.library.pillow import binarized, crop_pil, pil2gray, resize_pil
+
+
+class TestImageContext(TestCase):
+    def test_resize(self) -> None:
+        image = Image.fromarray(np.random.default_rng(0).integers(0, 256, (1600, 900, 3), dtype=np.uint8))
+        context = ImageContext(image)
+
+        self.assertEqual(context.size, (1024, 1820))
+        self.assertIs(context.image, context.image)
+        self.assertEqual(context.gray.shape, (1820, 1024))
+        self.assertIs(context.binarized(130), context.binarized(130))
+
+    def test_crop(self) -> None:
+        image = Image.fromarray(np.random.default_rng(0).integers(0, 256, (1800, 1024, 3), dtype=np.uint8))
+        context = ImageContext(image)
+
+        # 切り出した領域は、切り出した画像をその都度処理した場合と同じ結果になる
+        for box in (
+                (10.4, 20.6, 300.5, 400.2),
+                (-5, -7, 50, 60),
+                (900, 1600, 1100, 1900),
+        ):
+            with self.subTest(box=box):
+                region = context.crop(box)
+                cropped = crop_pil(context.image, box)
+                self.assertTrue(np.array_equal(np.asarray(region.image), np.asarray(cropped)))
+                self.assertTrue(np.array_equal(region.gray, pil2gray(cropped)))
+                self.assertTrue(np.array_equal(np.asarray(region.binarized(150)), np.asarray(binarized(cropped, 150))))
+
+                inner_box = (3.2, 4.7, 40, 500)
+                inner = region.crop(inner_box)
+                inner_cropped = crop_pil(cropped, inner_box)
+                self.assertTrue(np.array_equal(inner.gray, pil2gray(inner_cropped)))
+                self.assertTrue(np.array_equal(np.asarray(inner.binarized(150)), np.asarray(binarized(inner_cropped, 150))))
+
+    def test_resampled(self) -> None:
+        image = Image.fromarray(np.random.default_rng(0).integers(0, 256, (1600, 900, 3), dtype=np.uint8))
+        context = ImageContext(image)
+
+        # 既定ではこれまでのresize_pilと同じBILINEARで、スキルの読み取りではLANCZOSでリサイズする
+        for resample in (Image.BILINEAR, Image.LANCZOS):
+            with self.subTest(resample=resample):
+                resampled = context.resampled(resample)
+                want = resize_pil(image, 1024, None, resample)
+                self.assertTrue(np.array_equal(np.asarray(resampled.image), np.asarray(want)))
+                self.assertIs(context.resampled(resample), resampled)
+
+                box = (10, 20, 300, 400)
+                region = context.crop(box).resampled(resample)
+                self.assertTrue(np.array_equal(np.asarray(region.image), np.asarray(crop_pil(want, box))))
+
+    def test_size(self) -> None:
+        # 大きさはリサイズ・切り出しをせずに求め、実際に処理した画像の大きさと一致する
+        for (shape, box) in (
+                ((1600, 900, 3), (10.4, 20.6, 300.5, 400.2)),
+                ((1800, 1024, 3), (-5, -7, 50, 60)),
+                ((2337, 1283, 3), (900, 1600, 1100, 2400)),
+                ((700, 500, 3), (0.5, 1.5, 2.5, 3.5)),
+        ):
+            with self.subTest(shape=shape, box=box):
+                image = Image.fromarray(np.zeros(shape, dtype=np.uint8))
+                context = ImageContext(image)
+                region = context.crop(box)
+
+                (size, region_size) = (context.size, region.size)
+                self.assertIsNone(context.cache_image)
+                self.assertIsNone(region.cache_image)
+                self.assertEqual(size, context.image.size)
+                self.assertEqual(region_size, region.image.size)
@@ -0,0 +1,26 @@
+from unittest import TestCase
+
+from app.domain.skill import NormalSkill, NormalSkills, SkillExtraction, UniqueSkill
+
+
+class TestSkillExtraction(TestCase):
+    def test_split(self) -> None:
+        names = frozenset(['固有A', '固有B'])
+
+        for (skills, first, last, normal) in (
+                ([NormalSkill('固有A', 3), NormalSkill('コーナー回復◯', 0)],
+                 UniqueSkill('固有A', 3), UniqueSkill('固有A', 3), ['コーナー回復◯']),
+                # レベル0の固有スキルは継承した固有スキルなので通常スキルとして扱う
+                ([NormalSkill('固有A', 0), NormalSkill('コーナー回復◯', 0)],
+                 UniqueSkill('', 0), UniqueSkill('', 0), ['固有A', 'コーナー回復◯']),
+                ([NormalSkill('固有A', 4), NormalSkill('固有B', 2), NormalSkill('コーナー回復◯', 0)],
+                 UniqueSkill('固有A', 4), UniqueSkill('固有B', 2), ['コーナー回復◯']),
+                ([], UniqueSkill('', 0), UniqueSkill('', 0), []),
+        ):
+            with self.subTest(skills=skills):
+                extraction = SkillExtraction(NormalSkills(skills), names)
+
+                self.assertEqual(extraction.unique_skill(), first)
+                self.assertEqual(extraction.unique_skill(last=True), last)
+                self.assertEqual([skill.name for skill in extraction.normal_skills().values], normal)
+                self.assertEqual(extraction.character_skills().unique_skill, last)
@@ -0,0 +1,52 @@
+import asyncio
+import contextvars
+import threading
+from unittest import TestCase
+
+from app.library.executor import EventLoopThread, WorkerPool
+
+request_id = contextvars.ContextVar('request_id', default=None)
+
+
+class TestWorkerPool(TestCase):
+    def test_run(self) -> None:
+        worker_pool = WorkerPool(2)
+
+        async def run():
+            request_id.set('abc')
+            return await asyncio.gather(
+                worker_pool.run(lambda: (request_id.get(), threading.current_thread().name)),
+                worker_pool.run(pow, 2, 10),
+            )
+
+        ((got_request_id, thread_name), got_pow) = asyncio.run(run())
+        worker_pool.shutdown()
+
+        self.assertEqual(got_request_id, 'abc')
+        self.assertTrue(thread_name.startswith('worker'))
+        self.assertEqual(got_pow, 1024)
+        stats = worker_pool.stats()
+        self.assertEqual(stats.active, 0)
+        self.assertEqual(stats.queued, 0)
+        self.assertEqual(stats.completed, 2)
+
+
+class TestEventLoopThread(TestCase):
+    def test_run(self) -> None:
+        event_loop = EventLoopThread()
+
+        async def get_loop():
+            return asyncio.get_running_loop()
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(event_loop.run(get_loop()))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # どのスレッドから呼び出しても同じイベントループで実行される
+        self.assertEqual(len(results), 4)
+        self.assertEqual(len(set(map(id, results))), 1)
+
+        event_loop.close()
@@ -0,0 +1,121 @@
+import os
+import tempfile
+from unittest import TestCase
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from app.library.glyph_digits import DIGITS, GlyphDigitReader
+
+
+def render_digits(text: str) -> Image:
+    # 隣の字形と繋がらないよう、1文字ずつ間隔を空けて描く
+    array = np.full((40, 30 * len(text) + 20), 255, dtype=np.uint8)
+    for (i, digit) in enumerate(text):
+        cv2.putText(array, digit, (10 + 30 * i, 32), cv2.FONT_HERSHEY_SIMPLEX, 1.0, 0, 3)
+    return Image.fromarray(array).convert('RGB')
+
+
+class TestGlyphDigitReader(TestCase):
+    def learned_reader(self, digits: str) -> GlyphDigitReader:
+        reader = GlyphDigitReader()
+        reader.configure(learning=True)
+        for _ in range(reader.min_samples):
+            for digit in digits:
+                self.assertTrue(reader.learn(render_digits(digit), digit))
+        reader.configure(learning=False)
+        return reader
+
+    def test_read(self) -> None:
+        reader = self.learned_reader(DIGITS)
+
+        for text in ('1200', '987', '3456', '50'):
+            with self.subTest(text=text):
+                got = reader.read(render_digits(text))
+                self.assertIsNotNone(got)
+                self.assertEqual(got.text, text)
+
+    def test_incomplete_bank(self) -> None:
+        # 0〜9のどれかが欠けていれば、字形バンクは使わずにTesseractに任せる
+        reader = self.learned_reader(DIGITS[:-1])
+
+        self.assertIsNone(reader.bank)
+        self.assertIsNone(reader.read(render_digits('12')))
+
+    def test_learning(self) -> None:
+        reader = GlyphDigitReader()
+
+        # 学習を有効にしていなければ学習せず、学習中は字形バンクで読まない
+        self.assertFalse(reader.learn(render_digits('1'), '1'))
+        reader = self.learned_reader(DIGITS)
+        reader.configure(learning=True)
+        self.assertIsNone(reader.read(render_digits('12')))
+
+    def test_save_and_load(self) -> None:
+        reader = self.learned_reader(DIGITS)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'glyph_digits.npz')
+            reader.save(path)
+            self.assertEqual(os.listdir(directory), ['glyph_digits.npz'])
+
+            loaded = GlyphDigitReader()
+            loaded.load(path)
+            self.assertTrue(np.array_equal(loaded.counts, reader.counts))
+            self.assertEqual(loaded.read(render_digits('1200')).text, '1200')
+
+    def test_bootstrap(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cache', 'glyph_digits.npz')
+
+            # 字形バンクがなければ、0〜9が揃うまでTesseractで読んだ結果から学習する
+            reader = GlyphDigitReader()
+            reader.bootstrap(path)
+            self.assertTrue(reader.collecting())
+            for _ in range(reader.min_samples):
+                for digit in DIGITS:
+                    self.assertIsNone(reader.read(render_digits('12')))
+                    self.assertTrue(reader.learn(render_digits(digit), digit))
+
+            # 揃った時点で書き出し、それ以降は学習せずに字形バンクで読み取る
+            self.assertTrue(os.path.exists(path))
+            self.assertFalse(reader.collecting())
+            self.assertFalse(reader.learn(render_digits('1'), '1'))
+            self.assertEqual(reader.read(render_digits('1200')).text, '1200')
+
+            # 再起動後は書き出した字形バンクを読み込み、学習し直さない
+            restarted = GlyphDigitReader()
+            restarted.bootstrap(path)
+            self.assertFalse(restarted.collecting())
+            self.assertEqual(restarted.read(render_digits('3456')).text, '3456')
+
+        # 字形バンクを読み込み済みか、書き出し先がなければ学習しない
+        reader = self.learned_reader(DIGITS)
+        reader.bootstrap(path)
+        self.assertFalse(reader.collecting())
+        reader = GlyphDigitReader()
+        reader.bootstrap(None)
+        self.assertFalse(reader.collecting())
+
+    def test_load_corrupt(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            for (name, content) in (('truncated.npz', b'PK\x03\x04broken'), ('text.npz', b'not a numpy file')):
+                with self.subTest(name=name):
+                    path = os.path.join(directory, name)
+                    with open(path, 'wb') as f:
+                        f.write(content)
+
+                    # 壊れたファイルでは例外を送出せず、字形バンクを使わない
+                    reader = GlyphDigitReader()
+                    with self.assertLogs('app.library.glyph_digits', level='WARNING'):
+                        reader.load(path)
+                    self.assertIsNone(reader.bank)
+
+            with self.subTest(name='wrong shape'):
+                path = os.path.join(directory, 'shape.npz')
+                np.savez(path, sums=np.zeros((3, 4)), counts=np.zeros(3, dtype=np.int64))
+                reader = GlyphDigitReader()
+                with self.assertLogs('app.library.glyph_digits', level='WARNING'):
+                    reader.load(path)
+                self.assertIsNone(reader.bank)
@@ -0,0 +1,154 @@
+import asyncio
+import threading
+import time
+from unittest import TestCase
+
+import fakeredis
+
+from app.library.job_queue import (JOB_DONE, JOB_FAILED, JOB_QUEUED, JobQueueFull, JobWorkerPool, MemoryJobQueue,
+                                   RedisJobQueue)
+
+
+async def echo(payload: dict, on_progress) -> list:
+    result = []
+    for value in payload['values']:
+        await asyncio.sleep(0)
+        on_progress(value)
+        result.append(value * 2)
+    return result
+
+
+async def slow_echo(payload: dict, on_progress) -> list:
+    result = []
+    for value in payload['values']:
+        await asyncio.sleep(0.05)
+        on_progress(value)
+        result.append(value * 2)
+    return result
+
+
+async def fail(payload: dict, on_progress) -> list:
+    raise ValueError('broken payload')
+
+
+def wait_job(job_worker_pool: JobWorkerPool, job_id: str, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = job_worker_pool.get(job_id)
+        if job.status in (JOB_DONE, JOB_FAILED):
+            return job
+        time.sleep(0.01)
+    raise TimeoutError(job_id)
+
+
+class TestJobWorkerPool(TestCase):
+    def test_execute(self) -> None:
+        for (name, job_queue) in (
+                ('memory', MemoryJobQueue(ttl=60, max_depth=10)),
+                ('redis', RedisJobQueue(fakeredis.FakeRedis(), ttl=60, max_depth=10)),
+        ):
+            with self.subTest(name=name):
+                job_worker_pool = JobWorkerPool(job_queue, workers=2, poll_interval=0.05)
+                job_worker_pool.register('echo', echo)
+                job_worker_pool.register('fail', fail)
+                job_worker_pool.start()
+                try:
+                    done = job_worker_pool.submit('echo', {'values': [1, 2, 3]}, 3)
+                    failed = job_worker_pool.submit('fail', {'values': []}, 0)
+
+                    got = wait_job(job_worker_pool, done.id)
+                    self.assertEqual(got.status, JOB_DONE)
+                    self.assertEqual(got.result, [2, 4, 6])
+                    self.assertEqual(got.completed, 3)
+                    self.assertLessEqual(got.submitted_at, got.started_at)
+                    self.assertLessEqual(got.started_at, got.finished_at)
+
+                    got = wait_job(job_worker_pool, failed.id)
+                    self.assertEqual(got.status, JOB_FAILED)
+                    self.assertEqual(got.error, 'broken payload')
+                finally:
+                    job_worker_pool.stop()
+
+                stats = job_worker_pool.stats()
+                self.assertEqual(stats.depth, 0)
+                self.assertEqual(stats.running, 0)
+                self.assertEqual(stats.submitted, 2)
+                self.assertEqual(stats.done, 1)
+                self.assertEqual(stats.failed, 1)
+
+    def test_submit_unknown_endpoint(self) -> None:
+        job_worker_pool = JobWorkerPool(MemoryJobQueue(ttl=60, max_depth=10), workers=1)
+
+        with self.assertRaises(ValueError):
+            job_worker_pool.submit('echo', {}, 0)
+
+    def test_max_depth(self) -> None:
+        for (name, job_queue) in (
+                ('memory', MemoryJobQueue(ttl=60, max_depth=2)),
+                ('redis', RedisJobQueue(fakeredis.FakeRedis(), ttl=60, max_depth=2)),
+        ):
+            with self.subTest(name=name):
+                job_worker_pool = JobWorkerPool(job_queue, workers=1)
+                job_worker_pool.register('echo', echo)
+                jobs = [job_worker_pool.submit('echo', {'values': [i]}, 1) for i in range(2)]
+
+                # 上限を超えた投入は断り、そのジョブの状態も残さない
+                with self.assertRaises(JobQueueFull):
+                    job_worker_pool.submit('echo', {'values': [2]}, 1)
+                self.assertEqual(job_queue.depth(), 2)
+                self.assertEqual(job_worker_pool.stats().submitted, 2)
+                self.assertEqual([job_worker_pool.get(job.id).status for job in jobs], [JOB_QUEUED, JOB_QUEUED])
+
+                # 取り出せば再び受け付ける
+                job_worker_pool.execute(*job_queue.get(timeout=1))
+                job_worker_pool.submit('echo', {'values': [3]}, 1)
+                self.assertEqual(job_queue.depth(), 2)
+
+    def test_expired(self) -> None:
+        for (name, job_queue) in (
+                ('memory', MemoryJobQueue(ttl=1, max_depth=10)),
+                ('redis', RedisJobQueue(fakeredis.FakeRedis(), ttl=1, max_depth=10)),
+        ):
+            with self.subTest(name=name):
+                job_worker_pool = JobWorkerPool(job_queue, workers=1)
+                job_worker_pool.register('echo', echo)
+                job = job_worker_pool.submit('echo', {'values': [1]}, 1)
+                time.sleep(1.1)
+
+                # 状態の保持期間を過ぎるまで待たされたジョブは実行せず、失敗として残す
+                job_worker_pool.execute(*job_queue.get(timeout=1))
+
+                got = job_worker_pool.get(job.id)
+                self.assertEqual(got.status, JOB_FAILED)
+                self.assertEqual(got.error, 'job expired before it started')
+                self.assertIsNone(got.result)
+                self.assertEqual(job_worker_pool.stats().failed, 1)
+
+    def test_progress_interval(self) -> None:
+        class RecordingJobQueue(MemoryJobQueue):
+            def __init__(self):
+                super().__init__(ttl=60, max_depth=10)
+                self.saved = []
+                self.threads = set()
+
+            def save(self, job):
+                self.saved.append((job.status, job.completed))
+                self.threads.add(threading.current_thread().name)
+                super().save(job)
+
+        # 進捗の保存は progress_interval に1回までにし、終了時には必ず保存する
+        for (progress_interval, want) in (
+                (0.01, [('queued', 0), ('running', 0), ('running', 1), ('running', 2), ('done', 3)]),
+                (60, [('queued', 0), ('running', 0), ('done', 3)]),
+        ):
+            with self.subTest(progress_interval=progress_interval):
+                job_queue = RecordingJobQueue()
+                job_worker_pool = JobWorkerPool(job_queue, workers=1, progress_interval=progress_interval)
+                job_worker_pool.register('echo', slow_echo)
+
+                job = job_worker_pool.submit('echo', {'values': [1, 2, 3]}, 3)
+                job_worker_pool.execute(*job_queue.get(timeout=1))
+
+                self.assertEqual(job_queue.saved, want)
+                # 進捗の保存でイベントループを止めない
+                self.assertNotIn('event-loop', job_queue.threads)
@@ -0,0 +1,88 @@
+from unittest import TestCase
+
+import cv2
+import numpy as np
+
+from app.library.matching_template import (CORRELATION_AUTO, CORRELATION_FFT, CORRELATION_SPATIAL, SEARCH_MODE_FULL,
+                                           SEARCH_MODE_PYRAMID, CorrelationBackend, cost_ratio, detect_templates,
+                                           multi_scale_matching_template_impl, non_maximum_suppression,
+                                           search_template)
+from app.usecase.templates import PARAMS_FRAME_TEMPLATE, SKILL_FRAME_TEMPLATE, template_registry
+
+
+class TestMatchingTemplate(TestCase):
+    def test_search_template(self) -> None:
+        rng = np.random.default_rng(0)
+        templ = template_registry.get(PARAMS_FRAME_TEMPLATE)
+        image = rng.integers(0, 64, (1400, 1024), dtype=np.uint8)
+        pasted = cv2.resize(templ, (895, 34), interpolation=cv2.INTER_AREA)
+        image[600:634, 70:965] = pasted
+
+        for mode in (SEARCH_MODE_FULL, SEARCH_MODE_PYRAMID):
+            with self.subTest(mode=mode):
+                got = search_template(image, templ, np.linspace(1.1, 1.5, 10), mode=mode)
+                (start_x, start_y), (end_x, end_y) = got.loc
+                self.assertLessEqual(abs(start_x - 70), 4)
+                self.assertLessEqual(abs(start_y - 600), 4)
+                self.assertLessEqual(abs(end_x - 965), 4)
+                self.assertLessEqual(abs(end_y - 634), 4)
+
+    def test_detect_templates(self) -> None:
+        rng = np.random.default_rng(0)
+        templ = template_registry.get(SKILL_FRAME_TEMPLATE)
+        image = rng.integers(0, 64, (700, 1024), dtype=np.uint8)
+        # 2列に並んだスキル枠
+        want = [(x, y) for y in (20, 150, 280, 410) for x in (30, 530)]
+        for (x, y) in want:
+            image[y:y + templ.shape[0], x:x + templ.shape[1]] = templ
+
+        results = multi_scale_matching_template_impl(image, templ, linspace=np.linspace(1.0, 1.1, 3))
+        got = detect_templates(results, templ.shape, threshold=0.7, distance=(100, 80))
+
+        self.assertGreaterEqual(got.raw_hits, len(want))
+        self.assertEqual(sorted(start for (start, _) in got.locs), sorted(want))
+        for ((start_x, start_y), (end_x, end_y)) in got.locs:
+            self.assertEqual((end_x - start_x, end_y - start_y), (templ.shape[1], templ.shape[0]))
+
+    def test_non_maximum_suppression(self) -> None:
+        xs = np.array([0, 5, 200, 10, 0])
+        ys = np.array([0, 3, 0, 90, 85])
+        scores = np.array([0.8, 0.9, 0.75, 0.95, 0.7])
+
+        # スコアの高い順に採用し、採用した点の近くの点は除く
+        self.assertEqual(non_maximum_suppression(xs, ys, scores, (100, 80)).tolist(), [3, 1, 2])
+
+    def test_fft_ccoeff_normed(self) -> None:
+        rng = np.random.default_rng(0)
+        image = rng.integers(0, 256, (300, 400), dtype=np.uint8)
+        # 分散が0になる窓も含める
+        image[200:, 300:] = 128
+
+        for (name, templ) in (
+                ('square', image[50:90, 60:100].copy()),
+                ('wide', image[20:40, 10:390].copy()),
+                ('skill_frame', template_registry.get(SKILL_FRAME_TEMPLATE)),
+        ):
+            with self.subTest(templ=name):
+                backend = CorrelationBackend(mode=CORRELATION_FFT)
+                want = cv2.matchTemplate(image, templ, cv2.TM_CCOEFF_NORMED)
+                got = backend.match(image, templ, cv2.TM_CCOEFF_NORMED)
+
+                self.assertEqual(got.shape, want.shape)
+                self.assertLess(np.abs(got - want).max(), 1e-4)
+
+    def test_correlation_backend_choose(self) -> None:
+        image_shape = (1820, 1126)
+        templ_shape = (39, 1024)
+        ratio = cost_ratio(image_shape, templ_shape)
+
+        for (mode, crossover, method, want) in (
+                (CORRELATION_SPATIAL, 0, cv2.TM_CCOEFF_NORMED, CORRELATION_SPATIAL),
+                (CORRELATION_FFT, float('inf'), cv2.TM_CCOEFF_NORMED, CORRELATION_FFT),
+                (CORRELATION_FFT, 0, cv2.TM_SQDIFF, CORRELATION_SPATIAL),
+                (CORRELATION_AUTO, ratio, cv2.TM_CCOEFF_NORMED, CORRELATION_FFT),
+                (CORRELATION_AUTO, ratio * 1.01, cv2.TM_CCOEFF_NORMED, CORRELATION_SPATIAL),
+        ):
+            with self.subTest(mode=mode, crossover=crossover, method=method):
+                backend = CorrelationBackend(mode=mode, crossover=crossover)
+                self.assertEqual(backend.choose(image_shape, templ_shape, method), want)
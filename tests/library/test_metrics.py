@@ -0,0 +1,137 @@
+import asyncio
+import importlib.util
+from unittest import TestCase, skipIf
+
+from prometheus_client import REGISTRY, CollectorRegistry
+
+from app.library.executor import WorkerPoolStats, run_blocking
+from app.library.metrics import StatsCollector, Timings, request_stage, stage, timed, tracing
+
+
+def get_count(name: str) -> float:
+    return REGISTRY.get_sample_value('umaocr_stage_seconds_count', {'stage': name}) or 0
+
+
+class TestTimed(TestCase):
+    def test_timed(self) -> None:
+        @timed('test.sync')
+        def add(a, b):
+            return a + b
+
+        @timed('test.async')
+        async def async_add(a, b):
+            return a + b
+
+        for (name, call) in [
+            ('test.sync', lambda: add(1, 2)),
+            ('test.async', lambda: asyncio.run(async_add(1, 2))),
+        ]:
+            with self.subTest(name=name):
+                before = get_count(name)
+                self.assertEqual(call(), 3)
+                self.assertEqual(get_count(name), before + 1)
+
+
+class TestStatsCollector(TestCase):
+    def test_collect(self) -> None:
+        stats_collector = StatsCollector()
+        stats_collector.register('worker_pool', lambda: WorkerPoolStats(4, 1, 2, 3))
+        registry = CollectorRegistry()
+        registry.register(stats_collector)
+
+        for (field, expected) in [('workers', 4), ('active', 1), ('queued', 2), ('completed', 3)]:
+            with self.subTest(field=field):
+                self.assertEqual(registry.get_sample_value('umaocr_worker_pool_' + field), expected)
+
+
+class TestRequestStage(TestCase):
+    def test_timings(self) -> None:
+        timings = Timings()
+
+        async def read(index: int):
+            with stage('read', index=index):
+                await asyncio.sleep(0)
+
+        async def run():
+            with request_stage('request', timings=timings):
+                await asyncio.gather(read(0), read(1))
+            # リクエストの外側のステージは記録しない
+            with stage('outside'):
+                pass
+
+        asyncio.run(run())
+
+        items = timings.to_list()
+        self.assertEqual([item['stage'] for item in items], ['request', 'read', 'read'])
+        self.assertIsNone(items[0]['parent'])
+        for item in items[1:]:
+            with self.subTest(index=item['index']):
+                self.assertEqual(item['parent'], items[0]['id'])
+                self.assertIsNotNone(item['elapsed_ms'])
+
+
+class MemoryExporter:
+    # 書き出されたスパンを保持するだけのエクスポーター
+
+    def __init__(self):
+        self.spans = []
+
+    def emit(self, span_datas):
+        self.spans.extend(span_datas)
+
+    def export(self, span_datas):
+        self.emit(span_datas)
+
+
+@skipIf(importlib.util.find_spec('opencensus') is None, 'opencensus is not installed')
+class TestTracing(TestCase):
+    def setUp(self) -> None:
+        self.addCleanup(tracing.configure, enabled=False)
+
+    def trace(self, **kwargs) -> list:
+        exporter = MemoryExporter()
+        tracing.configure(enabled=True, exporter=exporter, **kwargs)
+
+        def ocr():
+            with stage('ocr', lang='jpn'):
+                pass
+
+        async def read(index: int):
+            with stage('read', index=index):
+                await asyncio.sleep(0)
+                await run_blocking(ocr)
+
+        async def run():
+            with request_stage('request'):
+                await asyncio.gather(read(0), read(1))
+
+        asyncio.run(run())
+        return exporter.spans
+
+    def test_spans(self) -> None:
+        spans = {span.span_id: span for span in self.trace()}
+        self.assertEqual(sorted(span.name for span in spans.values()), ['ocr', 'ocr', 'read', 'read', 'request'])
+
+        # 並行するタスクやワーカープールのスレッドのステージも、呼び出し元のステージの子になる
+        (request,) = [span for span in spans.values() if span.name == 'request']
+        self.assertIsNone(request.parent_span_id)
+        reads = [span for span in spans.values() if span.name == 'read']
+        self.assertEqual([span.parent_span_id for span in reads], [request.span_id] * 2)
+        self.assertEqual(sorted(span.attributes['index'] for span in reads), [0, 1])
+        for span in spans.values():
+            with self.subTest(name=span.name, span_id=span.span_id):
+                self.assertEqual(span.context.trace_id, request.context.trace_id)
+                if span.name == 'ocr':
+                    self.assertEqual(spans[span.parent_span_id].name, 'read')
+                    self.assertEqual(span.attributes['lang'], 'jpn')
+
+    def test_sampling_rate(self) -> None:
+        # サンプリングされなかったリクエストのスパンは書き出さない
+        self.assertEqual(self.trace(sampling_rate=0.0), [])
+
+    def test_default_exporter(self) -> None:
+        from opencensus.trace.logging_exporter import LoggingExporter
+
+        tracing.configure(enabled=True)
+        tracer = tracing.create_tracer()
+        self.assertIsInstance(tracer.exporter, LoggingExporter)
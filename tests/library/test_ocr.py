@@ -0,0 +1,37 @@
+from unittest import TestCase, mock
+
+from PIL import Image
+from pyocr.builders import Box, LineBox
+
+from app.library.ocr import DigitField, get_digits_with_single_text_line_and_eng_from_images
+
+
+def word_box(content: str, start_x: int, end_x: int, confidence: int) -> Box:
+    return Box(content, ((start_x, 0), (end_x, 8)), confidence)
+
+
+class TestGetDigitsFromImages(TestCase):
+    def test_get_digits(self) -> None:
+        # 高さ8の画像を並べると、間隔は8で、各画像の範囲は (8, 28), (36, 66), (74, 84) になる
+        images = [Image.new('L', (20, 8), 255), Image.new('L', (30, 8), 255), Image.new('L', (10, 8), 255)]
+
+        for (name, word_boxes, want) in (
+                ('one word per image', [word_box('123', 9, 27, 90), word_box('45', 40, 60, 80), word_box('6', 75, 83, 70)],
+                 [DigitField('123', 90), DigitField('45', 80), DigitField('6', 70)]),
+                # 1つの画像に複数の単語があれば左から順につなげ、確度は最も低いものにする
+                ('split words', [word_box('6', 75, 83, 70), word_box('2', 18, 27, 60), word_box('1', 9, 17, 95)],
+                 [DigitField('12', 60), DigitField('', 0), DigitField('6', 70)]),
+                # 間隔に少しはみ出した単語は中心が近い画像に振り分ける
+                ('overflow', [word_box('1', 4, 14, 90), word_box('2', 28, 40, 90), word_box('3', 64, 86, 90)],
+                 [DigitField('1', 90), DigitField('2', 90), DigitField('3', 90)]),
+                ('no words', [], [DigitField('', 0)] * 3),
+        ):
+            with self.subTest(name=name):
+                line_boxes = [LineBox(word_boxes, ((0, 0), (92, 8)))] if len(word_boxes) > 0 else []
+                with mock.patch('app.library.ocr.image_to_string', return_value=line_boxes) as image_to_string:
+                    got = get_digits_with_single_text_line_and_eng_from_images(images)
+
+                # 並べた1枚の画像を1回だけ読み取る
+                image_to_string.assert_called_once()
+                self.assertEqual(image_to_string.call_args[0][0].size, (92, 8))
+                self.assertEqual(got, want)
@@ -0,0 +1,55 @@
+from unittest import TestCase
+
+import numpy as np
+from PIL import Image
+
+from app.library.pillow import background_level, binarized, concat_horizontal, otsu_threshold
+
+
+class TestOtsuThreshold(TestCase):
+    def test_otsu_threshold(self) -> None:
+        rng = np.random.default_rng(0)
+        # 背景と文字の明るさが変わっても、切り出した領域ごとに文字を黒・背景を白に分ける
+        for (background, text) in ((230, 60), (135, 40), (210, 128), (250, 150)):
+            with self.subTest(background=background, text=text):
+                array = np.full((30, 200), background, dtype=np.int16)
+                array[8:22, 20:180:4] = text
+                mask = array == text
+                array = np.clip(array + rng.integers(-10, 11, array.shape), 0, 255).astype(np.uint8)
+
+                image = Image.fromarray(array).convert('RGB')
+                got = binarized(image, otsu_threshold(image))
+
+                self.assertEqual(got.mode, 'L')
+                self.assertEqual(got.size, (200, 30))
+                got_array = np.asarray(got)
+                self.assertTrue((got_array[mask] == 0).all())
+                self.assertTrue((got_array[~mask] == 255).all())
+
+
+class TestConcatHorizontal(TestCase):
+    def test_concat_horizontal(self) -> None:
+        images = [Image.new('L', (20, 8), 0), Image.new('RGB', (30, 6), (10, 10, 10)), Image.new('L', (10, 8), 0)]
+
+        (strip, spans) = concat_horizontal(images, 8, 255)
+
+        # 先頭・画像の間・末尾に同じ幅の間隔を空け、高さは最も高い画像に合わせる
+        self.assertEqual(strip.mode, 'L')
+        self.assertEqual(strip.size, (20 + 30 + 10 + 8 * 4, 8))
+        self.assertEqual(spans, [(8, 28), (36, 66), (74, 84)])
+
+        array = np.asarray(strip)
+        for ((start_x, end_x), (_, height), value) in zip(spans, [image.size for image in images], (0, 10, 0)):
+            self.assertTrue((array[:height, start_x:end_x] == value).all())
+            self.assertTrue((array[height:, start_x:end_x] == 255).all())
+        # 間隔は fill で埋める
+        for (start_x, end_x) in ((0, 8), (28, 36), (66, 74), (84, 92)):
+            self.assertTrue((array[:, start_x:end_x] == 255).all())
+
+    def test_background_level(self) -> None:
+        white = Image.new('L', (20, 8), 250)
+        mostly_white = Image.fromarray(np.pad(np.zeros((4, 4), dtype=np.uint8), 4, constant_values=250))
+
+        # すべての画像の濃淡分布を合わせて最も多い明るさを返す
+        self.assertEqual(background_level([white, mostly_white]), 250)
+        self.assertEqual(background_level([Image.new('RGB', (4, 4), (0, 0, 0)), white.resize((2, 2))]), 0)
@@ -0,0 +1,27 @@
+from unittest import TestCase
+
+import cv2
+import numpy as np
+
+from app.library.matching_template import matching_template
+from app.usecase.templates import ABILITY_RANK_TEMPLATES, ability_rank_classifier, template_registry
+
+
+class TestRankClassifier(TestCase):
+    def test_classify(self) -> None:
+        rng = np.random.default_rng(0)
+
+        for (templ_name, rank) in ABILITY_RANK_TEMPLATES:
+            with self.subTest(rank=rank):
+                templ = template_registry.get(templ_name)
+                image = rng.integers(0, 256, (templ.shape[0] + 12, templ.shape[1] + 14), dtype=np.uint8)
+                image[5:5 + templ.shape[0], 7:7 + templ.shape[1]] = templ
+
+                got = ability_rank_classifier.classify(image)
+                self.assertEqual(got.rank, rank)
+                self.assertAlmostEqual(got.confidence, 1.0, places=4)
+
+                scores = ability_rank_classifier.scores(image)
+                for (score, (other_templ_name, _)) in zip(scores, ABILITY_RANK_TEMPLATES):
+                    want = cv2.minMaxLoc(matching_template(image, template_registry.get(other_templ_name)))[1]
+                    self.assertAlmostEqual(float(score), want, places=4)
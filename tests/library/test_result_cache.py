@@ -0,0 +1,89 @@
+import asyncio
+import io
+from unittest import TestCase
+
+import fakeredis
+import numpy as np
+from PIL import Image
+
+from app.library.result_cache import ResultCache, image_digest
+
+
+def create_image(seed: int) -> Image:
+    return Image.fromarray(np.random.default_rng(seed).integers(0, 256, (64, 48, 3), dtype=np.uint8))
+
+
+def reencode(image: Image, **params) -> Image:
+    buf = io.BytesIO()
+    image.save(buf, format='PNG', **params)
+    buf.seek(0)
+    return Image.open(buf)
+
+
+class TestImageDigest(TestCase):
+    def test_image_digest(self) -> None:
+        image = create_image(0)
+
+        for (name, other, want_equal) in (
+                ('reencoded', reencode(image, compress_level=9), True),
+                ('rgba', image.convert('RGBA'), True),
+                ('other pixels', create_image(1), False),
+        ):
+            with self.subTest(name=name):
+                self.assertEqual(image_digest(image) == image_digest(other), want_equal)
+
+
+class TestResultCache(TestCase):
+    def test_get_or_create(self) -> None:
+        now = [0]
+        result_cache = ResultCache(maxsize=8, ttl=60, version='v1', timer=lambda: now[0])
+        calls = []
+
+        async def create():
+            calls.append(1)
+            await asyncio.sleep(0)
+            return {'value': len(calls)}
+
+        async def run(image):
+            return await asyncio.gather(
+                result_cache.get_or_create('status', image, create),
+                result_cache.get_or_create('status', image, create),
+            )
+
+        image = create_image(0)
+        self.assertEqual(asyncio.run(run(image)), [{'value': 1}, {'value': 1}])
+        self.assertEqual(asyncio.run(run(reencode(image))), [{'value': 1}, {'value': 1}])
+
+        # TTLを過ぎたら作り直す
+        now[0] = 61
+        self.assertEqual(asyncio.run(run(image)), [{'value': 2}, {'value': 2}])
+
+        stats = result_cache.stats()
+        self.assertEqual(stats.entries, 1)
+        self.assertEqual(stats.hits, 2)
+        self.assertEqual(stats.misses, 4)
+        self.assertEqual(stats.shared, 2)
+
+    def test_redis(self) -> None:
+        redis_client = fakeredis.FakeRedis()
+        image = create_image(0)
+
+        async def create():
+            return {'value': 1}
+
+        async def fail():
+            raise AssertionError('must not be called')
+
+        first = ResultCache(maxsize=8, ttl=60, version='v1', redis_client=redis_client)
+        self.assertEqual(asyncio.run(first.get_or_create('status', image, create)), {'value': 1})
+
+        # 別プロセスのキャッシュからもRedis経由で読める
+        second = ResultCache(maxsize=8, ttl=60, version='v1', redis_client=redis_client)
+        self.assertEqual(asyncio.run(second.get_or_create('status', image, fail)), {'value': 1})
+        self.assertEqual(second.stats().redis_hits, 1)
+
+        # マスターデータのバージョンやエンドポイントが違えば別の結果として扱う
+        for (version, endpoint) in (('v2', 'status'), ('v1', 'support_params')):
+            with self.subTest(version=version, endpoint=endpoint):
+                other = ResultCache(maxsize=8, ttl=60, version=version, redis_client=redis_client)
+                self.assertIsNone(other.get(other.key(endpoint, image_digest(image))))
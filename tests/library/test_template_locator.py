@@ -0,0 +1,112 @@
+import os
+import tempfile
+from unittest import TestCase
+
+import cv2
+import numpy as np
+
+from app.library.matching_template import TemplateMatch
+from app.library.template_locator import CalibrationCache, LayoutPrior, TemplateLocator
+from app.usecase.templates import PARAMS_FRAME_TEMPLATE, template_registry
+
+
+class TestTemplateLocator(TestCase):
+    def test_search(self) -> None:
+        rng = np.random.default_rng(0)
+        templ = template_registry.get(PARAMS_FRAME_TEMPLATE)
+        image = rng.integers(0, 64, (1400, 1024), dtype=np.uint8)
+        image[600:634, 70:965] = cv2.resize(templ, (895, 34), interpolation=cv2.INTER_AREA)
+        linspace = np.linspace(1.1, 1.5, 10)
+
+        # 範囲内で見つかればそのまま、見つからなければ画像全体から探し直した結果を返す
+        for (box, enabled, prior_hits, prior_misses) in (
+                ((0.0, 0.3, 1.0, 0.6), True, 1, 0),
+                ((0.0, 0.0, 1.0, 0.3), True, 0, 1),
+                ((0.0, 0.3, 1.0, 0.6), False, 0, 0),
+        ):
+            with self.subTest(box=box, enabled=enabled):
+                locator = TemplateLocator({PARAMS_FRAME_TEMPLATE: LayoutPrior(box)}, enabled=enabled)
+                got = locator.search(PARAMS_FRAME_TEMPLATE, image, templ, linspace)
+
+                (start_x, start_y), (end_x, end_y) = got.loc
+                self.assertLessEqual(abs(start_x - 70), 4)
+                self.assertLessEqual(abs(start_y - 600), 4)
+                self.assertLessEqual(abs(end_x - 965), 4)
+                self.assertLessEqual(abs(end_y - 634), 4)
+                stats = locator.stats()
+                self.assertEqual((stats.prior_hits, stats.prior_misses), (prior_hits, prior_misses))
+                self.assertEqual(stats.full_searches, 1 - prior_hits)
+
+    def test_calibration(self) -> None:
+        rng = np.random.default_rng(0)
+        templ = template_registry.get(PARAMS_FRAME_TEMPLATE)
+        pasted = cv2.resize(templ, (895, 34), interpolation=cv2.INTER_AREA)
+        linspace = np.linspace(1.1, 1.5, 10)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'calibration.json')
+            locator = TemplateLocator(dict(), calibration=CalibrationCache(path=path))
+
+            # 同じ解像度の2回目は前回の位置の周辺だけを探索し、位置が変わっていれば探索し直す
+            for (y, hits, invalidations) in ((600, 0, 0), (600, 1, 0), (603, 2, 0), (200, 2, 1)):
+                with self.subTest(y=y):
+                    image = rng.integers(0, 64, (1400, 1024), dtype=np.uint8)
+                    image[y:y + 34, 70:965] = pasted
+                    got = locator.search(PARAMS_FRAME_TEMPLATE, image, templ, linspace, size=(1080, 1476))
+
+                    (start_x, start_y), (end_x, end_y) = got.loc
+                    self.assertLessEqual(abs(start_x - 70), 4)
+                    self.assertLessEqual(abs(start_y - y), 4)
+                    self.assertLessEqual(abs(end_x - 965), 4)
+                    self.assertLessEqual(abs(end_y - (y + 34)), 4)
+                    stats = locator.calibration.stats()
+                    self.assertEqual((stats.entries, stats.hits, stats.invalidations), (1, hits, invalidations))
+
+            # 保存した内容は再起動後も使える
+            calibration = CalibrationCache(path=path)
+            calibration.load()
+            self.assertEqual(calibration.entries, locator.calibration.entries)
+
+    def test_calibration_merge(self) -> None:
+        match = TemplateMatch(0.9, 0.8, (70, 600), (965, 634))
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'calibration.json')
+            # 同じファイルに書く2つのプロセスのキャッシュ
+            a = CalibrationCache(path=path)
+            b = CalibrationCache(path=path)
+
+            # 他方が見つけたものを上書きせずにマージする
+            a.put('params_frame', (1080, 1476), match)
+            b.put('params_frame', (1080, 2340), match)
+            a.put('skill_tab', (1080, 1476), match)
+            loaded = CalibrationCache(path=path)
+            loaded.load()
+            self.assertEqual(sorted(loaded.entries),
+                             ['params_frame:1080x1476', 'params_frame:1080x2340', 'skill_tab:1080x1476'])
+
+            # 破棄したものはファイルからも除く
+            with b.lock:
+                b.entries.pop('params_frame:1080x2340')
+                b.removed.add('params_frame:1080x2340')
+            b.save()
+            loaded = CalibrationCache(path=path)
+            loaded.load()
+            self.assertEqual(sorted(loaded.entries), ['params_frame:1080x1476', 'skill_tab:1080x1476'])
+
+    def test_calibration_load_corrupt(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'calibration.json')
+            with open(path, 'w') as f:
+                f.write('{"params_frame:1080x1476": {"sca')
+
+            calibration = CalibrationCache(path=path)
+            with self.assertLogs('app.library.template_locator', level='WARNING'):
+                calibration.load()
+            self.assertEqual(len(calibration.entries), 0)
+
+            # 壊れたファイルは次の保存で置き換える
+            calibration.put('params_frame', (1080, 1476), TemplateMatch(0.9, 0.8, (70, 600), (965, 634)))
+            loaded = CalibrationCache(path=path)
+            loaded.load()
+            self.assertEqual(list(loaded.entries), ['params_frame:1080x1476'])
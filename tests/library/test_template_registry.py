@@ -0,0 +1,32 @@
+from unittest import TestCase
+
+from app.library.template_registry import TemplateRegistry, TemplateSpec
+from app.usecase.templates import (ABILITY_RANK_TEMPLATE_WIDTH, ABILITY_RANK_TEMPLATES, CHARACTER_RANK_TEMPLATES,
+                                   CIRCLE_TEMPLATES, resource_path, template_registry)
+
+
+class TestTemplateRegistry(TestCase):
+    def test_load(self) -> None:
+        template_registry.load()
+
+        for (templ_name, _) in ABILITY_RANK_TEMPLATES + CHARACTER_RANK_TEMPLATES + CIRCLE_TEMPLATES:
+            with self.subTest(templ_name=templ_name):
+                templ = template_registry.get(templ_name)
+                self.assertEqual(templ.ndim, 2)
+                self.assertFalse(templ.flags.writeable)
+
+    def test_get(self) -> None:
+        registry = TemplateRegistry([
+            TemplateSpec('ability/s', resource_path('template_matching', 'ability', 's.png'), ABILITY_RANK_TEMPLATE_WIDTH),
+        ])
+
+        first = registry.get('ability/s')
+        second = registry.get('ability/s')
+
+        self.assertIs(first, second)
+        self.assertEqual(first.shape, (ABILITY_RANK_TEMPLATE_WIDTH, ABILITY_RANK_TEMPLATE_WIDTH))
+        stats = registry.stats()
+        self.assertEqual(stats.templates, 1)
+        self.assertEqual(stats.hits, 1)
+        self.assertEqual(stats.misses, 1)
+        self.assertEqual(stats.nbytes, first.nbytes)
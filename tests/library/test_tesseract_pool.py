@@ -0,0 +1,77 @@
+import itertools
+from unittest import TestCase, mock
+
+from app.library import tesseract_pool
+from app.library.tesseract_pool import EngineKey, TesseractEnginePool
+
+ENG = EngineKey('eng', 7, True)
+JPN = EngineKey('jpn', 7, False)
+
+
+class TestTesseractEnginePool(TestCase):
+    def setUp(self) -> None:
+        handles = itertools.count(1)
+        self.init_engine = mock.patch.object(tesseract_pool, 'init_engine', side_effect=lambda key: next(handles))
+        self.clear_engine = mock.patch.object(tesseract_pool, 'clear_engine')
+        self.tesseract_raw = mock.patch.object(tesseract_pool, 'tesseract_raw')
+        self.init_engine = self.init_engine.start()
+        self.clear_engine = self.clear_engine.start()
+        self.tesseract_raw = self.tesseract_raw.start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_reuse(self) -> None:
+        pool = TesseractEnginePool(2)
+
+        # 同じ設定のエンジンは初期化し直さずに使い回し、返却のたびに前の認識結果を消す
+        for key in (ENG, ENG, JPN, JPN):
+            with pool.engine(key):
+                pass
+
+        self.assertEqual(self.init_engine.call_count, 2)
+        self.assertEqual(self.clear_engine.call_count, 4)
+        stats = pool.stats()
+        self.assertEqual((stats.engines, stats.idle, stats.created, stats.evicted), (2, 2, 2, 0))
+
+    def test_evict(self) -> None:
+        pool = TesseractEnginePool(1)
+
+        # 上限に達していれば、使われていない別の設定のエンジンを破棄して作り直す
+        for key in (ENG, JPN, ENG):
+            with pool.engine(key):
+                pass
+
+        self.assertEqual(self.init_engine.call_count, 3)
+        self.assertEqual([c.args for c in self.tesseract_raw.cleanup.call_args_list], [(1,), (2,)])
+        stats = pool.stats()
+        self.assertEqual((stats.engines, stats.idle, stats.created, stats.evicted), (1, 1, 3, 2))
+
+    def test_discard(self) -> None:
+        pool = TesseractEnginePool(2)
+
+        for (failure, clear_failure) in ((True, False), (False, True)):
+            with self.subTest(failure=failure, clear_failure=clear_failure):
+                self.clear_engine.side_effect = RuntimeError if clear_failure else None
+                self.tesseract_raw.cleanup.reset_mock()
+
+                # 認識やクリアに失敗したエンジンはプールに戻さずに解放する
+                with self.assertRaises(RuntimeError):
+                    with pool.engine(ENG) as handle:
+                        if failure:
+                            raise RuntimeError
+
+                self.tesseract_raw.cleanup.assert_called_once_with(handle)
+                stats = pool.stats()
+                self.assertEqual((stats.engines, stats.idle), (0, 0))
+
+    def test_close(self) -> None:
+        pool = TesseractEnginePool(2)
+        with pool.engine(ENG):
+            pass
+        with pool.engine(JPN):
+            pass
+
+        pool.close()
+
+        self.assertEqual(self.tesseract_raw.cleanup.call_count, 2)
+        stats = pool.stats()
+        self.assertEqual((stats.engines, stats.idle), (0, 0))
@@ -0,0 +1,63 @@
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+from unittest import TestCase, mock
+
+from scripts.analytics import main as analytics
+
+
+class FakePool:
+    # 子プロセスを起動せずに、同じプロセスで順に読み取る
+    def __init__(self, *, processes, initializer, initargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        return False
+
+    def imap_unordered(self, func, iterable, chunksize=1):
+        return map(func, iterable)
+
+
+class TestAnalytics(TestCase):
+    def test_resume(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            samples_dir = os.path.join(directory, 'samples')
+            paths = [os.path.join(samples_dir, '1', name) for name in ('a.png', 'b.png', 'c.png')]
+            os.makedirs(os.path.dirname(paths[0]))
+            for path in paths:
+                open(path, 'wb').close()
+
+            # a は読み取り済み、b は失敗、c はまだ読んでいない。最後の行は書き込み途中で中断している
+            output = os.path.join(directory, 'analytics.ndjson')
+            with open(output, 'w', encoding='utf-8') as f:
+                f.write(json.dumps({'path': paths[0], 'result': 'OK', 'elapsed_ms': 1.0}) + '\n')
+                f.write(json.dumps({'path': paths[1], 'result': 'failed to read image', 'elapsed_ms': 1.0}) + '\n')
+                f.write('{"path": "' + paths[2])
+
+            self.assertEqual(analytics.load_checkpoint(output), {paths[0]})
+
+            read = []
+
+            def get_status(path):
+                read.append(path)
+                return {'path': path, 'result': 'OK', 'elapsed_ms': 1.0}
+
+            argv = ['analytics', '--samples-dir', samples_dir, '--output', output, '--processes', '1']
+            with mock.patch.object(sys, 'argv', argv), mock.patch.object(analytics, 'Pool', FakePool), \
+                    mock.patch.object(analytics, 'get_status', get_status), contextlib.redirect_stdout(io.StringIO()):
+                analytics.main()
+
+            # 失敗した画像とまだ読んでいない画像だけを読み直し、後から追記した行が新しい結果になる
+            self.assertEqual(read, paths[1:])
+            with open(output, encoding='utf-8') as f:
+                records = [json.loads(line) for line in f]
+            self.assertEqual([(record['path'], record['result']) for record in records], [
+                (paths[0], 'OK'), (paths[1], 'failed to read image'), (paths[1], 'OK'), (paths[2], 'OK'),
+            ])
+            self.assertEqual(analytics.load_checkpoint(output), set(paths))
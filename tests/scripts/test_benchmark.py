@@ -0,0 +1,74 @@
+import contextlib
+import io
+import os
+import tempfile
+from unittest import TestCase, mock
+
+from PIL import Image
+
+from app.library.metrics import request_stage, stage
+from scripts.benchmark.main import Suite, compare, run_benchmark, summarize
+
+
+def suite_report(p50: float, p90: float, rate: float or None) -> dict:
+    return {'latency_ms': {'count': 10, 'p50': p50, 'p90': p90}, 'accuracy': {'rate': rate}}
+
+
+class TestBenchmark(TestCase):
+    def test_summarize(self) -> None:
+        self.assertEqual(summarize([]), {'count': 0})
+        self.assertEqual(summarize([float(v) for v in range(1, 101)]), {
+            'count': 100, 'min': 1.0, 'max': 100.0, 'mean': 50.5, 'p50': 50.5, 'p90': 90.1, 'p99': 99.01,
+        })
+
+    def test_compare(self) -> None:
+        base = {'suites': {'status': suite_report(100, 200, 0.9), 'skills': suite_report(100, 200, 0.8)}}
+
+        for (name, suites, want) in (
+                ('unchanged', {'status': suite_report(100, 200, 0.9)}, []),
+                ('within the limit', {'status': suite_report(109, 219, 0.95)}, []),
+                ('slower', {'status': suite_report(120, 200, 0.9)}, ['status p50 latency +20.0%']),
+                ('less accurate', {'skills': suite_report(90, 180, 0.75)}, ['skills accuracy 80.00% -> 75.00%']),
+                ('both', {'status': suite_report(100, 300, 0.5)},
+                 ['status p90 latency +50.0%', 'status accuracy 90.00% -> 50.00%']),
+                # 前回のレポートにないスイートや、サンプルのないスイートは比べない
+                ('new suite', {'support_params': suite_report(1000, 2000, 0.1)}, []),
+                ('no samples', {'status': {'latency_ms': {'count': 0}, 'accuracy': {'rate': None}}}, []),
+                ('no accuracy', {'status': suite_report(100, 200, None)}, []),
+        ):
+            with self.subTest(name=name), contextlib.redirect_stdout(io.StringIO()):
+                got = compare(base, {'suites': suites}, max_latency_regression=0.1)
+                self.assertEqual(got, want)
+
+    def test_run_benchmark(self) -> None:
+        async def read(api_resource, image, timings):
+            with request_stage('api.test', timings=timings):
+                with stage('ocr'):
+                    pass
+            return {'width': image.size[0]}
+
+        suite = Suite('test', 'test_dir', lambda rows: rows[0], read,
+                      lambda want, got: [('width', want[0], got.get('width'))])
+        api_resource = mock.Mock()
+
+        with tempfile.TemporaryDirectory() as tests_path:
+            os.mkdir(os.path.join(tests_path, 'test_dir'))
+            for (name, width, want) in (('a', 10, 10), ('b', 20, 21), ('c', 30, None)):
+                Image.new('RGB', (width, 8)).save(os.path.join(tests_path, 'test_dir', name + '.png'))
+                # 正解のCSVがない画像は使わない
+                if want is not None:
+                    with open(os.path.join(tests_path, 'test_dir', name + '.csv'), 'w') as f:
+                        f.write('{}\n'.format(want))
+
+            report = run_benchmark(api_resource, [suite], tests_path, 2)
+
+        got = report['suites']['test']
+        self.assertEqual((got['samples'], got['runs'], got['latency_ms']['count']), (2, 4, 4))
+        self.assertEqual(got['ocr_calls'], {'total': 4, 'per_run': 1.0})
+        self.assertEqual(sorted(got['stages_ms']), ['api.test', 'ocr'])
+        self.assertEqual(got['accuracy']['rate'], 0.5)
+        self.assertEqual(got['mismatches'], [{'sample': 'b', 'field': 'width', 'want': '21', 'got': 20}])
+        self.assertEqual(api_resource.result_cache.clear.call_count, 4)
+        # 最大メモリ使用量はプロセス全体の値なので、スイートごとではなくレポートに1つだけ持つ
+        self.assertNotIn('peak_rss_mb', got)
+        self.assertGreater(report['peak_rss_mb'], 0)
@@ -0,0 +1,55 @@
+import os
+import tempfile
+from unittest import TestCase, mock
+
+from PIL import Image
+
+from app.library.glyph_digits import GlyphDigitReader
+from scripts.glyph_bank.main import learn_labelled
+from tests.library.test_glyph_digits import render_digits
+
+
+class TestGlyphBank(TestCase):
+    def test_learn_labelled(self) -> None:
+        api_resource = mock.Mock()
+        # ステータスは5項目、サポートカードは上限値を含めた10項目を切り出す
+        status = ['1200', '987', '3456', '50', '768']
+        support = ['1', '2', '3', '4', '5', '6', '7', '8', '9', '0']
+
+        async def crop_parameter_images(image):
+            return [render_digits(text) for text in status]
+
+        async def crop_support_parameter_images(image):
+            if image.source.size[0] == 20:
+                return None
+            return [render_digits(text) for text in support]
+
+        api_resource.image_usecase.create_character_detail_image = mock.AsyncMock(side_effect=lambda image: image.source)
+        api_resource.status_usecase.crop_parameter_images = crop_parameter_images
+        api_resource.status_usecase.crop_support_parameter_images = crop_support_parameter_images
+
+        reader = GlyphDigitReader(min_samples=2)
+        reader.configure(learning=True)
+        with tempfile.TemporaryDirectory() as tests_path:
+            for (directory, name, width, row) in (
+                    ('get_parameters_from_image', 'a', 10, status + ['B']),
+                    ('get_parameters_from_image', 'b', 10, status + ['B']),
+                    # 字形の数と正解の桁数が合わなければ学習しない
+                    ('get_parameters_from_image', 'c', 10, ['1', '2', '3', '4', '5']),
+                    ('support_character_modal_aoharu', 'd', 10, ['SSR'] + support),
+                    # 数字の領域が見つからない画像は飛ばす
+                    ('support_character_modal_aoharu', 'e', 20, ['SSR'] + support),
+            ):
+                os.makedirs(os.path.join(tests_path, directory), exist_ok=True)
+                Image.new('RGB', (width, 8)).save(os.path.join(tests_path, directory, name + '.png'))
+                with open(os.path.join(tests_path, directory, name + '.csv'), 'w') as f:
+                    f.write(','.join(row) + '\n')
+
+            with mock.patch('scripts.glyph_bank.main.glyph_digit_reader', reader), \
+                    self.assertLogs('scripts.glyph_bank.main', level='WARNING'):
+                learned = learn_labelled(api_resource, tests_path)
+
+        self.assertEqual(learned, 20)
+        self.assertIsNotNone(reader.bank)
+        reader.configure(learning=False)
+        self.assertEqual(reader.read(render_digits('3456')).text, '3456')
@@ -0,0 +1,70 @@
+import os
+import tempfile
+from unittest import TestCase, mock
+
+from app.prefork import MAX_RESTART_DELAY, MIN_UPTIME, PreforkServer, prepare_metrics_dir, restart_delay
+
+
+class TestPreforkServer(TestCase):
+    def setUp(self) -> None:
+        self.server = PreforkServer(host='127.0.0.1', port=0, workers=1, shutdown_timeout=1)
+        self.spawned = []
+        self.server.spawn = lambda: self.spawned.append(self.server.generation)
+
+    def exit_child(self, pid: int, generation: int, uptime: float, now=100.0):
+        self.server.children[pid] = (generation, now - uptime)
+        with mock.patch('os.waitpid', side_effect=[(pid, 256), (0, 0)]), \
+                mock.patch('time.monotonic', return_value=now), \
+                mock.patch('app.prefork.mark_process_dead') as mark_process_dead, \
+                self.assertLogs('app.prefork', level='WARNING'):
+            self.server.reap()
+        mark_process_dead.assert_called_once_with(pid)
+
+    def test_restart_delay(self) -> None:
+        for (failures, want) in ((0, 0.0), (1, 0.5), (2, 1.0), (3, 2.0), (20, MAX_RESTART_DELAY)):
+            with self.subTest(failures=failures):
+                self.assertEqual(restart_delay(failures), want)
+
+    def test_reap_backoff(self) -> None:
+        # 起動直後に落ち続ける子プロセスは、間隔を倍にしながら起動し直す
+        for (i, want) in enumerate((0.5, 1.0, 2.0), 1):
+            with self.subTest(failures=i):
+                self.exit_child(i, 0, 1.0)
+                self.assertEqual(self.server.pending[-1], 100.0 + want)
+
+        # しばらく動いてから落ちた場合は、すぐに起動し直す
+        self.exit_child(10, 0, MIN_UPTIME + 1)
+        self.assertEqual(self.server.failures, 0)
+        self.assertEqual(self.server.pending[-1], 100.0)
+
+        with mock.patch('time.monotonic', return_value=101.0):
+            self.server.spawn_pending()
+        self.assertEqual(self.spawned, [0, 0, 0])
+        self.assertEqual(self.server.pending, [100.0 + 2.0])
+
+    def test_reap_old_generation(self) -> None:
+        # 入れ替えで止めた古い子プロセスは起動し直さない
+        self.server.children[1] = (0, 0.0)
+        self.server.generation = 1
+        with mock.patch('os.waitpid', side_effect=[(1, 0), ChildProcessError()]), \
+                mock.patch('app.prefork.mark_process_dead'):
+            self.server.reap()
+
+        self.assertEqual(self.server.children, {})
+        self.assertEqual(self.server.pending, [])
+
+
+class TestPrepareMetricsDir(TestCase):
+    def test_prepare_metrics_dir(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ('histogram_1.db', 'counter_2.db', 'README'):
+                open(os.path.join(directory, name), 'w').close()
+
+            # 前回の起動で残った値だけを消す
+            with mock.patch.dict(os.environ, {'PROMETHEUS_MULTIPROC_DIR': directory}):
+                prepare_metrics_dir()
+            self.assertEqual(os.listdir(directory), ['README'])
+
+    def test_not_set(self) -> None:
+        with mock.patch.dict(os.environ, clear=True), self.assertLogs('app.prefork', level='WARNING'):
+            prepare_metrics_dir()
@@ -1,5 +1,6 @@
 import asyncio
 import csv
+import json
 import logging
 import os
 from unittest import TestCase
@@ -65,3 +66,34 @@ class TestCharacterInteractor(TestCase):
                         result_character_array.append(Character(row[0], row[1]))
                     want = result_character_array[0].nickname
                 self.assertEqual(got, want)
+
+    def test_get_master_characters(self) -> None:
+        def load(name: str) -> list:
+            with open(os.path.join(resources.__path__[0], 'master_data', name)) as f:
+                return json.load(f)
+
+        want_characters = load('characters.json')
+        want_all_characters = load('all_characters.json')
+        self.assertNotEqual(want_characters, want_all_characters)
+
+        # どちらを先に読み込んでも、それぞれ別のキャッシュから返す
+        for first in ('characters', 'all_characters'):
+            with self.subTest(first=first):
+                character_interactor = CharacterInteractor(LocalFileDriverImpl(''), logging.getLogger(__name__))
+
+                async def get():
+                    if first == 'characters':
+                        characters = await character_interactor.get_master_characters()
+                        all_characters = await character_interactor.get_master_all_characters()
+                    else:
+                        all_characters = await character_interactor.get_master_all_characters()
+                        characters = await character_interactor.get_master_characters()
+                    return (characters, all_characters,
+                            await character_interactor.get_master_characters(),
+                            await character_interactor.get_master_all_characters())
+
+                (characters, all_characters, cached_characters, cached_all_characters) = asyncio.run(get())
+                self.assertEqual(characters, want_characters)
+                self.assertEqual(all_characters, want_all_characters)
+                self.assertEqual(cached_characters, want_characters)
+                self.assertEqual(cached_all_characters, want_all_characters)
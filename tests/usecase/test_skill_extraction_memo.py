@@ -0,0 +1,77 @@
+import asyncio
+import gc
+import logging
+from unittest import TestCase
+
+from PIL import Image
+
+from app.domain.skill import NormalSkill, NormalSkills, SkillExtraction
+from app.driver.file_driver import LocalFileDriverImpl
+from app.usecase.skill_interactor import SkillInteractor
+
+
+class TestSkillExtractionMemo(TestCase):
+    def test_memo(self) -> None:
+        interactor = SkillInteractor(LocalFileDriverImpl(''), logging.getLogger(__name__))
+        extraction = SkillExtraction(NormalSkills([NormalSkill('固有A', 3), NormalSkill('コーナー回復◯', 0)]),
+                                     frozenset(['固有A']))
+
+        # 呼び出し引数を覚えておくと画像が解放されないので、回数だけを数える
+        calls = []
+
+        async def extract(image):
+            calls.append(None)
+            await asyncio.sleep(0)
+            return extraction
+
+        async def read_all(image):
+            return await asyncio.gather(
+                interactor.get_unique_skill_from_image(image),
+                interactor.get_skills_without_unique_from_image(image),
+                interactor.get_skill_extraction_from_image(image),
+            )
+
+        interactor.extract_skills_from_image = extract
+
+        # 同じ画像への呼び出しは、同時に行われても抽出を1回だけ行う
+        image = Image.new('RGB', (10, 10))
+        (unique_skill, normal_skills, got) = asyncio.run(read_all(image))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(unique_skill, NormalSkill('固有A', 3))
+        self.assertEqual(normal_skills, NormalSkills([NormalSkill('コーナー回復◯', 0)]))
+        self.assertIs(got, extraction)
+
+        asyncio.run(read_all(image))
+        self.assertEqual(len(calls), 1)
+
+        # 別の画像は別に抽出し、画像が解放されたら結果も破棄する
+        other = Image.new('RGB', (10, 10))
+        asyncio.run(read_all(other))
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(len(interactor.skill_extraction_memo), 2)
+
+        del image, other
+        gc.collect()
+        self.assertEqual(len(interactor.skill_extraction_memo), 0)
+
+    def test_memo_failed(self) -> None:
+        interactor = SkillInteractor(LocalFileDriverImpl(''), logging.getLogger(__name__))
+        calls = []
+
+        async def extract(image):
+            calls.append(None)
+            raise ValueError('broken image')
+
+        interactor.extract_skills_from_image = extract
+
+        # 失敗した抽出は残さず、次の呼び出しで抽出し直す
+        image = Image.new('RGB', (10, 10))
+        for want_calls in (1, 2):
+            with self.assertRaises(ValueError):
+                asyncio.run(interactor.get_skill_extraction_from_image(image))
+            self.assertEqual(len(calls), want_calls)
+            self.assertEqual(len(interactor.skill_extraction_memo), 0)
+
+        del image
+        gc.collect()
+        self.assertEqual(len(interactor.skill_extraction_memo), 0)
@@ -2,7 +2,7 @@ import asyncio
 import csv
 import logging
 import os
-from unittest import TestCase
+from unittest import TestCase, mock
 
 from PIL import Image
 
@@ -155,3 +155,29 @@ class TestSkillInteractor(TestCase):
         want = ((42, 960), (973, 1008))
 
         self.assertEqual(got, want)
+
+    def test_skill_name_threshold_fallback(self):
+        skill_interactor = SkillInteractor(LocalFileDriverImpl(''), logging.getLogger(__name__))
+        image = Image.new('RGB', (1024, 600), (255, 255, 255))
+
+        # 大津の二値化で一致すれば1回だけ読み取り、そうでなければ大津のしきい値に最も近いものを除いた
+        # 固定のしきい値で最初に一致するまでリトライする。読み取りは最大4回
+        for (name, otsu, reads, want_name, want_thresholds) in (
+            ('otsu', 128, {128: ('A', 0.6)}, 'A', [128]),
+            ('fallback', 128, {128: None, 120: ('', 0), 140: ('B', 0.6), 160: ('C', 0.9)}, 'B', [128, 120, 140]),
+            ('dark', 100, {100: None, 130: ('B', 0.6)}, 'B', [100, 130]),
+            ('failed', 128, {128: ('', 0), 120: None, 140: ('', 0), 160: None}, '', [128, 120, 140, 160]),
+        ):
+            with self.subTest(name=name):
+                with mock.patch.object(skill_interactor, 'get_skill_tab_location', return_value=((0, 0), (100, 20))), \
+                        mock.patch.object(skill_interactor, 'get_skill_frame_locations',
+                                          return_value=[((0, 0), (500, 60))]), \
+                        mock.patch.object(skill_interactor, 'get_skill_level_from_image', return_value=0), \
+                        mock.patch('app.usecase.skill_interactor.otsu_threshold', return_value=otsu), \
+                        mock.patch('app.usecase.skill_interactor.binarized', side_effect=lambda _, threshold: threshold), \
+                        mock.patch.object(skill_interactor, 'match_skill_name_from_image',
+                                          side_effect=lambda threshold: reads[threshold]) as match:
+                    got = asyncio.run(skill_interactor.get_skills_from_image(image))
+
+                self.assertEqual(got, NormalSkills([NormalSkill(want_name, 0)]))
+                self.assertEqual([call[0][0] for call in match.call_args_list], want_thresholds)
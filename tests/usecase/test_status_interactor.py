@@ -2,13 +2,17 @@ import asyncio
 import csv
 import logging
 import os
-from unittest import TestCase
+import threading
+from unittest import TestCase, mock
 
 from PIL import Image
 
 import resources
 from app.domain.parameters import Parameters, SupportParameters
+from app.domain.image import ImageContext
 from app.driver.file_driver import LocalFileDriverImpl
+from app.library.ocr import DigitField
+from app.usecase.character import CharacterInteractor
 from app.usecase.status_interactor import StatusInteractor
 from app.usecase.image import ImageInteractor
 
@@ -96,3 +100,46 @@ class TestSkillInteractor(TestCase):
                     want = wants[0]
 
                 self.assertEqual(got, want)
+
+    def test_get_parameters_from_images(self) -> None:
+        status_interactor = StatusInteractor(LocalFileDriverImpl(''), logging.getLogger(__name__))
+        images = [Image.new('L', (20 + i, 8), 255) for i in range(5)]
+        per_crop = {22: '345', 23: 'l7', 24: ''}
+
+        # まとめて読み取れなかった項目だけを、その画像を個別に読み取って埋める
+        fields = [DigitField('1200', 90), DigitField('98', 85), DigitField('', 0), DigitField('a', 40), DigitField('', 0)]
+        with mock.patch('app.usecase.status_interactor.get_digits_with_single_text_line_and_eng_from_images',
+                        return_value=fields) as get_digits, \
+                mock.patch('app.usecase.status_interactor.get_digit_with_single_text_line_and_eng_from_image',
+                           side_effect=lambda image: per_crop[image.size[0]]) as get_digit, \
+                mock.patch('app.usecase.status_interactor.glyph_digit_reader.read', return_value=None):
+            got = asyncio.run(status_interactor.get_parameters_from_images(images))
+
+        get_digits.assert_called_once_with(images)
+        self.assertEqual([call[0][0].size[0] for call in get_digit.call_args_list], [22, 23, 24])
+        self.assertEqual(got, ['1200', '98', '345', '7', 0])
+
+    def test_support_image_resized_off_loop(self) -> None:
+        # 全体のリサイズはワーカープールで行い、イベントループのスレッドでは行わない
+        class RecordingContext(ImageContext):
+            @property
+            def image(self):
+                threads.append(threading.current_thread())
+                return ImageContext.image.fget(self)
+
+        logger = logging.getLogger(__name__)
+        for (name, read) in (
+                ('status', StatusInteractor(LocalFileDriverImpl(''), logger, debug=True).get_support_parameters_from_image),
+                ('character',
+                 CharacterInteractor(LocalFileDriverImpl(''), logger, debug=True).get_character_name_from_support_image),
+        ):
+            with self.subTest(name=name):
+                threads = []
+                context = RecordingContext(Image.new('RGB', (2048, 2048)))
+                with mock.patch('app.usecase.templates.template_registry.get'), \
+                        mock.patch('app.usecase.status_interactor.multi_scale_matching_template', return_value=None), \
+                        mock.patch('app.usecase.character.multi_scale_matching_template', return_value=None):
+                    asyncio.run(read(context))
+
+                self.assertGreater(len(threads), 0)
+                self.assertNotIn(threading.main_thread(), threads)
@@ -0,0 +1,167 @@
+import asyncio
+import io
+import json
+import time
+import uuid
+from unittest import IsolatedAsyncioTestCase, mock
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from app.aio import create_aio_app
+from app.library.job_queue import JobQueueFull, JobWorkerPool, MemoryJobQueue
+from tests.views.test_api import (BROKEN_WIDTH, MAX_BATCH_CONTENT_LENGTH, MAX_CONTENT_LENGTH, FakeAPIResource,
+                                  image_bytes, zip_bytes)
+
+
+def multipart_body(fields: [(str, str, bytes)]) -> (bytes, str):
+    boundary = uuid.uuid4().hex
+    body = io.BytesIO()
+    for (name, filename, content) in fields:
+        body.write('--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\n'
+                   'Content-Type: application/octet-stream\r\n\r\n'.format(boundary, name, filename).encode())
+        body.write(content)
+        body.write(b'\r\n')
+    body.write('--{}--\r\n'.format(boundary).encode())
+    return body.getvalue(), 'multipart/form-data; boundary={}'.format(boundary)
+
+
+class TestAioAPI(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        job_worker_pool = JobWorkerPool(MemoryJobQueue(ttl=60, max_depth=10), workers=1, poll_interval=0.05)
+        self.api_resource = FakeAPIResource(None, None, None, None, None, None, None, job_worker_pool,
+                                            batch_concurrency=2, max_batch_size=4)
+        config = {
+            'AIO_MAX_CONCURRENCY': 2,
+            'MAX_CONTENT_LENGTH': MAX_CONTENT_LENGTH,
+            'MAX_BATCH_CONTENT_LENGTH': MAX_BATCH_CONTENT_LENGTH,
+        }
+        self.client = TestClient(TestServer(create_aio_app(self.api_resource, config=config)))
+        await self.client.start_server()
+
+    async def asyncTearDown(self) -> None:
+        await self.client.close()
+        self.api_resource.job_worker_pool.stop()
+
+    async def post(self, path: str, fields: [(str, str, bytes)], *, chunked=False):
+        (body, content_type) = multipart_body(fields)
+        if chunked:
+            # Content-Lengthを付けずにチャンク形式で送る
+            async def chunks():
+                for i in range(0, len(body), 1024):
+                    yield body[i:i + 1024]
+
+            return await self.client.post(path, data=chunks(), headers={'Content-Type': content_type})
+        return await self.client.post(path, data=body, headers={'Content-Type': content_type})
+
+    async def test_ready(self) -> None:
+        response = await self.client.get('/api/v1/health/ready')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(await response.json(), {'result': 'OK'})
+
+        # 待ち行列に届かなければ受け付けない
+        job_queue = self.api_resource.job_worker_pool.job_queue
+        with mock.patch.object(job_queue, 'depth', side_effect=ConnectionError('redis is down')), \
+                self.assertLogs('app.views.aio_api', level='ERROR'):
+            response = await self.client.get('/api/v1/health/ready')
+        self.assertEqual(response.status, 503)
+        self.assertEqual(await response.json(), {'result': 'job queue is unavailable'})
+
+        # ジョブのワーカーが止まっていれば受け付けない
+        self.api_resource.job_worker_pool.stop()
+        response = await self.client.get('/api/v1/health/ready')
+        self.assertEqual(response.status, 503)
+        self.assertEqual(await response.json(), {'result': 'job workers are not running'})
+
+    async def test_ocr(self) -> None:
+        for (name, fields, want_status, want) in (
+                ('OK', [('file', 'a.png', image_bytes(10))], 200, {'result': 'OK', 'data': {'size': [10, 8]}}),
+                ('no file', [('files', 'a.png', image_bytes(10))], 400, {'result': 'file is required'}),
+                ('not an image', [('file', 'a.txt', b'not an image')], 400, {'result': 'cannot identify image file'}),
+        ):
+            with self.subTest(name=name):
+                response = await self.post('/api/v1/ocr/status', fields)
+
+                self.assertEqual(response.status, want_status)
+                self.assertEqual(await response.json(), want)
+
+    async def test_content_length(self) -> None:
+        small = [('files', 'a.png', image_bytes(30, 30, noise=True)), ('files', 'b.png', image_bytes(30, 30, noise=True))]
+        large = [('files', 'a.png', image_bytes(160, 160, noise=True))]
+
+        # 上限はエンドポイントごとに、Content-Lengthがなくても読みながら確かめる
+        for chunked in (False, True):
+            for (path, fields, want_status) in (
+                    ('/api/v1/ocr/status', [('file', 'a.png', image_bytes(64, 64, noise=True))], 413),
+                    ('/api/v1/ocr/status:batch', small, 200),
+                    ('/api/v1/ocr/status:batch', large, 413),
+                    ('/api/v1/jobs/ocr/status', small, 202),
+                    ('/api/v1/jobs/ocr/status', large, 413),
+            ):
+                with self.subTest(chunked=chunked, path=path, want_status=want_status):
+                    response = await self.post(path, fields, chunked=chunked)
+
+                    self.assertEqual(response.status, want_status)
+                    if want_status == 413:
+                        self.assertEqual(await response.json(), {'result': 'file is too large'})
+
+    async def test_batch(self) -> None:
+        fields = [('files', 'a.png', image_bytes(10)), ('files', 'b.txt', b'not an image'),
+                  ('archive', 'images.zip', zip_bytes([('c.png', image_bytes(BROKEN_WIDTH))]))]
+        want = [(0, 'a.png', 'OK'), (1, 'b.txt', 'cannot identify image file'), (2, 'c.png', 'failed to read image')]
+
+        response = await self.post('/api/v1/ocr/status:batch', fields)
+        self.assertEqual(response.status, 200)
+        got = [(item['index'], item['filename'], item['result']) for item in (await response.json())['data']]
+        self.assertEqual(got, want)
+
+        response = await self.post('/api/v1/ocr/status:batch?stream=1', fields)
+        self.assertEqual(response.status, 200)
+        lines = [json.loads(line) for line in (await response.text()).splitlines()]
+        self.assertEqual(sorted((item['index'], item['filename'], item['result']) for item in lines), want)
+
+    async def test_stream_failure(self) -> None:
+        async def get_batch_data(items, get_data, on_item=None):
+            on_item({'index': 0, 'filename': 'a.png', 'result': 'OK'})
+            raise RuntimeError('worker crashed')
+
+        # 途中で失敗した場合は、読み取れた分に続けて失敗を知らせる行を返す
+        self.api_resource.get_batch_data = get_batch_data
+        fields = [('files', 'a.png', image_bytes(10)), ('files', 'b.png', image_bytes(30))]
+        with self.assertLogs('app.views.aio_api', level='ERROR'):
+            response = await self.post('/api/v1/ocr/status:batch?stream=1', fields)
+            body = await response.text()
+
+        self.assertEqual(response.status, 200)
+        self.assertEqual([json.loads(line) for line in body.splitlines()],
+                         [{'index': 0, 'filename': 'a.png', 'result': 'OK'}, {'result': 'failed to read images'}])
+
+    async def test_job(self) -> None:
+        fields = [('files', 'a.png', image_bytes(10)), ('files', 'b.png', image_bytes(30))]
+
+        response = await self.post('/api/v1/jobs/ocr/status', fields)
+        self.assertEqual(response.status, 202)
+        job_id = (await response.json())['data']['id']
+
+        deadline = time.monotonic() + 5
+        while True:
+            response = await self.client.get('/api/v1/jobs/' + job_id)
+            self.assertEqual(response.status, 200)
+            job = (await response.json())['data']
+            if job['status'] == 'done' or time.monotonic() > deadline:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual([item['result'] for item in job['result']], ['OK', 'OK'])
+
+        response = await self.client.get('/api/v1/jobs/unknown')
+        self.assertEqual(response.status, 404)
+        self.assertEqual(await response.json(), {'result': 'job not found'})
+
+    async def test_job_queue_full(self) -> None:
+        # 待ち行列が上限に達していれば受け付けず、しばらくしてから投入し直してもらう
+        with mock.patch.object(self.api_resource.job_worker_pool, 'submit', side_effect=JobQueueFull('full')):
+            response = await self.post('/api/v1/jobs/ocr/status', [('files', 'a.png', image_bytes(10))])
+
+        self.assertEqual(response.status, 503)
+        self.assertEqual(response.headers['Retry-After'], '5')
+        self.assertEqual(await response.json(), {'result': 'job queue is full'})
@@ -0,0 +1,241 @@
+import io
+import json
+import time
+import zipfile
+from unittest import TestCase
+
+import numpy as np
+from flask import Flask
+from PIL import Image
+
+from app import add_url_rules
+from app.library.job_queue import JobWorkerPool, MemoryJobQueue
+from app.views.api import APIRequest, APIResource
+from app.views.web import WebResource
+
+MAX_CONTENT_LENGTH = 4 * 1024
+MAX_BATCH_CONTENT_LENGTH = 64 * 1024
+# この幅の画像は読み取りに失敗したことにする
+BROKEN_WIDTH = 13
+
+
+def image_bytes(width: int, height=8, *, format='PNG', noise=False) -> bytes:
+    if noise:
+        array = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    else:
+        array = np.zeros((height, width, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(array).save(buffer, format=format)
+    return buffer.getvalue()
+
+
+def zip_bytes(members: [(str, bytes)]) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for (name, data) in members:
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+class FakeAPIResource(APIResource):
+    # OCRを行わずに、画像の大きさを読み取り結果として返す
+    async def get_status_data(self, image: Image, *, timings=None) -> dict:
+        if image.size[0] == BROKEN_WIDTH:
+            raise RuntimeError('broken image')
+        return {'size': list(image.size)}
+
+    async def get_support_params_data(self, image: Image, *, timings=None) -> dict:
+        return await self.get_status_data(image, timings=timings)
+
+
+def create_test_app(*, max_batch_size=4, max_depth=10) -> Flask:
+    job_worker_pool = JobWorkerPool(MemoryJobQueue(ttl=60, max_depth=max_depth), workers=1, poll_interval=0.05)
+    api_resource = FakeAPIResource(None, None, None, None, None, None, None, job_worker_pool,
+                                   batch_concurrency=2, max_batch_size=max_batch_size)
+
+    app = Flask(__name__)
+    app.request_class = APIRequest
+    app.config.update(MAX_CONTENT_LENGTH=MAX_CONTENT_LENGTH, MAX_BATCH_CONTENT_LENGTH=MAX_BATCH_CONTENT_LENGTH)
+    add_url_rules(app, WebResource(), api_resource)
+    return app, api_resource
+
+
+class TestBatchAPI(TestCase):
+    def setUp(self) -> None:
+        (app, self.api_resource) = create_test_app()
+        self.client = app.test_client()
+
+    def post(self, path: str, *, files=(), archive: bytes = None, query=''):
+        data = {'files': [(io.BytesIO(content), name) for (name, content) in files]}
+        if archive is not None:
+            data['archive'] = (io.BytesIO(archive), 'images.zip')
+        return self.client.post(path + query, data=data, content_type='multipart/form-data')
+
+    def test_batch(self) -> None:
+        large = image_bytes(64, 64, noise=True)
+        self.assertGreater(len(large), MAX_CONTENT_LENGTH)
+
+        for (name, files, archive, want) in (
+                ('files', [('a.png', image_bytes(10)), ('b.jpg', image_bytes(20, format='JPEG'))], None,
+                 [('a.png', 'OK', [10, 8]), ('b.jpg', 'OK', [20, 8])]),
+                ('archive', [], zip_bytes([('dir/', b''), ('dir/a.png', image_bytes(10)), ('b.png', image_bytes(30))]),
+                 [('dir/a.png', 'OK', [10, 8]), ('b.png', 'OK', [30, 8])]),
+                ('files and archive', [('a.png', image_bytes(10))], zip_bytes([('b.png', image_bytes(30))]),
+                 [('a.png', 'OK', [10, 8]), ('b.png', 'OK', [30, 8])]),
+                # 読み取れない画像はその画像だけを失敗として返す
+                ('item errors', [('a.txt', b'not an image'), ('b.gif', image_bytes(10, format='GIF')),
+                                 ('c.png', image_bytes(BROKEN_WIDTH)), ('d.png', image_bytes(10))], None,
+                 [('a.txt', 'cannot identify image file', None), ('b.gif', 'support extension jpg, jpeg or png', None),
+                  ('c.png', 'failed to read image', None), ('d.png', 'OK', [10, 8])]),
+                # 1枚ごとの大きさは単体のエンドポイントと同じ上限で確かめる
+                ('too large', [('a.png', large)], zip_bytes([('b.png', large), ('c.png', image_bytes(10))]),
+                 [('a.png', 'file is too large', None), ('b.png', 'file is too large', None),
+                  ('c.png', 'OK', [10, 8])]),
+        ):
+            for path in ('/api/v1/ocr/status:batch', '/api/v1/ocr/support_params:batch'):
+                with self.subTest(name=name, path=path):
+                    response = self.post(path, files=files, archive=archive)
+
+                    self.assertEqual(response.status_code, 200)
+                    body = response.get_json()
+                    self.assertEqual(body['result'], 'OK')
+                    self.assertEqual([item['index'] for item in body['data']], list(range(len(want))))
+                    got = [(item['filename'], item['result'], item.get('data', {}).get('size'))
+                           for item in body['data']]
+                    self.assertEqual(got, want)
+
+    def test_batch_bad_request(self) -> None:
+        for (name, files, archive, want) in (
+                ('empty', [], None, 'files or archive is required'),
+                ('bad zip', [], b'not a zip file', 'archive must be a zip file'),
+                ('too many files', [(str(i) + '.png', image_bytes(10)) for i in range(5)], None, 'too many files (max 4)'),
+                ('too many members', [], zip_bytes([(str(i) + '.png', image_bytes(10)) for i in range(5)]),
+                 'too many files (max 4)'),
+        ):
+            with self.subTest(name=name):
+                response = self.post('/api/v1/ocr/status:batch', files=files, archive=archive)
+
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.get_json(), {'result': want})
+
+    def test_content_length(self) -> None:
+        # バッチは単体のエンドポイントより大きなリクエストを受け付ける
+        files = [('a.png', image_bytes(40, 40, noise=True)), ('b.png', image_bytes(40, 40, noise=True))]
+        self.assertGreater(sum(len(content) for (_, content) in files), MAX_CONTENT_LENGTH)
+
+        self.assertEqual(self.post('/api/v1/ocr/status:batch', files=files).status_code, 200)
+        self.assertEqual(self.post('/api/v1/ocr/status', files=files).status_code, 413)
+
+        files = [('a.png', image_bytes(160, 160, noise=True))]
+        self.assertGreater(len(files[0][1]), MAX_BATCH_CONTENT_LENGTH)
+        self.assertEqual(self.post('/api/v1/ocr/status:batch', files=files).status_code, 413)
+
+    def test_stream(self) -> None:
+        files = [('a.png', image_bytes(10)), ('b.txt', b'not an image'), ('c.png', image_bytes(30))]
+
+        response = self.post('/api/v1/ocr/status:batch', files=files, query='?stream=1')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        got = sorted((item['index'], item['filename'], item['result']) for item in lines)
+        self.assertEqual(got, [(0, 'a.png', 'OK'), (1, 'b.txt', 'cannot identify image file'), (2, 'c.png', 'OK')])
+
+    def test_stream_failure(self) -> None:
+        async def get_batch_data(items, get_data, on_item=None):
+            on_item({'index': 0, 'filename': 'a.png', 'result': 'OK'})
+            raise RuntimeError('worker crashed')
+
+        # 途中で失敗した場合は、読み取れた分に続けて失敗を知らせる行を返す
+        self.api_resource.get_batch_data = get_batch_data
+        files = [('a.png', image_bytes(10)), ('b.png', image_bytes(30))]
+        with self.assertLogs('app.views.api', level='ERROR'):
+            response = self.post('/api/v1/ocr/status:batch', files=files, query='?stream=1')
+            body = response.get_data(as_text=True)
+
+        self.assertEqual(response.status_code, 200)
+        lines = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual(lines, [{'index': 0, 'filename': 'a.png', 'result': 'OK'},
+                                 {'result': 'failed to read images'}])
+
+
+class TestJobAPI(TestCase):
+    def setUp(self) -> None:
+        (app, api_resource) = create_test_app()
+        api_resource.job_worker_pool.start()
+        self.addCleanup(api_resource.job_worker_pool.stop)
+        self.client = app.test_client()
+
+    def post(self, path: str, *, files=(), archive: bytes = None):
+        data = {'files': [(io.BytesIO(content), name) for (name, content) in files]}
+        if archive is not None:
+            data['archive'] = (io.BytesIO(archive), 'images.zip')
+        return self.client.post(path, data=data, content_type='multipart/form-data')
+
+    def wait_job(self, job_id: str, timeout=5.0) -> dict:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            response = self.client.get('/api/v1/jobs/' + job_id)
+            self.assertEqual(response.status_code, 200)
+            job = response.get_json()['data']
+            if job['status'] in ('done', 'failed'):
+                return job
+            time.sleep(0.01)
+        raise TimeoutError(job_id)
+
+    def test_job(self) -> None:
+        # ジョブもバッチと同じく、単体のエンドポイントより大きなリクエストを受け付ける
+        files = [('a.png', image_bytes(30, 30, noise=True)), ('b.txt', b'not an image')]
+        archive = zip_bytes([('c.png', image_bytes(30)), ('d.png', image_bytes(64, 64, noise=True))])
+        self.assertGreater(sum(len(content) for (_, content) in files) + len(archive), MAX_CONTENT_LENGTH)
+
+        for path in ('/api/v1/jobs/ocr/status', '/api/v1/jobs/ocr/support_params'):
+            with self.subTest(path=path):
+                response = self.post(path, files=files, archive=archive)
+
+                self.assertEqual(response.status_code, 202)
+                submitted = response.get_json()['data']
+                self.assertEqual((submitted['status'], submitted['total']), ('queued', 4))
+
+                job = self.wait_job(submitted['id'])
+                self.assertEqual((job['status'], job['completed']), ('done', 4))
+                got = [(item['index'], item['filename'], item['result']) for item in job['result']]
+                self.assertEqual(got, [(0, 'a.png', 'OK'), (1, 'b.txt', 'cannot identify image file'),
+                                       (2, 'c.png', 'OK'), (3, 'd.png', 'file is too large')])
+
+    def test_job_bad_request(self) -> None:
+        for (name, files, archive, want_status, want) in (
+                ('empty', [], None, 400, 'file, files or archive is required'),
+                ('bad zip', [], b'not a zip file', 400, 'archive must be a zip file'),
+                ('too many files', [(str(i) + '.png', image_bytes(10)) for i in range(5)], None, 400,
+                 'too many files (max 4)'),
+        ):
+            with self.subTest(name=name):
+                response = self.post('/api/v1/jobs/ocr/status', files=files, archive=archive)
+
+                self.assertEqual(response.status_code, want_status)
+                self.assertEqual(response.get_json(), {'result': want})
+
+        files = [('a.png', image_bytes(160, 160, noise=True))]
+        self.assertEqual(self.post('/api/v1/jobs/ocr/status', files=files).status_code, 413)
+
+    def test_job_queue_full(self) -> None:
+        # 待ち行列が上限に達していれば受け付けず、しばらくしてから投入し直してもらう
+        (app, _) = create_test_app(max_depth=1)
+        client = app.test_client()
+        data = {'files': [(io.BytesIO(image_bytes(10)), 'a.png')]}
+
+        response = client.post('/api/v1/jobs/ocr/status', data=dict(data), content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 202)
+
+        data = {'files': [(io.BytesIO(image_bytes(10)), 'b.png')]}
+        response = client.post('/api/v1/jobs/ocr/status', data=data, content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '5')
+        self.assertEqual(response.get_json(), {'result': 'job queue is full'})
+
+    def test_job_not_found(self) -> None:
+        response = self.client.get('/api/v1/jobs/unknown')
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.get_json(), {'result': 'job not found'})